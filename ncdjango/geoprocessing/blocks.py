@@ -0,0 +1,334 @@
+"""
+Block-wise evaluation of expressions over rasters which are too large to hold in memory (see `LazyRaster`). Rasters
+are processed in bands of rows, and results are written to a NetCDF file as they are computed.
+"""
+
+import itertools
+import os
+import tempfile
+
+import netCDF4
+import numpy
+from django.conf import settings
+from trefoil.netcdf.crs import set_crs
+from trefoil.netcdf.variable import SpatialCoordinateVariables
+from trefoil.utilities.proj import is_latlong
+
+from ncdjango.stats import Summary
+from ncdjango.views import READ_BLOCK_SIZE
+
+from .data import LazyRaster, get_data, is_lazy_raster, remove_file
+from .evaluation import BinaryOperation, Call, Expression, Item, Name, Negation, get_children
+from .profiling import evaluate
+
+BLOCKED_OUTPUT_DIR = getattr(settings, 'NC_BLOCKED_OUTPUT_DIR', None)
+
+# Reductions which can be combined across blocks, and how to get their results from a `Summary`
+REDUCTIONS = {
+    'fn_min': lambda summary: summary.min,
+    'fn_max': lambda summary: summary.max,
+    'fn_mean': lambda summary: summary.mean,
+    'fn_std': lambda summary: summary.std,
+    'fn_var': lambda summary: summary.variance
+}
+
+# Reductions which can't be combined across blocks
+UNSUPPORTED_REDUCTIONS = {'fn_median'}
+
+
+class BlockedEvaluationError(ValueError):
+    """Indicates that an operation can't be done block by block"""
+
+
+def create_raster_dataset(path, extent, shape, dtype, y_increasing=False, fill_value=None, compression='zlib',
+                          chunksizes=None):
+    """
+    Creates a NetCDF file for a raster of the given (height, width) shape, with coordinate variables and a `data`
+    variable. Returns a tuple of (dataset, x variable name, y variable name). The caller is responsible for closing
+    the dataset.
+    """
+
+    dataset = netCDF4.Dataset(path, 'w', format='NETCDF4')
+
+    if is_latlong(extent.projection):
+        x_var = 'longitude'
+        y_var = 'latitude'
+    else:
+        x_var = 'x'
+        y_var = 'y'
+
+    coord_vars = SpatialCoordinateVariables.from_bbox(extent, *reversed(shape), y_ascending=y_increasing)
+    coord_vars.add_to_dataset(dataset, x_var, y_var)
+
+    dataset.createVariable(
+        'data', dtype, dimensions=(y_var, x_var), fill_value=fill_value, compression=compression, chunksizes=chunksizes
+    )
+    set_crs(dataset, 'data', extent.projection)
+
+    return dataset, x_var, y_var
+
+
+class RasterWriter(object):
+    """
+    Writes a raster to a temporary NetCDF file in bands of rows. The file is uncompressed (temporary files are usually
+    read once or twice, so compression would cost more than it saves) and chunked in bands of rows of about
+    `CHUNK_SIZE` bytes.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, extent, shape, y_increasing=False, output_dir=BLOCKED_OUTPUT_DIR):
+        self.extent = extent
+        self.shape = shape
+        self.y_increasing = y_increasing
+        self.output_dir = output_dir
+        self.dataset = None
+        self.path = None
+        self.dtype = None
+
+    @property
+    def stored_dtype(self):
+        # NetCDF has no boolean type
+        return numpy.dtype('int8') if self.dtype == bool else self.dtype
+
+    def create(self, dtype):
+        self.dtype = numpy.dtype(dtype)
+
+        fd, self.path = tempfile.mkstemp(suffix='.nc', dir=self.output_dir)
+        os.close(fd)
+
+        height, width = self.shape
+        chunk_rows = min(max(self.CHUNK_SIZE // max(width * self.stored_dtype.itemsize, 1), 1), max(height, 1))
+
+        self.dataset, self.x_var, self.y_var = create_raster_dataset(
+            self.path, self.extent, self.shape, self.stored_dtype, self.y_increasing,
+            fill_value=netCDF4.default_fillvals[self.stored_dtype.str[1:]], compression=None,
+            chunksizes=(chunk_rows, max(width, 1))
+        )
+
+    def write(self, start, block):
+        """Writes a block of rows, starting at row `start`. The first block determines the data type of the raster."""
+
+        if self.dataset is None:
+            self.create(block.dtype)
+
+        if block.dtype != self.stored_dtype:
+            block = block.astype(self.stored_dtype)
+
+        self.dataset.variables['data'][start:start + block.shape[0]] = block
+
+    def close(self):
+        """Closes the file and returns it as a temporary `LazyRaster`"""
+
+        if self.dataset is None:
+            self.create('float32')
+
+        self.dataset.close()
+
+        return LazyRaster(
+            self.path, 'data', self.x_var, self.y_var, self.extent, self.y_increasing,
+            dtype=self.dtype if self.dtype != self.stored_dtype else None, temporary=True
+        )
+
+    def abort(self):
+        """Closes and deletes the file"""
+
+        if self.dataset is not None:
+            self.dataset.close()
+            remove_file(self.path)
+
+
+def get_lazy_rasters(values):
+    """Returns the lazy rasters in `values`, which must all have the same dimensions"""
+
+    rasters = [x for x in values if is_lazy_raster(x)]
+
+    if len({x.shape for x in rasters}) > 1:
+        raise BlockedEvaluationError('Large rasters must all have the same dimensions')
+
+    return rasters
+
+
+def get_row_ranges(rasters, block_size=None):
+    """
+    Returns a list of (start, stop) row ranges covering lazy rasters of the same shape. Ranges are aligned to the
+    chunking of the first raster, and no block of any raster is larger than `block_size` bytes (`NC_READ_BLOCK_SIZE`
+    by default), unless a single chunk row is larger.
+    """
+
+    if block_size is None:
+        block_size = READ_BLOCK_SIZE
+
+    height, width = rasters[0].shape
+    chunk_rows = rasters[0].chunk_rows
+    row_size = max(width, 1) * max(x.dtype.itemsize for x in rasters)
+    block_rows = max(block_size // (row_size * chunk_rows), 1) * chunk_rows
+
+    return [(start, min(start + block_rows, height)) for start in range(0, height, block_rows)]
+
+
+def get_block(value, start, stop, shape):
+    """Returns a band of rows from `value`, if it's a raster with the given shape, or otherwise `value` itself"""
+
+    if is_lazy_raster(value):
+        return value.read(start, stop)
+    if isinstance(value, numpy.ndarray) and value.shape == shape:
+        return value[start:stop]
+
+    return value
+
+
+def map_blocks(fn, values, output_dir=BLOCKED_OUTPUT_DIR):
+    """
+    Calls `fn(blocks)` for each band of rows of the lazy rasters in `values`, where `blocks` is a list of the rows of
+    each value (see `get_block`). The results are written to a temporary NetCDF file, which is returned as a
+    `LazyRaster`.
+    """
+
+    rasters = get_lazy_rasters(values)
+    shape = rasters[0].shape
+    writer = RasterWriter(rasters[0].extent, shape, rasters[0].y_increasing, output_dir)
+
+    try:
+        for start, stop in get_row_ranges(rasters):
+            block = fn([get_block(x, start, stop, shape) for x in values])
+
+            if not isinstance(block, numpy.ndarray) or block.shape != (stop - start, shape[1]):
+                raise BlockedEvaluationError('The result must have the same dimensions as the input rasters')
+
+            writer.write(start, block)
+    except:
+        writer.abort()
+        raise
+
+    return writer.close()
+
+
+def refers_to(node, names):
+    """Does a parse tree refer to any of `names`?"""
+
+    if isinstance(node, Name):
+        return node.key in names
+    return any(refers_to(x, names) for x in get_children(node))
+
+
+def find_reductions(node, names):
+    """
+    Returns the innermost reductions (e.g., `mean(x)`) of `names` in a parse tree. Raises `BlockedEvaluationError` if
+    the tree has operations on `names` which can't be done block by block.
+    """
+
+    found = []
+    for child in get_children(node):
+        found += find_reductions(child, names)
+
+    if not refers_to(node, names):
+        return found
+
+    if isinstance(node, Call):
+        fn_name = getattr(node.fn, '__name__', '')
+
+        if fn_name in UNSUPPORTED_REDUCTIONS:
+            raise BlockedEvaluationError("'{}' isn't supported for large rasters".format(fn_name[3:]))
+
+        if fn_name in REDUCTIONS and not found:
+            if len(node.args) != 1:
+                raise BlockedEvaluationError("'{}' can't be used with an axis for large rasters".format(fn_name[3:]))
+            return [node]
+
+    if isinstance(node, Item) and refers_to(node.obj, names):
+        raise BlockedEvaluationError("Large rasters can't be indexed")
+
+    return found
+
+
+def replace_nodes(node, replacements):
+    """Returns a copy of a parse tree, with nodes replaced according to a dictionary of `{id(node): replacement}`"""
+
+    if id(node) in replacements:
+        return replacements[id(node)]
+    if isinstance(node, BinaryOperation):
+        return BinaryOperation(node.op, replace_nodes(node.left, replacements), replace_nodes(node.right, replacements))
+    if isinstance(node, Negation):
+        return Negation(replace_nodes(node.operand, replacements))
+    if isinstance(node, Call):
+        return Call(node.fn, [replace_nodes(x, replacements) for x in node.args])
+    if isinstance(node, Item):
+        return Item(replace_nodes(node.obj, replacements), replace_nodes(node.index, replacements))
+    return node
+
+
+def compute_reductions(reductions, context):
+    """
+    Computes reductions of the lazy rasters in `context` in a single pass over the rasters. As with in-memory
+    evaluation, masked cells of floating point rasters are ignored, as are NaNs.
+    """
+
+    expressions = [Expression('', node.args[0], set()) for node in reductions]
+    summaries = [Summary() for _ in reductions]
+    rasters = get_lazy_rasters(context.values())
+    shape = rasters[0].shape
+
+    for start, stop in get_row_ranges(rasters):
+        block_context = {k: get_data(get_block(v, start, stop, shape), fill_nan=True) for k, v in context.items()}
+
+        for expression, summary in zip(expressions, summaries):
+            values = numpy.ravel(evaluate(expression, block_context))
+            if values.dtype.kind == 'f':
+                values = values[~numpy.isnan(values)]
+            summary.update(values)
+
+    results = []
+    for node, summary in zip(reductions, summaries):
+        value = REDUCTIONS[node.fn.__name__](summary)
+        results.append(numpy.nan if value is None else value)
+
+    return results
+
+
+def evaluate_blocked(expression, context, evaluate, block_fn=None, output_dir=BLOCKED_OUTPUT_DIR):
+    """
+    Evaluates an expression over the lazy rasters in `context` block by block. Reductions of the rasters (e.g.,
+    `mean(x)`) are computed first, in one pass over the rasters (or one per level, if reductions are nested). Then the
+    expression is evaluated for each band of rows and written to a temporary NetCDF file, which is returned as a
+    `LazyRaster`. If the expression reduces the rasters to a single value, that value is returned instead.
+
+    :param expression: A compiled `Expression`.
+    :param context: Evaluation context.
+    :param evaluate: A function to evaluate a compiled expression for a block, given the block's context.
+    :param block_fn: An optional function to transform each result block, given the result and the block's context.
+    :param output_dir: Directory for the result file. Defaults to the system temporary directory.
+    """
+
+    names = {k for k, v in context.items() if is_lazy_raster(v)}
+    context = dict(context)
+    tree = expression.tree
+    counter = itertools.count()
+
+    while True:
+        # Identical reductions are a single shared node in an optimized tree, so only compute each once
+        reductions = list({id(x): x for x in find_reductions(tree, names)}.values())
+        if not reductions:
+            break
+
+        replacements = {}
+        for node, value in zip(reductions, compute_reductions(reductions, context)):
+            key = '__reduction_{}'.format(next(counter))
+            context[key] = value
+            replacements[id(node)] = Name(key)
+
+        tree = replace_nodes(tree, replacements)
+
+    expression = Expression(expression.expr, tree, expression.names, expression.backend)
+
+    if block_fn is None and not refers_to(tree, names):
+        return evaluate(expression, {k: v for k, v in context.items() if k not in names})
+
+    keys = list(context)
+
+    def evaluate_block(blocks):
+        block_context = dict(zip(keys, blocks))
+        result = evaluate(expression, block_context)
+        return result if block_fn is None else block_fn(result, block_context)
+
+    return map_blocks(evaluate_block, [context[k] for k in keys], output_dir)
@@ -0,0 +1,335 @@
+"""
+Content-addressed cache of workflow node outputs, shared by all jobs. Outputs are keyed by the task name and a hash of
+its inputs. Values loaded from services (or from the cache) are identified by where they came from, so their contents
+don't need to be hashed. Arrays are stored as `.npy` files, and memory-mapped when they're read back. The least recently
+used outputs are removed when the cache is larger than `NC_WORKFLOW_CACHE_SIZE`.
+"""
+
+import hashlib
+import json
+import logging
+import numbers
+import os
+import pickle
+import shutil
+import tempfile
+import weakref
+
+import netCDF4
+import numpy
+from django.conf import settings
+from pyproj import Proj
+from shapely.geometry.base import BaseGeometry
+from trefoil.geometry.bbox import BBox
+
+from .data import LazyRaster, Raster
+
+logger = logging.getLogger(__name__)
+
+WORKFLOW_CACHE_DIR = getattr(settings, 'NC_WORKFLOW_CACHE_DIR', None)
+WORKFLOW_CACHE_SIZE = getattr(settings, 'NC_WORKFLOW_CACHE_SIZE', 2 ** 30)
+
+_sources = {}  # {id(value): (weak reference to value, key)}
+
+
+def set_source(value, key):
+    """Identifies a value by where it came from (e.g., a service variable and the version of its data file)"""
+
+    def remove(ref, value_id=id(value)):
+        if _sources.get(value_id, (None,))[0] is ref:
+            del _sources[value_id]
+
+    _sources[id(value)] = (weakref.ref(value, remove), key)
+
+
+def get_source(value):
+    """Returns the key set for a value with `set_source`, or None"""
+
+    ref, key = _sources.get(id(value), (None, None))
+    return key if ref is not None and ref() is value else None
+
+
+def get_file_version(path):
+    """Returns an identifier for the current version of a file, or None if it doesn't exist"""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return '{}:{}-{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def hash_array(value):
+    """Returns a hash of the contents, type, and shape of an array, including the mask and extent of rasters"""
+
+    h = hashlib.sha256()
+    h.update('{}{}'.format(value.dtype.str, value.shape).encode())
+    h.update(numpy.ascontiguousarray(numpy.ma.getdata(value)).view('uint8'))
+
+    mask = numpy.ma.getmask(value)
+    if mask is not numpy.ma.nomask:
+        h.update(numpy.ascontiguousarray(mask).view('uint8'))
+
+    if isinstance(value, Raster):
+        h.update('{}{}{}{}{}'.format(
+            value.extent.as_list(), value.extent.projection.srs, value.x_dim, value.y_dim, value.y_increasing
+        ).encode())
+
+    return h.hexdigest()
+
+
+def get_value_key(value):
+    """Returns a string which identifies a task input, or None if the value can't be identified"""
+
+    source = get_source(value)
+    if source is not None:
+        return source
+
+    if value is None or isinstance(value, (bool, numbers.Number, str)):
+        return '{}:{!r}'.format(type(value).__name__, value)
+    if isinstance(value, numpy.ndarray):
+        return 'array:{}'.format(hash_array(value))
+    if isinstance(value, (list, tuple)):
+        keys = [get_value_key(x) for x in value]
+        return None if None in keys else json.dumps(keys)
+    if isinstance(value, dict):
+        keys = {str(k): get_value_key(v) for k, v in value.items()}
+        return None if None in keys.values() else json.dumps(keys, sort_keys=True)
+    if isinstance(value, BaseGeometry):
+        return 'geometry:{}'.format(hashlib.sha256(value.wkb).hexdigest())
+    if isinstance(value, netCDF4.Dataset):
+        version = get_file_version(value.filepath())
+        return None if version is None else 'dataset:{}'.format(version)
+    if isinstance(value, LazyRaster) and not value.is_temporary:
+        version = get_file_version(value.path)
+        if version is not None:
+            return 'lazy_raster:{}:{}:{}'.format(version, value.variable, value.time_index)
+
+    return None
+
+
+def store_value(path, name, value, copy_files=True, allow_pickle=False):
+    """
+    Writes a value to files in a directory, and returns a description of it which can be serialized as JSON, or None if
+    the value can't be stored. Lazy rasters which aren't temporary are referred to in place if `copy_files` is False,
+    and values which can't be stored otherwise are pickled if `allow_pickle` is True.
+    """
+
+    if isinstance(value, LazyRaster):
+        value.close()
+        copy = copy_files or value.is_temporary
+
+        if copy:
+            shutil.copyfile(value.path, os.path.join(path, name + '.nc'))
+
+        return {
+            'type': 'lazy_raster', 'file': name + '.nc' if copy else value.path, 'variable': value.variable,
+            'x_dimension': value.x_dimension, 'y_dimension': value.y_dimension, 'extent': value.extent.as_list(),
+            'projection': value.extent.projection.srs, 'y_increasing': value.y_increasing,
+            'time_dimension': value.time_dimension, 'time_index': value.time_index,
+            'dtype': None if value._dtype is None else value._dtype.str, 'service': None if copy else value.service
+        }
+
+    if isinstance(value, numpy.ndarray) and value.dtype.kind in 'biuf':
+        info = {'type': 'array', 'file': name + '.npy'}
+        numpy.save(os.path.join(path, info['file']), numpy.ma.getdata(value))
+
+        if isinstance(value, numpy.ma.MaskedArray):
+            info['mask'] = name + '.mask.npy'
+            info['fill_value'] = value.fill_value.item()
+            numpy.save(os.path.join(path, info['mask']), numpy.ma.getmaskarray(value))
+
+        if isinstance(value, Raster) and value.extent is not None:
+            info.update({
+                'type': 'raster', 'extent': value.extent.as_list(), 'projection': value.extent.projection.srs,
+                'x_dim': value.x_dim, 'y_dim': value.y_dim, 'y_increasing': value.y_increasing
+            })
+
+        return info
+
+    if isinstance(value, (list, tuple)) and any(isinstance(x, (numpy.ndarray, LazyRaster)) for x in value):
+        items = [
+            store_value(path, '{}.{}'.format(name, i), x, copy_files, allow_pickle) for i, x in enumerate(value)
+        ]
+        return None if None in items else {'type': 'list', 'items': items}
+
+    try:
+        return {'type': 'json', 'value': json.loads(json.dumps(value))}
+    except (TypeError, ValueError):
+        pass
+
+    if allow_pickle:
+        with open(os.path.join(path, name + '.pickle'), 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        return {'type': 'pickle', 'file': name + '.pickle'}
+
+    return None
+
+
+def link_file(path, directory):
+    """
+    Creates a new link to a file in a directory (or a copy, if the file can't be linked to), and returns its path. The
+    file can still be read from the link after it has been removed from its original path.
+    """
+
+    fd, link_path = tempfile.mkstemp(prefix='.', suffix=os.path.splitext(path)[1], dir=directory)
+    os.close(fd)
+    os.remove(link_path)
+
+    try:
+        os.link(path, link_path)
+    except OSError:
+        shutil.copyfile(path, link_path)
+
+    return link_path
+
+
+def load_value(path, info, link_dir=None):
+    """
+    Reads a value written by `store_value`. If `link_dir` is given, lazy rasters are read from links to their files in
+    that directory (see `link_file`), which are removed once the rasters are no longer used. Other files are read
+    when they're loaded (or memory-mapped, which keeps them readable), so no values depend on `path` afterwards.
+    """
+
+    if info['type'] == 'json':
+        return info['value']
+
+    if info['type'] == 'list':
+        return [load_value(path, x, link_dir) for x in info['items']]
+
+    if info['type'] == 'pickle':
+        with open(os.path.join(path, info['file']), 'rb') as f:
+            return pickle.load(f)
+
+    if info['type'] == 'lazy_raster':
+        extent = BBox(info['extent'], projection=Proj(info['projection']))
+        file_path = os.path.join(path, info['file'])
+        if link_dir is not None:
+            file_path = link_file(file_path, link_dir)
+
+        return LazyRaster(
+            file_path, info['variable'], info['x_dimension'], info['y_dimension'], extent, info['y_increasing'],
+            info['time_dimension'], info['time_index'], info['dtype'], temporary=link_dir is not None,
+            service=info.get('service')
+        )
+
+    # Copy on write, so tasks can modify their inputs without changing the cache
+    value = numpy.load(os.path.join(path, info['file']), mmap_mode='c')
+    if 'mask' in info:
+        mask = numpy.load(os.path.join(path, info['mask']), mmap_mode='c')
+        value = numpy.ma.masked_array(value, mask=mask, fill_value=info['fill_value'])
+
+    if info['type'] == 'raster':
+        extent = BBox(info['extent'], projection=Proj(info['projection']))
+        value = Raster(value, extent, info['x_dim'], info['y_dim'], info['y_increasing'])
+
+    return value
+
+
+class NodeCache(object):
+    """A cache of task outputs in a directory. Each entry is a subdirectory with an `outputs.json` file."""
+
+    def __init__(self, path, max_size=WORKFLOW_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+
+    def get_key(self, task, inputs):
+        """Returns the cache key for a task and its inputs, or None if the outputs can't be cached"""
+
+        if not task.name or not task.cacheable:
+            return None
+
+        keys = {}
+        for name, value in inputs.items():
+            keys[name] = get_value_key(value)
+            if keys[name] is None:
+                return None
+
+        return hashlib.sha256(json.dumps([task.name, keys], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """Returns the cached outputs for a key, or None"""
+
+        path = os.path.join(self.path, key)
+
+        try:
+            with open(os.path.join(path, 'outputs.json'), 'r') as f:
+                info = json.load(f)
+
+            os.utime(path)  # Mark the entry as recently used
+
+            # Other jobs may evict the entry while the outputs are in use. NetCDF files are opened lazily, so lazy
+            # rasters get their own links to them.
+            outputs = {k: load_value(path, v, link_dir=self.path) for k, v in info.items()}
+        except (OSError, ValueError):
+            return None
+
+        for name, value in outputs.items():
+            self.set_source(value, key, name)
+
+        return outputs
+
+    def set(self, key, outputs):
+        """Stores the outputs of a task, if they can be stored"""
+
+        os.makedirs(self.path, exist_ok=True)
+        path = tempfile.mkdtemp(prefix='.', dir=self.path)
+
+        try:
+            info = {}
+            for name, value in outputs.items():
+                info[name] = store_value(path, name, value)
+                if info[name] is None:
+                    return
+
+            with open(os.path.join(path, 'outputs.json'), 'w') as f:
+                json.dump(info, f)
+
+            try:
+                os.rename(path, os.path.join(self.path, key))
+            except OSError:
+                return  # Another job stored these outputs first
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+        for name, value in outputs.items():
+            self.set_source(value, key, name)
+
+        self.evict()
+
+    def set_source(self, value, key, name):
+        """Identifies an output by its cache entry, so it doesn't need to be hashed as an input to other tasks"""
+
+        if isinstance(value, (numpy.ndarray, LazyRaster)):
+            set_source(value, 'node:{}:{}'.format(key, name))
+
+    def evict(self):
+        """Removes the least recently used entries until the cache is no larger than `max_size`"""
+
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+
+            try:
+                size = sum(x.stat().st_size for x in os.scandir(entry.path))
+                entries.append((entry.stat().st_mtime, size, entry.path))
+            except OSError:
+                continue  # Removed by another job
+
+        total = sum(x[1] for x in entries)
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+
+            logger.debug('Removing cached outputs {}'.format(os.path.basename(path)))
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def get_node_cache():
+    """Returns the cache of workflow node outputs, or None if it isn't enabled"""
+
+    return None if WORKFLOW_CACHE_DIR is None else NodeCache(WORKFLOW_CACHE_DIR)
@@ -2,6 +2,8 @@ import copy
 import json
 import logging
 import os
+import shutil
+from contextlib import nullcontext
 from datetime import timedelta
 from importlib import import_module
 
@@ -15,16 +17,20 @@ from django.utils.timezone import now
 from trefoil.render.renderers import RasterRenderer
 
 from ncdjango.models import ProcessingJob, ProcessingResultService, SERVICE_DATA_ROOT
+from .distributed import (
+    WORKFLOW_DISTRIBUTED, get_run_path, get_shared_dir, get_workflow_signature, load_expression_profiles,
+    load_job_profile, load_outputs, load_run, start_run
+)
+from .profiling import EXPRESSION_PROFILE, profile_expressions, profile_job
 from .utils import get_task_instance, process_web_inputs, process_web_outputs, REGISTERED_JOBS
+from .workflow import Workflow
 
 logger = logging.getLogger(__name__)
 
 MAX_TEMPORARY_SERVICE_AGE = getattr(settings, 'NC_MAX_TEMPORARY_SERVICE_AGE', 43200)  # 12 hours
 
 
-@shared_task(bind=True)
-def run_job(self, job_name, inputs):
-    job_info = REGISTERED_JOBS[job_name]
+def get_results_renderer(job_info):
     results_renderer = job_info.get('results_renderer')
 
     if isinstance(results_renderer, str):
@@ -38,15 +44,87 @@ def run_job(self, job_name, inputs):
     if not any((results_renderer is None, callable(results_renderer), isinstance(results_renderer, RasterRenderer))):
         raise ImproperlyConfigured('Invalid renderer: {}'.format(results_renderer))
 
-    t = get_task_instance(job_name)
-    results = t(**process_web_inputs(t, copy.copy(inputs)))
+    return results_renderer
+
+
+def save_job_outputs(job_name, celery_id, results, profile, expression_profiles=None):
+    job_info = REGISTERED_JOBS[job_name]
     publish_raster_results = job_info.get('publish_raster_results', False)
 
-    job = ProcessingJob.objects.get(celery_id=self.request.id)
-    job.outputs = json.dumps(process_web_outputs(results, job, publish_raster_results, results_renderer))
+    job = ProcessingJob.objects.get(celery_id=celery_id)
+    outputs = process_web_outputs(results, job, publish_raster_results, get_results_renderer(job_info))
+
+    if expression_profiles is not None:
+        outputs['expression_profiles'] = expression_profiles
+
+    job.outputs = json.dumps(outputs)
+    job.profile = json.dumps(profile)
     job.save()
 
 
+def save_job_profile(celery_id, profile):
+    """Saves the execution profile of a job which failed"""
+
+    ProcessingJob.objects.filter(celery_id=celery_id).update(profile=json.dumps(profile))
+
+
+@shared_task(bind=True)
+def run_job(self, job_name, inputs):
+    job_info = REGISTERED_JOBS[job_name]
+    get_results_renderer(job_info)  # Check the renderer before starting the job
+
+    t = get_task_instance(job_name)
+    profile = job_info.get('profile_expressions', EXPRESSION_PROFILE)
+
+    if isinstance(t, Workflow) and job_info.get('distributed', WORKFLOW_DISTRIBUTED):
+        # Run the workflow nodes as separate Celery tasks, which replace this one
+        path = get_run_path(self.request.id)
+
+        try:
+            with profile_job() as job_profile:
+                inputs = process_web_inputs(t, copy.copy(inputs))
+
+            start_run(t, inputs, path, profile, job_profile.to_dict())
+        except:
+            save_job_profile(self.request.id, job_profile.to_dict())
+            raise
+
+        callback = finish_distributed_job.si(job_name, self.request.id, path)
+        return self.replace(get_workflow_signature(t, path, callback))
+
+    try:
+        with profile_job() as job_profile, profile_expressions() if profile else nullcontext() as profiler:
+            results = t(**process_web_inputs(t, copy.copy(inputs)))
+
+        if profiler is not None:
+            profiler.log()
+
+        save_job_outputs(
+            job_name, self.request.id, results, job_profile.to_dict(), None if profiler is None else profiler.to_list()
+        )
+    except:
+        save_job_profile(self.request.id, job_profile.to_dict())
+        raise
+
+
+@shared_task
+def finish_distributed_job(job_name, celery_id, path):
+    try:
+        workflow, run = load_run(path)
+        expression_profiles = load_expression_profiles(path) if run['profile'] else None
+        save_job_outputs(
+            job_name, celery_id, load_outputs(workflow, path), load_job_profile(path), expression_profiles
+        )
+    except:
+        try:
+            save_job_profile(celery_id, load_job_profile(path))
+        except (OSError, ValueError):
+            logger.exception('Could not load the profile of run {}'.format(path))
+        raise
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 @shared_task
 def cleanup_temporary_services():
     cutoff = now() - timedelta(seconds=MAX_TEMPORARY_SERVICE_AGE)
@@ -67,3 +145,9 @@ def cleanup_temporary_services():
         except OSError as e:
             if e.errno != errno.ENOTEMPTY:
                 logger.warn('Error deleting temporary service data: {}'.format(str(e)))
+
+    # Remove the run directories of distributed workflows which didn't finish
+    if os.path.isdir(get_shared_dir()):
+        for entry in os.scandir(get_shared_dir()):
+            if entry.is_dir() and entry.stat().st_mtime < cutoff.timestamp():
+                shutil.rmtree(entry.path, ignore_errors=True)
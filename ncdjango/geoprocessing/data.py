@@ -1,8 +1,16 @@
+import mmap
+import os
+import tempfile
+import weakref
+
+import netCDF4
 import numpy
 from numpy.ma import masked
 from numpy.ma.core import MaskedConstant
 from trefoil.geometry.bbox import BBox
 
+from .profiling import record_read
+
 
 class Raster(numpy.ma.MaskedArray):
     def __new__(cls, arr, extent, x_dim, y_dim, y_increasing=False):
@@ -33,6 +41,16 @@ class Raster(numpy.ma.MaskedArray):
 
         super(Raster, self).__array_finalize__(obj)
 
+    def __reduce__(self):
+        """Pickles the raster with its extent, e.g., to pass it to another process"""
+
+        arr = numpy.ma.masked_array(self.data, mask=self._mask, fill_value=self._fill_value)
+
+        if self.extent is None or self.ndim < 2:
+            return arr.__reduce__()
+
+        return Raster, (arr, self.extent, self.x_dim, self.y_dim, self.y_increasing)
+
     def __getitem__(self, items):
         arr = super(Raster, self).__getitem__(items)
         if not isinstance(arr, numpy.ndarray) or isinstance(arr, MaskedConstant):
@@ -273,7 +291,316 @@ class Raster(numpy.ma.MaskedArray):
         return obj
 
 
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class LazyRaster(object):
+    """
+    A raster backed by a 2- or more-dimensional variable in a NetCDF file, which is read in bands of rows rather than
+    held in memory. Slicing rows (e.g., `raster[100:200]`) reads those rows as a `Raster`. As with rasters created from
+    services, the first axis is y and the second is x.
+
+    If `temporary` is True, the file is deleted once the object is no longer used (see `detach`). `service` is the name
+    of the service the file belongs to, if any, which reads are recorded for (see `record_read`).
+    """
+
+    x_dim = 1
+    y_dim = 0
+    ndim = 2
+
+    def __init__(self, path, variable, x_dimension, y_dimension, extent, y_increasing=False, time_dimension=None,
+                 time_index=None, dtype=None, temporary=False, service=None):
+        self.path = path
+        self.variable = variable
+        self.x_dimension = x_dimension
+        self.y_dimension = y_dimension
+        self.extent = extent
+        self.y_increasing = y_increasing
+        self.time_dimension = time_dimension
+        self.time_index = time_index
+        self._dtype = None if dtype is None else numpy.dtype(dtype)
+        self._dataset = None
+        self._finalizer = weakref.finalize(self, remove_file, path) if temporary else None
+        self._transferred = False
+        self.service = service
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_dataset'] = None
+        state['_finalizer'] = None
+        return state
+
+    def __setstate__(self, state):
+        transferred = state.pop('_transferred', False)
+        self.__dict__.update(state)
+        self._finalizer = weakref.finalize(self, remove_file, self.path) if transferred else None
+        self._transferred = False
+
+    @property
+    def is_temporary(self):
+        return self._finalizer is not None and self._finalizer.alive
+
+    def detach(self):
+        """Keeps a temporary file from being deleted (e.g., after it has been moved)"""
+
+        if self._finalizer is not None:
+            self._finalizer.detach()
+
+    def transfer(self):
+        """
+        Hands a temporary file over to the copy unpickled from this raster (e.g., in another process), so the file is
+        deleted once that copy is no longer used, rather than this raster.
+        """
+
+        if self.is_temporary:
+            self.detach()
+            self._transferred = True
+
+    @property
+    def data(self):
+        if self._dataset is None:
+            self._dataset = netCDF4.Dataset(self.path, 'r')
+        return self._dataset.variables[self.variable]
+
+    def close(self):
+        if self._dataset is not None:
+            self._dataset.close()
+            self._dataset = None
+
+    @property
+    def shape(self):
+        dimensions = list(self.data.dimensions)
+        return self.data.shape[dimensions.index(self.y_dimension)], self.data.shape[dimensions.index(self.x_dimension)]
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    @property
+    def dtype(self):
+        return self._dtype or self.data.dtype
+
+    @property
+    def chunk_rows(self):
+        """The number of rows in each chunk of the file, or 1 if the variable isn't chunked"""
+
+        chunking = self.data.chunking()
+        if chunking == 'contiguous' or chunking is None:
+            return 1
+        return chunking[list(self.data.dimensions).index(self.y_dimension)]
+
+    def read(self, start=0, stop=None):
+        """Reads a band of rows as a `Raster`"""
+
+        height, width = self.shape
+        start, stop, _ = slice(start, stop).indices(height)
+        stop = max(start, stop)
+        dimensions = list(self.data.dimensions)
+        slices = []
+
+        for dimension in self.data.dimensions:
+            if dimension == self.y_dimension:
+                slices.append(slice(start, stop))
+            elif dimension == self.x_dimension:
+                slices.append(slice(None))
+            else:
+                use_time_index = dimension == self.time_dimension and self.time_index is not None
+                slices.append(self.time_index if use_time_index else 0)
+                dimensions.remove(dimension)
+
+        data = self.data[tuple(slices)]
+        if self.service is not None:
+            record_read(self.service, data.nbytes)
+
+        data = data.transpose(dimensions.index(self.y_dimension), dimensions.index(self.x_dimension))
+        if self._dtype is not None:
+            data = data.astype(self._dtype)
+
+        cell_height = self.extent.height / height
+        if self.y_increasing:
+            ymin, ymax = self.extent.ymin + start * cell_height, self.extent.ymin + stop * cell_height
+        else:
+            ymin, ymax = self.extent.ymax - stop * cell_height, self.extent.ymax - start * cell_height
+
+        extent = BBox((self.extent.xmin, ymin, self.extent.xmax, ymax), projection=self.extent.projection)
+        return Raster(data, extent, 1, 0, self.y_increasing)
+
+    def materialize(self):
+        """Reads the full raster into memory"""
+
+        return self.read()
+
+    def __getitem__(self, items):
+        if not isinstance(items, tuple):
+            items = (items,)
+
+        rows = items[0]
+        if not isinstance(rows, slice) or rows.step not in (None, 1):
+            return self.materialize()[items]
+
+        data = self.read(rows.start, rows.stop)
+        return data[(slice(None),) + items[1:]] if len(items) > 1 else data
+
+    def __array__(self, dtype=None, copy=None):
+        return numpy.asarray(self.materialize(), dtype=dtype)
+
+    def __repr__(self):
+        return '<LazyRaster {}:{} {}x{}>'.format(self.path, self.variable, *reversed(self.shape))
+
+
 def is_raster(arr):
     """Determine whether the array is a `Raster`"""
 
-    return isinstance(arr, Raster) or hasattr(arr, 'extent')
+    return isinstance(arr, (Raster, LazyRaster)) or hasattr(arr, 'extent')
+
+
+def is_lazy_raster(arr):
+    """Determine whether the array is a `LazyRaster`"""
+
+    return isinstance(arr, LazyRaster)
+
+
+def is_memory_mapped(value):
+    """Is an array (or the data of a masked array) backed by a memory-mapped file?"""
+
+    base = numpy.ma.getdata(value)
+    while base is not None:
+        if isinstance(base, (numpy.memmap, mmap.mmap)):
+            return True
+        base = getattr(base, 'base', None)
+
+    return False
+
+
+def get_resident_size(value):
+    """Returns the memory held by an array and its mask in bytes, or 0 if it isn't an array or is memory-mapped"""
+
+    if not isinstance(value, numpy.ndarray) or is_memory_mapped(value):
+        return 0
+
+    mask = numpy.ma.getmask(value)
+    return value.nbytes + (0 if mask is numpy.ma.nomask else mask.nbytes)
+
+
+def get_output_size(value):
+    """
+    Returns the size of an array in bytes, including its mask, or the file size of a lazy raster. Lists are the total
+    of their items. Returns None for other values.
+    """
+
+    if isinstance(value, LazyRaster):
+        try:
+            return os.path.getsize(value.path)
+        except OSError:
+            return None
+
+    if isinstance(value, numpy.ndarray):
+        mask = numpy.ma.getmask(value)
+        return value.nbytes + (0 if mask is numpy.ma.nomask else mask.nbytes)
+
+    if isinstance(value, (list, tuple)):
+        sizes = [get_output_size(x) for x in value]
+        return None if all(x is None for x in sizes) else sum(x or 0 for x in sizes)
+
+    return None
+
+
+def map_array(arr, output_dir=None):
+    """
+    Writes an array to a temporary file, and returns it memory-mapped from the file. The file is removed right away,
+    and its space freed once the array is no longer used (on systems which allow open files to be removed).
+    """
+
+    fd, path = tempfile.mkstemp(suffix='.npy', dir=output_dir)
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, arr)
+        return numpy.load(path, mmap_mode='c')  # Copy on write, in case the array is modified
+    finally:
+        remove_file(path)
+
+
+def spill_array(value, output_dir=None):
+    """
+    Returns an array (or masked array, or `Raster`) memory-mapped from a temporary file, so that it's read from disk as
+    it's used rather than held in memory. Anything else, and arrays which are already memory-mapped, are returned as-is.
+    """
+
+    if not isinstance(value, numpy.ndarray) or value.dtype.hasobject or is_memory_mapped(value):
+        return value
+
+    data = map_array(numpy.ma.getdata(value), output_dir)
+
+    if isinstance(value, numpy.ma.MaskedArray):
+        mask = numpy.ma.getmask(value)
+        if mask is not numpy.ma.nomask:
+            mask = map_array(mask, output_dir)
+        data = numpy.ma.masked_array(data, mask=mask, fill_value=value.fill_value)
+
+    if isinstance(value, Raster) and value.extent is not None:
+        data = Raster(data, value.extent, value.x_dim, value.y_dim, value.y_increasing)
+
+    return data
+
+
+def get_data(value, fill_nan=False):
+    """
+    Returns the data of a masked array as a regular array, or otherwise `value` itself. If `fill_nan` is True, masked
+    cells of floating point arrays are set to NaN (in a copy of the data), so that NaN-aware reductions ignore them.
+    """
+
+    if not isinstance(value, numpy.ma.MaskedArray):
+        return value
+
+    data = numpy.ma.getdata(value)
+    mask = numpy.ma.getmask(value)
+
+    if fill_nan and data.dtype.kind == 'f' and mask is not numpy.ma.nomask:
+        return numpy.where(mask, numpy.nan, data)
+
+    return data
+
+
+def combine_masks(values, shape):
+    """Returns the union of the masks of all arrays in `values` with the given shape, or `nomask` if none are masked"""
+
+    mask = numpy.ma.nomask
+
+    for value in values:
+        value_mask = numpy.ma.getmask(value)
+
+        if value_mask is numpy.ma.nomask or value_mask.shape != shape:
+            continue
+
+        if mask is numpy.ma.nomask:
+            mask = value_mask.copy()
+        else:
+            mask |= value_mask
+
+    return mask
+
+
+def apply_mask(result, values):
+    """
+    Masks an array computed from the unmasked data of `values` (see `get_data`) with the combined mask of `values`.
+    If any of `values` is a `Raster` with the same shape as the result, the result is returned as a `Raster` with the
+    same extent.
+    """
+
+    if not isinstance(result, numpy.ndarray) or isinstance(result, MaskedConstant):
+        return result
+
+    mask = combine_masks(values, result.shape)
+    if mask is not numpy.ma.nomask:
+        result = numpy.ma.masked_array(result, mask=mask)
+
+    template = next((x for x in values if isinstance(x, Raster) and x.shape == result.shape), None)
+    if template is not None:
+        result = Raster(result, template.extent, template.x_dim, template.y_dim, template.y_increasing)
+
+    return result
@@ -0,0 +1,264 @@
+"""
+Distributed execution of workflows on Celery workers. A workflow is compiled into a chain of Celery tasks, with a
+chord for each group of nodes which can run at the same time (i.e., whose dependencies are all in earlier groups).
+Workflow inputs and node outputs are exchanged through files in a run directory on storage shared by all of the
+workers, rather than through the Celery result backend. Nodes which fail with infrastructure errors (e.g., shared storage
+or the broker being unavailable) are retried up to `NC_WORKFLOW_NODE_RETRIES` times; other errors would only happen
+again, so they fail the run straight away.
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import Iterator
+from contextlib import nullcontext
+from functools import lru_cache
+
+from celery import chain, chord, group, shared_task
+from django.conf import settings
+from kombu.exceptions import OperationalError
+
+from .cache import get_node_cache, load_value, store_value
+from .params import ParameterCollection
+from .profiling import profile_expressions
+from .workflow import Workflow, execute_task, get_cached_outputs, get_cached_profile
+
+logger = logging.getLogger(__name__)
+
+WORKFLOW_DISTRIBUTED = getattr(settings, 'NC_WORKFLOW_DISTRIBUTED', False)
+WORKFLOW_SHARED_DIR = getattr(settings, 'NC_WORKFLOW_SHARED_DIR', None)
+WORKFLOW_NODE_RETRIES = getattr(settings, 'NC_WORKFLOW_NODE_RETRIES', 3)
+WORKFLOW_NODE_RETRY_DELAY = getattr(settings, 'NC_WORKFLOW_NODE_RETRY_DELAY', 10)  # Seconds
+
+# Errors which may not happen again if a node is retried (e.g., shared storage or the broker being unavailable)
+RETRYABLE_ERRORS = (OSError, OperationalError)
+
+
+def get_shared_dir():
+    """Returns the directory for the run directories of distributed workflows"""
+
+    return WORKFLOW_SHARED_DIR or os.path.join(settings.MEDIA_ROOT, 'workflow_runs')
+
+
+def get_run_path(run_id):
+    return os.path.join(get_shared_dir(), str(run_id))
+
+
+def write_values(path, values):
+    """
+    Writes a dictionary of values (workflow inputs or node outputs) to a directory with `store_value`. The directory
+    is written under a temporary name and then renamed, so it's only ever seen complete.
+    """
+
+    parent = os.path.dirname(path)
+    temp_path = tempfile.mkdtemp(prefix='.', dir=parent)
+
+    try:
+        info = {}
+        for name, value in values.items():
+            if isinstance(value, Iterator):
+                # Write items as they're produced, rather than materializing the list in memory
+                items = [
+                    store_value(temp_path, '{}.{}'.format(name, i), x, copy_files=False, allow_pickle=True)
+                    for i, x in enumerate(value)
+                ]
+                info[name] = {'type': 'list', 'items': items}
+            else:
+                info[name] = store_value(temp_path, name, value, copy_files=False, allow_pickle=True)
+
+        with open(os.path.join(temp_path, 'values.json'), 'w') as f:
+            json.dump(info, f)
+
+        shutil.rmtree(path, ignore_errors=True)  # Left by an earlier attempt
+        os.rename(temp_path, path)
+    finally:
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+def read_values(path):
+    """Reads a dictionary of values written by `write_values`"""
+
+    with open(os.path.join(path, 'values.json'), 'r') as f:
+        return {k: load_value(path, v) for k, v in json.load(f).items()}
+
+
+def get_node_path(path, workflow, node_id):
+    return os.path.join(path, 'node-{}'.format(workflow.get_execution_order().index(node_id)))
+
+
+def start_run(workflow, inputs, path, profile=False, job_profile=None):
+    """
+    Creates the run directory for a workflow, with the workflow definition and its (validated) inputs. If `profile` is
+    True, nodes profile the expressions they evaluate. `job_profile` is the profile of the job so far (e.g., loading
+    the inputs), as a dictionary.
+    """
+
+    os.makedirs(path)
+
+    with open(os.path.join(path, 'run.json'), 'w') as f:
+        json.dump({
+            'workflow': workflow.to_json(), 'profile': profile, 'job_profile': job_profile, 'started': time.time()
+        }, f)
+
+    write_values(os.path.join(path, 'inputs'), inputs)
+
+
+@lru_cache(maxsize=16)
+def _load_run(path):
+    with open(os.path.join(path, 'run.json'), 'r') as f:
+        run = json.load(f)
+
+    return Workflow.from_json(run.pop('workflow')), run
+
+
+def load_run(path):
+    """
+    Returns a tuple of (workflow, run options) for a run directory. Workers load each run once, for all of its nodes
+    they run.
+    """
+
+    workflow, run = _load_run(path)
+    return workflow.clone(), run
+
+
+def get_workflow_signature(workflow, path, callback=None):
+    """
+    Returns a Celery signature which runs the nodes of a workflow started with `start_run`, followed by `callback` (a
+    signature which is called with no arguments), if given.
+    """
+
+    levels = {}
+    for node_id in workflow.get_execution_order():
+        dependencies = workflow.nodes_by_id[node_id].dependencies
+        levels[node_id] = max((levels[x] + 1 for x in dependencies), default=0)
+
+    steps = []
+    for level in range(max(levels.values(), default=-1) + 1):
+        nodes = [run_workflow_node.si(path, x) for x in levels if levels[x] == level]
+        # The chord waits for all of the nodes in the group before the next step
+        steps.append(nodes[0] if len(nodes) == 1 else chord(group(nodes), finish_workflow_level.si()))
+
+    if callback is not None:
+        steps.append(callback)
+
+    return chain(steps)
+
+
+def load_outputs(workflow, path):
+    """Returns the outputs of a workflow run from its run directory, as a `ParameterCollection`"""
+
+    outputs = ParameterCollection(workflow.outputs)
+
+    for param, (node_id, name) in workflow.output_mapping.items():
+        outputs[param] = read_values(get_node_path(path, workflow, node_id))[name]
+
+    return outputs
+
+
+def load_expression_profiles(path):
+    """Returns the expression profiles recorded by the nodes of a workflow run"""
+
+    profiles = []
+
+    for entry in sorted(os.scandir(path), key=lambda x: x.name):
+        if entry.name.startswith('node-') and os.path.exists(os.path.join(entry.path, 'expression_profiles.json')):
+            with open(os.path.join(entry.path, 'expression_profiles.json'), 'r') as f:
+                profiles.extend(json.load(f))
+
+    return profiles
+
+
+def load_job_profile(path):
+    """
+    Returns the execution profile of a workflow run (see `JobProfile.to_dict`), from the profiles recorded by each node.
+    The CPU time is the total of the nodes, and the peak RSS is the highest of any worker. Nodes which haven't finished
+    (e.g., if the run failed) are left out.
+    """
+
+    workflow, run = load_run(path)
+    profile = run['job_profile'] or {'cpu_time': 0, 'peak_rss': None, 'bytes_read': {}}
+    bytes_read = dict(profile['bytes_read'])
+    nodes = []
+
+    for node_id in workflow.get_execution_order():
+        try:
+            with open(os.path.join(get_node_path(path, workflow, node_id), 'profile.json'), 'r') as f:
+                nodes.append(dict(json.load(f), node=node_id))
+        except FileNotFoundError:
+            continue
+
+        for service, size in nodes[-1]['bytes_read'].items():
+            bytes_read[service] = bytes_read.get(service, 0) + size
+
+    peak_rss = [x['peak_rss'] for x in [profile] + nodes if x['peak_rss'] is not None]
+
+    return {
+        'time': time.time() - run['started'],
+        'cpu_time': profile['cpu_time'] + sum(x['cpu_time'] or 0 for x in nodes),
+        'peak_rss': max(peak_rss, default=None),
+        'bytes_read': bytes_read,
+        'nodes': nodes
+    }
+
+
+@shared_task(
+    bind=True, max_retries=WORKFLOW_NODE_RETRIES, default_retry_delay=WORKFLOW_NODE_RETRY_DELAY,
+    acks_late=True  # Run the node again if its worker is lost. Outputs are written atomically, so this is safe.
+)
+def run_workflow_node(self, path, node_id):
+    workflow, run = load_run(path)
+    node = workflow.nodes_by_id[node_id]
+    inputs = None
+    task_inputs = {}
+
+    for name, (source, value) in node.inputs.items():
+        if source == 'input':
+            if inputs is None:
+                inputs = read_values(os.path.join(path, 'inputs'))
+            if value in inputs:
+                task_inputs[name] = inputs[value]
+        elif source == 'dependency':
+            outputs = read_values(get_node_path(path, workflow, value[0]))
+            if value[1] in outputs:
+                task_inputs[name] = outputs[value[1]]
+        elif source == 'literal':
+            task_inputs[name] = value
+        else:
+            raise ValueError('Invalid input source: {0}'.format(source))
+
+    cache = get_node_cache()
+    key, outputs = get_cached_outputs(cache, node, task_inputs)
+    profiler = None
+
+    try:
+        if outputs is None:
+            with profile_expressions() if run['profile'] else nullcontext() as profiler:
+                outputs, profile = execute_task(node.task, task_inputs)
+
+            if key is not None:
+                cache.set(key, outputs)
+        else:
+            profile = get_cached_profile(node.task, outputs)
+
+        node_path = get_node_path(path, workflow, node_id)
+        write_values(node_path, outputs)
+    except RETRYABLE_ERRORS as e:
+        logger.warning('Node {0} failed, retrying ({1} of {2}): {3}'.format(
+            node_id, self.request.retries + 1, self.max_retries, e
+        ))
+        raise self.retry(exc=e)
+
+    with open(os.path.join(node_path, 'profile.json'), 'w') as f:
+        json.dump(profile, f)
+
+    if profiler is not None:
+        with open(os.path.join(node_path, 'expression_profiles.json'), 'w') as f:
+            json.dump(profiler.to_list(), f)
+
+
+@shared_task
+def finish_workflow_level():
+    """Does nothing. Used to wait for a group of nodes to finish."""
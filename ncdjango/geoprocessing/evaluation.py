@@ -1,14 +1,29 @@
+import copy
 import logging
 import math
 import operator
+import threading
 import time
+from collections import defaultdict
+from functools import lru_cache
 
 import numpy
+from django.conf import settings
 from ply import lex, yacc
 from rasterio.dtypes import is_ndarray
 
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
 logger = logging.getLogger(__name__)
 
+EXPRESSION_BACKEND = getattr(settings, 'NC_EXPRESSION_BACKEND', 'closure')
+EXPRESSION_CACHE_SIZE = getattr(settings, 'NC_EXPRESSION_CACHE_SIZE', 256)
+EXPRESSION_NUMEXPR = getattr(settings, 'NC_EXPRESSION_NUMEXPR', True)
+EXPRESSION_OPTIMIZE = getattr(settings, 'NC_EXPRESSION_OPTIMIZE', True)
+
 
 class Lexer(object):
     reserved = {
@@ -90,7 +105,7 @@ class Lexer(object):
         raise SyntaxError("Illegal character {0} at position {1}".format(t.value[0], t.lexpos))
 
     def __init__(self):
-        self.lexer = lex.lex(module=self)
+        self.lexer = get_template(type(self), lambda: lex.lex(module=self)).clone(self)
 
     def get_names(self, expr):
         self.lexer.input(expr)
@@ -109,6 +124,79 @@ def op_or(x, y):
     return x or y
 
 
+def resolve_id(key, context):
+    try:
+        value = context[key]
+        if hasattr(value, '__call__'):
+            return value()
+        return value
+    except KeyError:
+        raise NameError("name '{}' is not defined".format(key))
+
+
+def resolve_item(obj, index):
+    if is_ndarray(obj) or isinstance(obj, (list, tuple)):
+        if not isinstance(index, int):
+            raise TypeError("Not a valid array index: '{}'".format(index))
+
+    elif isinstance(obj, dict):
+        if not isinstance(index, (str, int)):
+            raise TypeError("Not a valid dictionary index: '{}'".format(index))
+
+    else:
+        raise TypeError("Object does not support indexing: '{}'".format(type(obj)))
+
+    return obj[index]
+
+
+# Parser tables, generated from the grammar by `scripts/build_parser_tables.py`
+PARSER_TABLES = 'ncdjango.geoprocessing.parsetab'
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(cls, build):
+    """
+    Returns the PLY lexer or parser template for a class, building it the first time. Lexers and parsers are
+    expensive to build, so this only happens once per process, and instances are given clones of the templates.
+    """
+
+    try:
+        return _templates[cls]
+    except KeyError:
+        pass
+
+    with _templates_lock:
+        if cls not in _templates:
+            _templates[cls] = build()
+
+        return _templates[cls]
+
+
+def build_parser(module, write_tables=False):
+    """
+    Builds a PLY parser for the grammar rules of `module`. The parser tables are read from `PARSER_TABLES` if they
+    match the grammar, and otherwise generated (and, if `write_tables` is True, written to `PARSER_TABLES`).
+    """
+
+    return yacc.yacc(module=module, tabmodule=PARSER_TABLES, debug=False, write_tables=write_tables)
+
+
+def clone_parser(template, module):
+    """Returns a copy of a PLY parser which shares its tables, with its grammar rules bound to `module`"""
+
+    parser = copy.copy(template)
+    parser.productions = [copy.copy(x) for x in template.productions]
+    parser.errorfunc = module.p_error
+
+    for production in parser.productions:
+        if production.func:
+            production.callable = getattr(module, production.func)
+
+    return parser
+
+
 class Parser(object):
     tokens = Lexer.tokens
 
@@ -147,7 +235,7 @@ class Parser(object):
                     | term MOD factor
         """
 
-        p[0] = Instruction("op(left, right)", context={'op': self.binary_operators[p[2]], 'left': p[1], 'right': p[3]})
+        p[0] = BinaryOperation(self.binary_operators[p[2]], p[1], p[3])
 
     def p_conditional_condition(self, p):
         """
@@ -184,7 +272,7 @@ class Parser(object):
         """
 
         if p[1] == '-':
-            p[0] = Instruction('-x', context={'x': p[2]})
+            p[0] = Negation(p[2])
         else:
             p[0] = p[2]
 
@@ -236,20 +324,7 @@ class Parser(object):
         factor : ID
         """
 
-        def resolve_id(key, context):
-            try:
-                value = context[key]
-                if hasattr(value, '__call__'):
-                    return value()
-                return value
-            except KeyError:
-                raise NameError("name '{}' is not defined".format(key))
-
-        p[0] = Instruction('resolve_id(key, context)', context={
-            'resolve_id': resolve_id,
-            'key': p[1],
-            'context': self.context
-        })
+        p[0] = Name(p[1])
 
     def p_factor_fn(self, p):
         """
@@ -263,12 +338,7 @@ class Parser(object):
         fn : FUNC LPAREN arguments RPAREN
         """
 
-        fn = getattr(self, 'fn_{0}'.format(p[1]))
-        p[0] = Instruction('fn(*[x.execute() if isinstance(x, Instruction) else x for x in args])', context={
-            'fn': fn,
-            'args': p[3],
-            'Instruction': Instruction
-        })
+        p[0] = Call(getattr(self, 'fn_{0}'.format(p[1])), p[3])
 
     def p_arguments(self, p):
         """
@@ -289,25 +359,7 @@ class Parser(object):
         factor : factor LBRACK conditional RBRACK
         """
 
-        def resolve_item(obj, index):
-            if is_ndarray(obj) or isinstance(obj, (list, tuple)):
-                if not isinstance(index, int):
-                    raise TypeError("Not a valid array index: '{}'".format(index))
-
-            elif isinstance(obj, dict):
-                if not isinstance(index, (str, int)):
-                    raise TypeError("Not a valid dictionary index: '{}'".format(index))
-
-            else:
-                raise TypeError("Object does not support indexing: '{}'".format(type(obj)))
-
-            return obj[index]
-
-        p[0] = Instruction('resolve_item(obj, index)', context={
-            'resolve_item': resolve_item,
-            'obj': p[1],
-            'index': p[3]
-        })
+        p[0] = Item(p[1], p[3])
 
     def _to_ndarray(self, a):
         """Casts Python lists and tuples to a numpy array or raises an AssertionError."""
@@ -569,39 +621,649 @@ class Parser(object):
             raise SyntaxError("Invalid syntax at end of statement")
 
     def __init__(self):
-        self.context = {}
-        self.parser = yacc.yacc(module=self)
+        self.parser = clone_parser(get_template(type(self), lambda: build_parser(self)), self)
         self.lexer = Lexer().lexer
 
+    def compile(self, expr, backend=EXPRESSION_BACKEND):
+        """
+        Parses an expression into an `Expression`, which can be evaluated any number of times. See `Expression` for
+        backends.
+        """
+
+        tree = self.parser.parse(expr, lexer=self.lexer)
+
+        # Names are kept in the order they first appear (e.g., `x` and then `y` in `x - y`)
+        self.lexer.input(expr)
+        names = tuple(dict.fromkeys(t.value for t in self.lexer if t.type == 'ID'))
+
+        return Expression(expr, tree, names, backend=backend)
+
     def evaluate(self, expr, context={}):
         start = time.time()
         try:
-            self.context = context
-            del context
-
-            result = self.parser.parse(expr, lexer=self.lexer)
-            del self.context
-
-            return result.execute() if isinstance(result, Instruction) else result
+            return self.compile(expr).evaluate(context)
         finally:
             logger.info('Executed expression in {:.3f} seconds: {}'.format(time.time() - start, expr))
-            self.context = {}
-            self.parser.parse('1', lexer=self.lexer)  # Clear out references to potentially large objects
+
+
+class Expression(object):
+    """
+    A parsed expression. Expressions don't hold any evaluation state, so a single expression can be evaluated any number
+    of times, from any number of threads, with different contexts.
+
+    With the `closure` backend (the default), the parse tree is converted once into nested Python closures, so
+    evaluating the expression is a chain of plain function calls. The `inplace` backend is the same, except that
+    arithmetic on intermediate arrays reuses their memory where possible rather than allocating new arrays, and (if
+    numexpr is installed and `NC_EXPRESSION_NUMEXPR` is True) arithmetic subtrees are evaluated by numexpr. With the
+    `eval` backend, each instruction in the tree is run with `eval()`, with a new locals dictionary for every node.
+
+    For the `closure` and `inplace` backends, the tree is first optimized (see `optimize`), unless
+    `NC_EXPRESSION_OPTIMIZE` is False. Subexpressions which appear more than once are evaluated once per evaluation.
+    """
+
+    BACKENDS = ('closure', 'inplace', 'eval')
+
+    def __init__(self, expr, tree, names, backend=EXPRESSION_BACKEND):
+        if backend not in self.BACKENDS:
+            raise ValueError("Invalid expression backend: '{}'".format(backend))
+
+        if backend in ('closure', 'inplace') and EXPRESSION_OPTIMIZE:
+            tree = optimize(tree)
+
+        self.expr = expr
+        self.tree = tree
+        self.names = names
+        self.backend = backend
+        self.reduced_names = frozenset(get_reduced_names(tree))
+
+        if backend in ('closure', 'inplace'):
+            self.function = self.build_function()
+        elif isinstance(tree, Instruction):
+            self.function = tree.execute
+        else:
+            self.function = lambda context: tree
+
+    def build_function(self, profile=None):
+        """
+        Returns a function of the evaluation context for the `closure` or `inplace` backend. If `profile` is given,
+        the function records the time and memory used by each node (see `ExpressionProfile`).
+        """
+
+        function = to_closure(self.tree, self.backend == 'inplace', profile)
+
+        if any(x.shared for x in iter_nodes(self.tree)):
+            # Shared results are stored in the context (see `shared_closure`), so each evaluation needs its own
+            return lambda context: function(dict(context))
+
+        return function
+
+    def evaluate(self, context={}):
+        return self.function(context)
 
 
 class Instruction(object):
-    """A compiled statement to be executed by `exec()`"""
+    """A compiled statement to be executed by `eval()`, given the evaluation context"""
+
+    # Is the result used by more than one node? (see `optimize`)
+    shared = False
 
     def __init__(self, statement, context={}):
         self.statement = statement
         self.compiled = compile(statement, '<string>', 'eval')
         self.locals = context
 
-    def execute(self):
-        context = {k: v.execute() if isinstance(v, Instruction) else v for k, v in self.locals.items()}
+    def execute(self, context={}):
+        local_context = {k: v.execute(context) if isinstance(v, Instruction) else v for k, v in self.locals.items()}
+        local_context['context'] = context
 
         try:
-            return eval(self.compiled, None, context)
+            return eval(self.compiled, None, local_context)
         finally:
-            del context
-            del self.locals
+            del local_context
+
+    def to_closure(self, inplace=False, profile=None):
+        """
+        Returns a function of the evaluation context which has the same result as `execute`. If `inplace` is True,
+        the function may reuse the memory of intermediate arrays (see `Expression`). If `profile` is given, the
+        function records the time and memory used by each node (see `ExpressionProfile`).
+        """
+
+        return self.execute
+
+
+class BinaryOperation(Instruction):
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+        super(BinaryOperation, self).__init__('op(left, right)', context={'op': op, 'left': left, 'right': right})
+
+    def to_closure(self, inplace=False, profile=None):
+        op = self.op
+
+        if inplace and numexpr is not None and EXPRESSION_NUMEXPR and (count_numexpr_operations(self) or 0) > 1:
+            return numexpr_closure(self, self.to_closure(inplace=False, profile=profile), profile)
+
+        left = to_closure(self.left, inplace, profile)
+        right = to_closure(self.right, inplace, profile)
+
+        if inplace and op in UFUNCS and (is_temporary(self.left) or is_temporary(self.right)):
+            ufunc = UFUNCS[op]
+            masked_op = MASKED_INPLACE_OPERATORS.get(op)
+            left_temporary, right_temporary = is_temporary(self.left), is_temporary(self.right)
+            # Values the left result could share a mask with: names, and shared results stored in the context
+            left_sources = [
+                x.key if isinstance(x, Name) else x for x in iter_nodes(self.left) if isinstance(x, Name) or x.shared
+            ]
+
+            def run(context):
+                a, b = left(context), right(context)
+
+                # Intermediate results are only used here, so one can hold the result if it fits
+                if left_temporary and can_hold_result(ufunc, a, b, a):
+                    if type(a) is numpy.ndarray:
+                        return ufunc(a, b, out=a)
+                    if masked_op is not None:
+                        if a._mask is not numpy.ma.nomask and may_share_mask(a, left_sources, context):
+                            # Some masked operations (e.g., negation) return the mask of an operand
+                            a._mask = a._mask.copy()
+                        return masked_op(a, b)
+                if right_temporary and type(b) is numpy.ndarray and can_hold_result(ufunc, a, b, b):
+                    return ufunc(a, b, out=b)
+
+                return op(a, b)
+
+            return run
+
+        # Avoid calls to fetch constant operands
+        if not isinstance(self.right, Instruction):
+            value = self.right
+            return lambda context: op(left(context), value)
+        if not isinstance(self.left, Instruction):
+            value = self.left
+            return lambda context: op(value, right(context))
+
+        return lambda context: op(left(context), right(context))
+
+
+class Negation(Instruction):
+    def __init__(self, operand):
+        self.operand = operand
+
+        super(Negation, self).__init__('-x', context={'x': operand})
+
+    def to_closure(self, inplace=False, profile=None):
+        if inplace and numexpr is not None and EXPRESSION_NUMEXPR and (count_numexpr_operations(self) or 0) > 1:
+            return numexpr_closure(self, self.to_closure(inplace=False, profile=profile), profile)
+
+        operand = to_closure(self.operand, inplace, profile)
+
+        if inplace and is_temporary(self.operand):
+            def run(context):
+                value = operand(context)
+
+                if type(value) is numpy.ndarray and can_hold_result(numpy.negative, value, None, value):
+                    return numpy.negative(value, out=value)
+
+                return -value
+
+            return run
+
+        return lambda context: -operand(context)
+
+
+class Name(Instruction):
+    def __init__(self, key):
+        self.key = key
+
+        super(Name, self).__init__('resolve_id(key, context)', context={'resolve_id': resolve_id, 'key': key})
+
+    def to_closure(self, inplace=False, profile=None):
+        key = self.key
+
+        def resolve(context):
+            try:
+                value = context[key]
+            except KeyError:
+                raise NameError("name '{}' is not defined".format(key))
+
+            return value() if hasattr(value, '__call__') else value
+
+        return resolve
+
+
+class Call(Instruction):
+    def __init__(self, fn, args):
+        self.fn = fn
+        self.args = args
+
+        super(Call, self).__init__('fn(*execute_all(args, context))', context={
+            'fn': fn,
+            'args': args,
+            'execute_all': execute_all
+        })
+
+    def to_closure(self, inplace=False, profile=None):
+        fn = self.fn
+        args = [to_closure(x, inplace, profile) for x in self.args]
+
+        if len(args) == 1:
+            arg = args[0]
+            return lambda context: fn(arg(context))
+
+        return lambda context: fn(*[x(context) for x in args])
+
+
+class Item(Instruction):
+    def __init__(self, obj, index):
+        self.obj = obj
+        self.index = index
+
+        super(Item, self).__init__('resolve_item(obj, index)', context={
+            'resolve_item': resolve_item,
+            'obj': obj,
+            'index': index
+        })
+
+    def to_closure(self, inplace=False, profile=None):
+        obj = to_closure(self.obj, inplace, profile)
+        index = to_closure(self.index, inplace, profile)
+        return lambda context: resolve_item(obj(context), index(context))
+
+
+def to_closure(node, inplace=False, profile=None):
+    """Returns a function of the evaluation context for an instruction or a constant (see `Instruction.to_closure`)"""
+
+    if isinstance(node, Instruction):
+        function = node.to_closure(inplace, profile)
+
+        # Name lookups are too cheap to be worth profiling
+        if profile is not None and not isinstance(node, Name):
+            function = profile.wrap(node, function)
+
+        return shared_closure(node, function) if node.shared else function
+
+    return lambda context: node
+
+
+def shared_closure(node, function):
+    """
+    Returns a function which evaluates a shared node once per evaluation. The result is stored in the evaluation
+    context, keyed by the node itself, so it can't clash with names.
+    """
+
+    def run(context):
+        try:
+            return context[node]
+        except KeyError:
+            value = context[node] = function(context)
+            return value
+
+    return run
+
+
+def get_children(node):
+    """Returns the child nodes of a parse tree node"""
+
+    if isinstance(node, BinaryOperation):
+        return [node.left, node.right]
+    if isinstance(node, Negation):
+        return [node.operand]
+    if isinstance(node, Call):
+        return list(node.args)
+    if isinstance(node, Item):
+        return [node.obj, node.index]
+    return []
+
+
+# Functions which reduce an array to a single value (or along an axis), ignoring NaNs
+REDUCTIONS = {'fn_min', 'fn_max', 'fn_median', 'fn_mean', 'fn_std', 'fn_var'}
+
+
+def get_reduced_names(node):
+    """Returns the names which are reduced (e.g., `x` in `mean(x)`) in a parse tree"""
+
+    if isinstance(node, Call) and getattr(node.fn, '__name__', '') in REDUCTIONS:
+        return get_names(node.args[0])
+
+    return set().union(*(get_reduced_names(x) for x in get_children(node)))
+
+
+def get_names(node):
+    """Returns the names referred to in a parse tree"""
+
+    if isinstance(node, Name):
+        return {node.key}
+
+    return set().union(*(get_names(x) for x in get_children(node)))
+
+
+def to_expression(node):
+    """Returns an expression string for a parse tree (which may differ in form from the original expression)"""
+
+    if isinstance(node, Name):
+        return node.key
+    if isinstance(node, BinaryOperation):
+        symbol = OPERATOR_SYMBOLS.get(node.op, '?')
+        operands = [
+            '({})'.format(to_expression(x)) if isinstance(x, BinaryOperation) else to_expression(x)
+            for x in (node.left, node.right)
+        ]
+        return '{} {} {}'.format(operands[0], symbol, operands[1])
+    if isinstance(node, Negation):
+        operand = to_expression(node.operand)
+        return '-({})'.format(operand) if isinstance(node.operand, BinaryOperation) else '-' + operand
+    if isinstance(node, Call):
+        name = getattr(node.fn, '__name__', '')
+        name = name[3:] if name.startswith('fn_') else name
+        return '{}({})'.format(name, ', '.join(to_expression(x) for x in node.args))
+    if isinstance(node, Item):
+        return '{}[{}]'.format(to_expression(node.obj), to_expression(node.index))
+
+    return repr(node)
+
+
+# Parser.binary_operators, with the last symbol listed for each operator
+OPERATOR_SYMBOLS = {v: k for k, v in Parser.binary_operators.items()}
+
+
+def iter_nodes(node):
+    """Yields each instruction in a parse tree once, even if it is shared"""
+
+    seen = set()
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+
+        if isinstance(node, Instruction) and id(node) not in seen:
+            seen.add(id(node))
+            yield node
+            stack.extend(get_children(node))
+
+
+# Constants are only folded if they evaluate to one of these types, so arrays are never shared between evaluations
+FOLDABLE_TYPES = (bool, int, float, str, numpy.generic)
+
+
+def fold_constant(node):
+    """
+    Returns the value of an instruction with only constant operands, or the instruction itself if it can't be
+    evaluated ahead of time. Errors (including numpy floating point warnings) are left to be raised at evaluation.
+    """
+
+    try:
+        with numpy.errstate(all='raise'):
+            value = to_closure(node)({})
+    except Exception:
+        return node
+
+    return value if isinstance(value, FOLDABLE_TYPES) else node
+
+
+def optimize(tree):
+    """
+    Returns an optimized copy of a parse tree. Subtrees with only constant operands (e.g., `2 * 1.5`) are replaced
+    with their values, and identical subtrees (e.g., both instances of `x - mean(x)` in
+    `(x - mean(x)) / std(x) + (x - mean(x))`) are replaced with a single node, which is marked as `shared` if it's used
+    more than once. All expression functions are pure, so calls are deduplicated too.
+    """
+
+    nodes = {}
+
+    def get_key(node):
+        if isinstance(node, Instruction):
+            return id(node)
+        return type(node), repr(node)
+
+    def visit(node):
+        if not isinstance(node, Instruction):
+            return node
+        if isinstance(node, Name):
+            return nodes.setdefault(('name', node.key), node)
+
+        children = [visit(x) for x in get_children(node)]
+        key = (type(node), getattr(node, 'op', None), getattr(node, 'fn', None)) + tuple(get_key(x) for x in children)
+
+        if key not in nodes:
+            copy = copy_node(node, children)
+            nodes[key] = copy if any(isinstance(x, Instruction) for x in children) else fold_constant(copy)
+
+        return nodes[key]
+
+    tree = visit(tree)
+
+    references = defaultdict(int)
+    for node in iter_nodes(tree):
+        for child in get_children(node):
+            references[id(child)] += 1
+
+    for node in iter_nodes(tree):
+        node.shared = not isinstance(node, Name) and references[id(node)] > 1
+
+    return tree
+
+
+def copy_node(node, children):
+    """Returns a copy of a parse tree node with new child nodes (in the order returned by `get_children`)"""
+
+    if isinstance(node, BinaryOperation):
+        return BinaryOperation(node.op, *children)
+    if isinstance(node, Negation):
+        return Negation(*children)
+    if isinstance(node, Call):
+        return Call(node.fn, children)
+    if isinstance(node, Item):
+        return Item(*children)
+
+    raise TypeError("Unknown instruction type: '{}'".format(type(node)))
+
+
+# Operators with equivalent numpy ufuncs, which can write their results to an existing array
+UFUNCS = {
+    operator.add: numpy.add,
+    operator.sub: numpy.subtract,
+    operator.mul: numpy.multiply,
+    operator.truediv: numpy.true_divide,
+    operator.pow: numpy.power,
+    operator.mod: numpy.remainder
+}
+
+# Masked arrays update their masks in augmented assignment, but don't support `out=`. Masked power and modulo are
+# left out, since their in-place versions mask invalid results differently.
+MASKED_INPLACE_OPERATORS = {
+    operator.add: operator.iadd,
+    operator.sub: operator.isub,
+    operator.mul: operator.imul,
+    operator.truediv: operator.itruediv
+}
+
+# Power and modulo are left to numpy, since numexpr's results differ (e.g., modulo by zero or infinity is NaN)
+NUMEXPR_OPERATORS = {
+    operator.add: '+',
+    operator.sub: '-',
+    operator.mul: '*',
+    operator.truediv: '/'
+}
+
+NUMEXPR_COMPARISONS = {
+    operator.eq: '==',
+    operator.le: '<=',
+    operator.ge: '>=',
+    operator.lt: '<',
+    operator.gt: '>'
+}
+
+NUMEXPR_DTYPES = {numpy.dtype('float32'), numpy.dtype('float64')}
+
+# Below this many elements, numexpr's overhead outweighs its savings
+NUMEXPR_MIN_SIZE = 2 ** 16
+
+
+def is_temporary(node):
+    """
+    Is the result of this node a new array, used only by its parent? Such arrays can be overwritten by the parent.
+    """
+
+    if getattr(node, 'shared', False):
+        return False
+
+    return isinstance(node, Negation) or (isinstance(node, BinaryOperation) and node.op in UFUNCS)
+
+
+def may_share_mask(value, keys, context):
+    """Might the mask of a masked array share memory with the mask of any of the given values in the context?"""
+
+    for key in keys:
+        try:
+            other = context[key]
+        except KeyError:
+            continue
+
+        if hasattr(other, '__call__'):
+            return True  # Not resolved yet, so assume it does
+        if numpy.may_share_memory(value._mask, numpy.ma.getmask(other)):
+            return True
+
+    return False
+
+
+def can_hold_result(ufunc, a, b, out):
+    """
+    Can `out` hold the result of `ufunc(a, b)` (or `ufunc(a)`, if `b` is None) without casting, broadcasting, or
+    changing the array type?
+    """
+
+    array_types = {numpy.ndarray: (numpy.ndarray,), numpy.ma.MaskedArray: (numpy.ndarray, numpy.ma.MaskedArray)}
+
+    if type(out) not in array_types or not out.flags.writeable:
+        return False
+
+    operands = (a,) if b is None else (a, b)
+    # Masked operations convert Python numbers to arrays, so they're promoted like arrays, not like Python numbers
+    # (e.g., a float32 masked array divided by 2.25 is float64)
+    is_masked = any(isinstance(x, numpy.ma.MaskedArray) for x in operands)
+    dtypes = []
+
+    for value in operands:
+        if type(value) in array_types[type(out)] or isinstance(value, numpy.generic):
+            dtypes.append(value.dtype)
+        elif type(value) in (bool, int, float):
+            dtypes.append(numpy.asarray(value).dtype if is_masked else type(value))
+        else:
+            return False
+
+    try:
+        result_dtype = ufunc.resolve_dtypes(tuple(dtypes) + (None,))[-1]
+        shape = numpy.broadcast_shapes(*(numpy.shape(x) for x in operands))
+    except (TypeError, ValueError):
+        return False
+
+    return result_dtype == out.dtype and shape == out.shape
+
+
+def count_numexpr_operations(node, is_root=True):
+    """
+    Returns the number of operations in a subtree which can be evaluated by numexpr, or None if any part of the
+    subtree can't be. Names, numbers, and shared nodes (which are evaluated separately) are the only supported leaves,
+    and comparisons are only supported at the root (numexpr and numpy treat booleans differently in arithmetic).
+    """
+
+    if isinstance(node, Name) or type(node) in (int, float) or (getattr(node, 'shared', False) and not is_root):
+        return 0
+    if isinstance(node, Negation):
+        operands = [node.operand]
+    elif isinstance(node, BinaryOperation) and (
+        node.op in NUMEXPR_OPERATORS or (is_root and node.op in NUMEXPR_COMPARISONS)
+    ):
+        operands = [node.left, node.right]
+    else:
+        return None
+
+    counts = [count_numexpr_operations(x, is_root=False) for x in operands]
+    return None if None in counts else sum(counts) + 1
+
+
+def to_numexpr(node, is_root=True):
+    """
+    Returns a numexpr expression string for a subtree (see `count_numexpr_operations`), a dictionary of its variables
+    (the names and shared nodes it refers to), and its constants
+    """
+
+    if isinstance(node, Name):
+        return node.key, {node.key: node}, set()
+    if isinstance(node, Instruction) and node.shared and not is_root:
+        name = '__shared_{}'.format(id(node))
+        return name, {name: node}, set()
+    if isinstance(node, Negation):
+        operand, variables, constants = to_numexpr(node.operand, is_root=False)
+        return '(-{})'.format(operand), variables, constants
+    if isinstance(node, BinaryOperation):
+        left, left_variables, left_constants = to_numexpr(node.left, is_root=False)
+        right, right_variables, right_constants = to_numexpr(node.right, is_root=False)
+        symbol = NUMEXPR_OPERATORS.get(node.op) or NUMEXPR_COMPARISONS[node.op]
+        expr = '({} {} {})'.format(left, symbol, right)
+        return expr, dict(left_variables, **right_variables), left_constants | right_constants
+
+    return repr(node), {}, {node}
+
+
+def numexpr_closure(node, fallback, profile=None):
+    """
+    Returns a function which evaluates a subtree with numexpr. Numexpr's type promotion rules differ from numpy's, so
+    it's only used when the result type is certain to be the same: all arrays must have the same float type, and
+    float32 arrays can't be combined with float values (which numexpr treats as float64). Otherwise, `fallback` is
+    used instead.
+    """
+
+    expr, variables, constants = to_numexpr(node)
+    resolvers = {name: to_closure(x, True, profile) for name, x in variables.items()}
+    has_float_constant = any(type(x) is float for x in constants)
+
+    def run(context):
+        values = {name: resolve(context) for name, resolve in resolvers.items()}
+        arrays = [value for value in values.values() if type(value) is numpy.ndarray]
+        dtypes = {value.dtype for value in arrays}
+
+        # Numexpr always returns arrays, so scalar-only expressions are left to Python
+        if len(dtypes) != 1 or not dtypes <= NUMEXPR_DTYPES or max(x.size for x in arrays) < NUMEXPR_MIN_SIZE:
+            return fallback(context)
+
+        dtype = dtypes.pop()
+        scalar_types = {type(value) for value in values.values() if type(value) is not numpy.ndarray}
+
+        if not scalar_types <= ({int} if dtype == numpy.float32 else {int, float}):
+            return fallback(context)
+        if dtype == numpy.float32 and has_float_constant:
+            return fallback(context)
+
+        return numexpr.evaluate(expr, local_dict=values)
+
+    return run
+
+
+def execute_all(args, context):
+    """Executes a list of function arguments, which may be instructions or constants"""
+
+    return [x.execute(context) if isinstance(x, Instruction) else x for x in args]
+
+
+_parser = None
+_parser_lock = threading.Lock()
+
+
+@lru_cache(maxsize=EXPRESSION_CACHE_SIZE)
+def compile_expression(expr):
+    """
+    Returns an `Expression` for an expression string. Results are cached, so each distinct expression is only parsed
+    once. Parsing is serialized, since PLY parsers are not thread-safe.
+    """
+
+    global _parser
+
+    with _parser_lock:
+        if _parser is None:
+            _parser = Parser()
+
+        return _parser.compile(expr)
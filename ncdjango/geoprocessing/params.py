@@ -1,8 +1,11 @@
 import numbers
 from types import GeneratorType
 
+import os
+
 import netCDF4
 import numpy
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
 from fiona.collection import Collection
 from shapely.geometry.base import BaseGeometry
@@ -10,7 +13,11 @@ from shapely.geometry.base import BaseGeometry
 from ncdjango.models import Service
 from ncdjango.utils import best_fit, timestamp_to_date
 from ncdjango.views import NetCdfDatasetMixin
-from .data import Raster
+from .cache import set_source
+from .data import LazyRaster, Raster
+from .profiling import record_read
+
+LAZY_RASTER_SIZE = getattr(settings, 'NC_LAZY_RASTER_SIZE', 2 ** 26)
 
 
 class ParameterNotValidError(ValueError):
@@ -168,14 +175,17 @@ class ListParameter(Parameter):
 
     id = 'list'
 
-    def __init__(self, param_type, *args, **kwargs):
+    def __init__(self, param_type, *args, streaming=False, **kwargs):
         """
         :param param_type: A `Parameter` instance.
+        :param streaming: If True, the task iterates over the value once, in order, so workflows may pass it a generator
+            rather than a list.
         """
 
         super(ListParameter, self).__init__(*args, **kwargs)
 
         self.param_type = param_type
+        self.streaming = streaming
 
     def clean(self, value):
         """Cleans and returns the given value, or raises a ParameterNotValidError exception"""
@@ -297,14 +307,14 @@ class DictParameter(Parameter):
 
 
 class NdArrayParameter(Parameter):
-    """Accepts a numpy array or Python list"""
+    """Accepts a numpy array, `LazyRaster`, or Python list"""
 
     id = 'array'
 
     def clean(self, value):
         """Cleans and returns the given value, or raises a ParameterNotValidError exception"""
 
-        if isinstance(value, numpy.ndarray):
+        if isinstance(value, (numpy.ndarray, LazyRaster)):
             return value
         elif isinstance(value, (list, tuple)):
             return numpy.array(value)
@@ -313,14 +323,14 @@ class NdArrayParameter(Parameter):
 
 
 class RasterParameter(Parameter):
-    """Accepts a `Raster` instance"""
+    """Accepts a `Raster` or `LazyRaster` instance"""
 
     id = 'raster'
 
     def clean(self, value):
         """Cleans and returns the given value, or raises a ParameterNotValidError exception"""
 
-        if isinstance(value, Raster):
+        if isinstance(value, (Raster, LazyRaster)):
             return value
 
         raise ParameterNotValidError
@@ -436,8 +446,28 @@ class RegisteredDatasetParameter(NetCdfDatasetMixin, Parameter):
                 else:
                     time_index = None
 
+                width, height = self.get_grid_spatial_dimensions(variable)
+
+                # Large grids are read in blocks as they're used, rather than all at once
+                if LAZY_RASTER_SIZE is not None and width * height > LAZY_RASTER_SIZE:
+                    return LazyRaster(
+                        os.path.join(settings.MEDIA_ROOT, self.service.data_path), variable.variable,
+                        variable.x_dimension, variable.y_dimension, variable.full_extent,
+                        self.is_y_increasing(variable), variable.time_dimension, time_index, service=self.service.name
+                    )
+
                 data = self.get_grid_for_variable(variable, time_index=time_index)
-                return Raster(data, variable.full_extent, 1, 0, self.is_y_increasing(variable))
+                record_read(self.service.name, data.nbytes)
+                raster = Raster(data, variable.full_extent, 1, 0, self.is_y_increasing(variable))
+
+                # Identify the raster by its source, so that cached outputs of tasks using it can be found cheaply
+                data_version = self.service.data_version
+                if data_version is not None:
+                    set_source(raster, 'service:{}:{}:{}:{}'.format(
+                        self.service.name, variable.variable, time_index, data_version
+                    ))
+
+                return raster
             else:
                 return self.dataset
         else:
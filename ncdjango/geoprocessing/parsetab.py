@@ -0,0 +1,62 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = 'ADD AND COMMA DIV EQ FALSE FLOAT FUNC GT GTE ID INT LBRACK LPAREN LT LTE MOD MUL OR POW RBRACK RPAREN STR SUB TRUE\n        conditional : conditional AND condition\n                    | conditional OR condition\n        condition   : condition LTE expression\n                    | condition GTE expression\n                    | condition LT expression\n                    | condition GT expression\n                    | condition EQ expression\n        expression  : expression ADD term\n                    | expression SUB term\n        term        : term MUL factor\n                    | term DIV factor\n                    | term POW factor\n                    | term MOD factor\n        \n        conditional : condition\n        \n        condition : expression\n        \n        expression : term\n        \n        term : factor\n        \n        term : SUB factor\n             | ADD factor\n        \n        factor : number\n        \n        factor : STR\n        \n        factor : TRUE\n               | FALSE\n        \n        factor : LPAREN conditional RPAREN\n        \n        number : INT\n        \n        number : FLOAT\n        \n        factor : ID\n        \n        factor : fn\n        \n        fn : FUNC LPAREN arguments RPAREN\n        \n        arguments : conditional COMMA arguments\n        \n        arguments : conditional\n        \n        factor : factor LBRACK conditional RBRACK\n        '
+    
+_lr_action_items = {'SUB':([0,3,5,7,8,9,10,11,12,13,14,15,16,18,19,20,21,22,23,24,25,26,27,32,33,35,38,39,40,41,42,43,44,45,46,47,48,50,53,54,55,],[6,26,-16,-17,-20,-21,-22,-23,6,-27,-28,-25,-26,6,6,6,6,6,6,6,6,6,-19,-18,6,6,26,26,26,26,26,-8,-9,-10,-11,-12,-13,-24,-32,-29,6,]),'ADD':([0,3,5,7,8,9,10,11,12,13,14,15,16,18,19,20,21,22,23,24,25,26,27,32,33,35,38,39,40,41,42,43,44,45,46,47,48,50,53,54,55,],[4,25,-16,-17,-20,-21,-22,-23,4,-27,-28,-25,-26,4,4,4,4,4,4,4,4,4,-19,-18,4,4,25,25,25,25,25,-8,-9,-10,-11,-12,-13,-24,-32,-29,4,]),'STR':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,9,]),'TRUE':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,10,]),'FALSE':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,11,]),'LPAREN':([0,4,6,12,17,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[12,12,12,12,35,12,12,12,12,12,12,12,12,12,12,12,12,12,12,12,12,]),'ID':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,13,]),'INT':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,15,]),'FLOAT':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,16,]),'FUNC':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,17,]),'$end':([1,2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[0,-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'AND':([1,2,3,5,7,8,9,10,11,13,14,15,16,27,32,34,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,52,53,54,],[18,-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,18,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,18,-24,18,-32,-29,]),'OR':([1,2,3,5,7,8,9,10,11,13,14,15,16,27,32,34,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,52,53,54,],[19,-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,19,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,19,-24,19,-32,-29,]),'RPAREN':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,34,36,37,38,39,40,41,42,43,44,45,46,47,48,50,51,52,53,54,56,],[-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,50,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,54,-31,-32,-29,-30,]),'RBRACK':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,49,50,53,54,],[-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,53,-24,-32,-29,]),'COMMA':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,52,53,54,],[-14,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,-1,-2,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,55,-32,-29,]),'LTE':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[20,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,20,20,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'GTE':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[21,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,21,21,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'LT':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[22,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,22,22,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'GT':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[23,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,23,23,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'EQ':([2,3,5,7,8,9,10,11,13,14,15,16,27,32,36,37,38,39,40,41,42,43,44,45,46,47,48,50,53,54,],[24,-15,-16,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,24,24,-3,-4,-5,-6,-7,-8,-9,-10,-11,-12,-13,-24,-32,-29,]),'MUL':([5,7,8,9,10,11,13,14,15,16,27,32,43,44,45,46,47,48,50,53,54,],[28,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,28,28,-10,-11,-12,-13,-24,-32,-29,]),'DIV':([5,7,8,9,10,11,13,14,15,16,27,32,43,44,45,46,47,48,50,53,54,],[29,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,29,29,-10,-11,-12,-13,-24,-32,-29,]),'POW':([5,7,8,9,10,11,13,14,15,16,27,32,43,44,45,46,47,48,50,53,54,],[30,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,30,30,-10,-11,-12,-13,-24,-32,-29,]),'MOD':([5,7,8,9,10,11,13,14,15,16,27,32,43,44,45,46,47,48,50,53,54,],[31,-17,-20,-21,-22,-23,-27,-28,-25,-26,-19,-18,31,31,-10,-11,-12,-13,-24,-32,-29,]),'LBRACK':([7,8,9,10,11,13,14,15,16,27,32,45,46,47,48,50,53,54,],[33,-20,-21,-22,-23,-27,-28,-25,-26,33,33,33,33,33,33,-24,-32,-29,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'conditional':([0,12,33,35,55,],[1,34,49,52,52,]),'condition':([0,12,18,19,33,35,55,],[2,2,36,37,2,2,2,]),'expression':([0,12,18,19,20,21,22,23,24,33,35,55,],[3,3,3,3,38,39,40,41,42,3,3,3,]),'term':([0,12,18,19,20,21,22,23,24,25,26,33,35,55,],[5,5,5,5,5,5,5,5,5,43,44,5,5,5,]),'factor':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[7,27,32,7,7,7,7,7,7,7,7,7,7,45,46,47,48,7,7,7,]),'number':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,8,]),'fn':([0,4,6,12,18,19,20,21,22,23,24,25,26,28,29,30,31,33,35,55,],[14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,14,]),'arguments':([35,55,],[51,56,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> conditional","S'",1,None,None,None),
+  ('conditional -> conditional AND condition','conditional',3,'p_binary_operators','evaluation.py',223),
+  ('conditional -> conditional OR condition','conditional',3,'p_binary_operators','evaluation.py',224),
+  ('condition -> condition LTE expression','condition',3,'p_binary_operators','evaluation.py',225),
+  ('condition -> condition GTE expression','condition',3,'p_binary_operators','evaluation.py',226),
+  ('condition -> condition LT expression','condition',3,'p_binary_operators','evaluation.py',227),
+  ('condition -> condition GT expression','condition',3,'p_binary_operators','evaluation.py',228),
+  ('condition -> condition EQ expression','condition',3,'p_binary_operators','evaluation.py',229),
+  ('expression -> expression ADD term','expression',3,'p_binary_operators','evaluation.py',230),
+  ('expression -> expression SUB term','expression',3,'p_binary_operators','evaluation.py',231),
+  ('term -> term MUL factor','term',3,'p_binary_operators','evaluation.py',232),
+  ('term -> term DIV factor','term',3,'p_binary_operators','evaluation.py',233),
+  ('term -> term POW factor','term',3,'p_binary_operators','evaluation.py',234),
+  ('term -> term MOD factor','term',3,'p_binary_operators','evaluation.py',235),
+  ('conditional -> condition','conditional',1,'p_conditional_condition','evaluation.py',242),
+  ('condition -> expression','condition',1,'p_condition_expression','evaluation.py',249),
+  ('expression -> term','expression',1,'p_expression_term','evaluation.py',256),
+  ('term -> factor','term',1,'p_term_factor','evaluation.py',263),
+  ('term -> SUB factor','term',2,'p_factor_unary_operators','evaluation.py',270),
+  ('term -> ADD factor','term',2,'p_factor_unary_operators','evaluation.py',271),
+  ('factor -> number','factor',1,'p_factor_number','evaluation.py',281),
+  ('factor -> STR','factor',1,'p_factor_string','evaluation.py',288),
+  ('factor -> TRUE','factor',1,'p_factor_bool','evaluation.py',295),
+  ('factor -> FALSE','factor',1,'p_factor_bool','evaluation.py',296),
+  ('factor -> LPAREN conditional RPAREN','factor',3,'p_factor_conditional','evaluation.py',303),
+  ('number -> INT','number',1,'p_number_int','evaluation.py',310),
+  ('number -> FLOAT','number',1,'p_number_float','evaluation.py',317),
+  ('factor -> ID','factor',1,'p_factor_id','evaluation.py',324),
+  ('factor -> fn','factor',1,'p_factor_fn','evaluation.py',331),
+  ('fn -> FUNC LPAREN arguments RPAREN','fn',4,'p_fn','evaluation.py',338),
+  ('arguments -> conditional COMMA arguments','arguments',3,'p_arguments','evaluation.py',345),
+  ('arguments -> conditional','arguments',1,'p_arguments_conditional','evaluation.py',352),
+  ('factor -> factor LBRACK conditional RBRACK','factor',4,'p_factor_item','evaluation.py',359),
+]
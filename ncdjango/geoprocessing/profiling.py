@@ -0,0 +1,379 @@
+"""
+Profiling of jobs and expressions. Within `profile_job()`, workflow nodes record the wall and CPU time they take, the
+peak RSS of the process, the size of their outputs, and the bytes they read from each service. Within the opt-in
+`profile_expressions()`, expressions evaluated with `evaluate` record the time taken by each node of the expression,
+the type and shape of its result, and the memory it allocated.
+"""
+
+import contextvars
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy
+from django.conf import settings
+
+from .evaluation import get_children, to_expression
+
+logger = logging.getLogger(__name__)
+
+EXPRESSION_PROFILE = getattr(settings, 'NC_EXPRESSION_PROFILE', False)
+
+# The number of nodes to log after profiling
+PROFILE_LOG_COUNT = 5
+
+_profiler = contextvars.ContextVar('expression_profiler', default=None)
+_job_profile = contextvars.ContextVar('job_profile', default=None)
+_task_profile = contextvars.ContextVar('task_profile', default=None)
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def get_peak_rss():
+    """Returns the peak resident set size of this process in bytes, or None if it isn't available"""
+
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # Kilobytes, except on macOS
+
+
+class TaskProfile(object):
+    """
+    Profile of a single task call (e.g., a workflow node). `cpu_time` is the CPU time of the thread which called the
+    task, and `peak_rss` is the peak RSS of the process when the task finished, so it's only higher than the job's peak
+    before the task if the task raised it. `output_sizes` are set by the caller (see `get_output_size`).
+    """
+
+    def __init__(self, task, cached=False):
+        self.task = task.name or type(task).__name__
+        self.cached = cached
+        self.time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.output_sizes = {}
+        self.bytes_read = {}
+        self.lock = threading.Lock()
+
+    def add_read(self, service, size):
+        with self.lock:
+            self.bytes_read[service] = self.bytes_read.get(service, 0) + size
+
+    def to_dict(self):
+        return {
+            'task': self.task,
+            'cached': self.cached,
+            'time': self.time,
+            'cpu_time': self.cpu_time,
+            'peak_rss': self.peak_rss,
+            'output_sizes': self.output_sizes,
+            'bytes_read': self.bytes_read
+        }
+
+
+class JobProfile(object):
+    """
+    Execution profile of a job: its wall and CPU time and peak RSS, the profiles of its workflow nodes (see
+    `TaskProfile`), and the bytes read from each service. Times are in seconds and sizes in bytes.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = time.process_time()
+        self.nodes = []
+        self.bytes_read = {}  # Read outside of nodes (e.g., to load inputs)
+        self.lock = threading.Lock()
+
+    def add_read(self, service, size):
+        with self.lock:
+            self.bytes_read[service] = self.bytes_read.get(service, 0) + size
+
+    def add_node(self, node_id, profile):
+        """Adds the profile of a workflow node, as a dictionary (see `TaskProfile.to_dict`)"""
+
+        with self.lock:
+            self.nodes.append(dict(profile, node=node_id))
+
+    def to_dict(self):
+        """Returns the profile, which can be serialized as JSON"""
+
+        with self.lock:
+            bytes_read = dict(self.bytes_read)
+            for node in self.nodes:
+                for service, size in node['bytes_read'].items():
+                    bytes_read[service] = bytes_read.get(service, 0) + size
+
+            return {
+                'time': time.perf_counter() - self.start,
+                'cpu_time': time.process_time() - self.cpu_start,
+                'peak_rss': get_peak_rss(),
+                'bytes_read': bytes_read,
+                'nodes': list(self.nodes)
+            }
+
+
+class NodeProfile(object):
+    """Totals for a single node of an expression"""
+
+    def __init__(self, node):
+        self.node = node
+        self.expression = to_expression(node)
+        self.calls = 0
+        self.time = 0.0
+        self.self_time = 0.0
+        self.allocated = None
+        self.peak = None
+        self.dtype = None
+        self.shape = None
+
+    def add(self, elapsed, self_elapsed, allocated, peak, value):
+        self.calls += 1
+        self.time += elapsed
+        self.self_time += self_elapsed
+
+        if allocated is not None:
+            self.allocated = (self.allocated or 0) + allocated
+            self.peak = max(self.peak or 0, peak)
+
+        if isinstance(value, numpy.ndarray):
+            self.dtype = str(value.dtype)
+            self.shape = list(value.shape)
+        elif isinstance(value, numpy.generic):
+            self.dtype = str(value.dtype)
+            self.shape = []
+        else:
+            self.dtype = type(value).__name__
+            self.shape = None
+
+
+class ExpressionProfile(object):
+    """
+    Profile of an expression, over any number of evaluations. Times are in seconds and include the time taken by
+    child nodes, except for `self_time`. `allocated` is the memory still in use after each evaluation of a node (mostly
+    its result), and `peak` is the most memory in use above that at the start of any evaluation of the node, in bytes.
+    Memory is only recorded while `tracemalloc` is tracing, and includes allocations by other threads.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self.evaluations = 0
+        self.time = 0.0
+        self.nodes = {}
+        self.local = threading.local()
+        self.function = expression.build_function(self)
+
+    def wrap(self, node, function):
+        """Returns a function which evaluates a node with `function` and records its profile"""
+
+        record = self.nodes.get(id(node))
+        if record is None:
+            record = self.nodes[id(node)] = NodeProfile(node)
+
+        def run(context):
+            stack = self.get_stack()
+            tracing = tracemalloc.is_tracing()
+
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], peak)
+                tracemalloc.reset_peak()
+
+            # Time spent in child nodes, and the peak memory of child nodes
+            frame = [0.0, 0]
+            stack.append(frame)
+            start = time.perf_counter()
+
+            try:
+                value = function(context)
+            finally:
+                elapsed = time.perf_counter() - start
+                stack.pop()
+
+            allocated = peak = None
+            if tracing:
+                end, end_peak = tracemalloc.get_traced_memory()
+                absolute_peak = max(end_peak, frame[1])
+                allocated, peak = end - current, absolute_peak - current
+                if stack:
+                    stack[-1][1] = max(stack[-1][1], absolute_peak)
+
+            if stack:
+                stack[-1][0] += elapsed
+
+            record.add(elapsed, elapsed - frame[0], allocated, peak, value)
+            return value
+
+        return run
+
+    def get_stack(self):
+        """Returns the stack of nodes being evaluated by this thread"""
+
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def evaluate(self, context):
+        start = time.perf_counter()
+
+        try:
+            return self.function(context)
+        finally:
+            self.evaluations += 1
+            self.time += time.perf_counter() - start
+
+    def to_dict(self):
+        """Returns the profile as a tree of nodes, which can be serialized as JSON"""
+
+        def to_dicts(node):
+            record = self.nodes.get(id(node))
+            children = [x for child in get_children(node) for x in to_dicts(child)]
+
+            # Names aren't profiled, and nodes evaluated as part of their parent (by numexpr) are never called
+            if record is None or not record.calls:
+                return children
+
+            return [{
+                'expression': record.expression,
+                'calls': record.calls,
+                'time': record.time,
+                'self_time': record.self_time,
+                'allocated': record.allocated,
+                'peak': record.peak,
+                'dtype': record.dtype,
+                'shape': record.shape,
+                'shared': node.shared,
+                'children': children
+            }]
+
+        tree = to_dicts(self.expression.tree)
+
+        return {
+            'expression': self.expression.expr,
+            'evaluations': self.evaluations,
+            'time': self.time,
+            'tree': tree[0] if len(tree) == 1 else None
+        }
+
+
+class ExpressionProfiler(object):
+    """Collects the profiles of expressions evaluated within `profile_expressions()`"""
+
+    def __init__(self):
+        self.profiles = {}
+        self.lock = threading.Lock()
+
+    def evaluate(self, expression, context):
+        with self.lock:
+            profile = self.profiles.get(expression)
+            if profile is None:
+                profile = self.profiles[expression] = ExpressionProfile(expression)
+
+        return profile.evaluate(context)
+
+    def get_top_nodes(self, count=PROFILE_LOG_COUNT):
+        """Returns the nodes with the most `self_time`, as a list of (profile, node profile) tuples"""
+
+        nodes = [(profile, x) for profile in self.profiles.values() for x in profile.nodes.values()]
+        return sorted(nodes, key=lambda x: x[1].self_time, reverse=True)[:count]
+
+    def log(self, count=PROFILE_LOG_COUNT):
+        """Logs the nodes which took the most time"""
+
+        for profile, record in self.get_top_nodes(count):
+            peak = '' if record.peak is None else ', peak {:.1f} MB'.format(record.peak / 1024 / 1024)
+            logger.info('Expression node took {:.3f}s ({} calls{}): {} in {}'.format(
+                record.self_time, record.calls, peak, record.expression, profile.expression.expr
+            ))
+
+    def to_list(self):
+        """Returns the profiles of all expressions, which can be serialized as JSON"""
+
+        return [x.to_dict() for x in self.profiles.values()]
+
+
+@contextmanager
+def profile_job():
+    """Profiles the workflow nodes run within the context, and yields the `JobProfile`"""
+
+    profile = JobProfile()
+    token = _job_profile.set(profile)
+
+    try:
+        yield profile
+    finally:
+        _job_profile.reset(token)
+
+
+def get_job_profile():
+    """Returns the `JobProfile` of the current job, or None if it isn't being profiled"""
+
+    return _job_profile.get()
+
+
+@contextmanager
+def profile_task(task):
+    """Times a task called within the context, and records the data it reads from services. Yields the `TaskProfile`."""
+
+    profile = TaskProfile(task)
+    token = _task_profile.set(profile)
+    start, cpu_start = time.perf_counter(), time.thread_time()
+
+    try:
+        yield profile
+    finally:
+        profile.time = time.perf_counter() - start
+        profile.cpu_time = time.thread_time() - cpu_start
+        profile.peak_rss = get_peak_rss()
+        _task_profile.reset(token)
+
+
+def record_read(service, size):
+    """Records bytes read from a service by the current task, or the current job outside of tasks"""
+
+    profile = _task_profile.get() or _job_profile.get()
+    if profile is not None:
+        profile.add_read(service, size)
+
+
+@contextmanager
+def profile_expressions(trace_memory=True):
+    """
+    Profiles expressions evaluated with `evaluate` within the context, and yields the `ExpressionProfiler`. If
+    `trace_memory` is True, `tracemalloc` is started (if it isn't already) to record memory use.
+    """
+
+    profiler = ExpressionProfiler()
+    token = _profiler.set(profiler)
+    started = trace_memory and not tracemalloc.is_tracing()
+
+    if started:
+        tracemalloc.start()
+
+    try:
+        yield profiler
+    finally:
+        _profiler.reset(token)
+
+        if started:
+            tracemalloc.stop()
+
+
+def evaluate(expression, context):
+    """Evaluates a compiled expression, profiling it if called within `profile_expressions()`"""
+
+    profiler = _profiler.get()
+
+    if profiler is None or expression.backend == 'eval':
+        return expression.evaluate(context)
+
+    return profiler.evaluate(expression, context)
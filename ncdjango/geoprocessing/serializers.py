@@ -4,17 +4,18 @@ from rest_framework import serializers
 from ncdjango.models import ProcessingJob
 
 from .celery_tasks import run_job
-from .utils import REGISTERED_JOBS, get_task_instance
+from .utils import REGISTERED_JOBS, get_job_template
 
 
 class ProcessingJobSerializer(serializers.ModelSerializer):
     status = serializers.CharField(read_only=True)
     inputs = serializers.JSONField(allow_null=True, write_only=True)
     outputs = serializers.JSONField(read_only=True)
+    profile = serializers.JSONField(read_only=True)
 
     class Meta:
         model = ProcessingJob
-        fields = ('uuid', 'job', 'created', 'status', 'inputs', 'outputs')
+        fields = ('uuid', 'job', 'created', 'status', 'inputs', 'outputs', 'profile')
         read_only_fields = ('uuid', 'created', 'status')
 
     def validate_job(self, value):
@@ -32,7 +33,7 @@ class ProcessingJobSerializer(serializers.ModelSerializer):
         return {}
 
     def validate(self, data):
-        task = get_task_instance(data['job'])
+        task = get_job_template(data['job'])
         missing_params = set(x.name for x in task.inputs if x.required).difference(set(data['inputs'].keys()))
 
         if missing_params:
@@ -1,15 +1,15 @@
+import itertools
 from functools import reduce
 
 from netCDF4 import Dataset
-from numpy import ndarray
-from numpy.ma import masked_array, masked_where
-from numpy.ma.core import is_masked
-from rasterio.dtypes import is_ndarray
+from numpy.ma import masked_where
 
 from ncdjango.geoprocessing import params
-from ncdjango.geoprocessing.data import Raster
-from ncdjango.geoprocessing.evaluation import Lexer, Parser
+from ncdjango.geoprocessing.blocks import BlockedEvaluationError, evaluate_blocked, find_reductions, map_blocks
+from ncdjango.geoprocessing.data import apply_mask, get_data, is_lazy_raster
+from ncdjango.geoprocessing.evaluation import compile_expression
 from ncdjango.geoprocessing.exceptions import ExecutionError
+from ncdjango.geoprocessing.profiling import evaluate
 from ncdjango.geoprocessing.workflow import Task
 
 
@@ -41,37 +41,45 @@ class ExpressionMixin(object):
     """A mixin class to handle expression parsing and error handling."""
 
     def get_expression_names(self, expression):
+        """Returns the names in an expression, in the order they first appear (e.g., `x` and then `y` in `x - y`)"""
+
         try:
-            return list(Lexer().get_names(expression))
+            return list(compile_expression(expression).names)
         except SyntaxError as e:
             raise ExecutionError('The expression is invalid ({0}): {1}'.format(str(e), expression), self)
 
-    def evaluate_expression(self, expression, context={}):
-        try:
-            # Operations against masked arrays are really slow, so take a regular array view, then back to a masked
-            # array afterwards. Todo: find a better solution long-term
-            expr_context = {k: v.view(ndarray) if is_masked(v) else v for k, v in context.items()}
-
-            result = Parser().evaluate(expression, context=expr_context)
+    def evaluate_expression(self, expression, context={}, block_fn=None):
+        """
+        Evaluates an expression. If any values in the context are `LazyRaster` objects, the expression is evaluated
+        block by block and the result is returned as a `LazyRaster` (see `evaluate_blocked`). In that case, `block_fn`
+        is an optional function to transform each block of the result, given the result and the block's context.
+        """
 
-            if is_ndarray(result):
-                for value in context.values():
-                    if is_masked(value):
-                        if is_masked(result) and is_masked(value):
-                            result.mask = result.mask | value.mask
-                        elif is_masked(value):
-                            result = masked_array(result, mask=value.mask)
+        try:
+            compiled = compile_expression(expression)
 
-                        result = Raster(result, value.extent, value.x_dim, value.y_dim, value.y_increasing)
-                        break
+            if any(is_lazy_raster(x) for x in context.values()):
+                return evaluate_blocked(compiled, context, self.evaluate_compiled, block_fn)
 
-            return result
+            return self.evaluate_compiled(compiled, context)
 
         except (SyntaxError, NameError) as e:
             raise ExecutionError(
                 'The expression is invalid ({0}): {1}\nContext: {2}'.format(str(e), expression, str(context)),
                 self
             )
+        except BlockedEvaluationError as e:
+            raise ExecutionError('{0}: {1}'.format(str(e), expression), self)
+
+    def evaluate_compiled(self, expression, context):
+        """Evaluates a compiled expression with in-memory values"""
+
+        # Operations against masked arrays are really slow, so evaluate the expression against the data of each array,
+        # then mask the result once, with the combined mask of the inputs. For arrays which are reduced (e.g.,
+        # `mean(x)`), masked cells of floating point arrays are set to NaN so that they are ignored.
+        result = evaluate(expression, {k: get_data(v, k in expression.reduced_names) for k, v in context.items()})
+
+        return apply_mask(result, list(context.values()))
 
 
 class SingleArrayExpressionBase(ExpressionMixin, Task):
@@ -81,11 +89,10 @@ class SingleArrayExpressionBase(ExpressionMixin, Task):
     outputs = [params.NdArrayParameter('array_out')]
     allow_extra_args = True
 
-    def get_context(self, arr, expr, context):
+    def get_array_name(self, expr, context):
         """
-        Returns a context dictionary for use in evaluating the expression.
+        Returns the name of the input array in the expression: the only name which isn't in the context.
 
-        :param arr: The input array.
         :param expr: The input expression.
         :param context: Evaluation context.
         """
@@ -95,7 +102,18 @@ class SingleArrayExpressionBase(ExpressionMixin, Task):
         if len(expression_names) != 1:
             raise ValueError('The expression must have exactly one variable.')
 
-        return {expression_names[0]: arr}
+        return expression_names[0]
+
+    def get_context(self, arr, expr, context):
+        """
+        Returns a context dictionary for use in evaluating the expression.
+
+        :param arr: The input array.
+        :param expr: The input expression.
+        :param context: Evaluation context.
+        """
+
+        return {self.get_array_name(expr, context): arr}
 
 
 class MaskByExpression(SingleArrayExpressionBase):
@@ -107,7 +125,14 @@ class MaskByExpression(SingleArrayExpressionBase):
         """Creates and returns a masked view of the input array."""
 
         context = self.get_context(array_in, expression, kwargs)
+        name = next(iter(context))
         context.update(kwargs)
+
+        if is_lazy_raster(array_in):
+            return self.evaluate_expression(
+                expression, context, block_fn=lambda mask, block_context: masked_where(mask, block_context[name])
+            )
+
         return masked_where(self.evaluate_expression(expression, context), array_in)
 
 
@@ -129,16 +154,16 @@ class MapByExpression(SingleArrayExpressionBase):
 
     name = 'raster:map_by_expression'
     inputs = [
-        params.ListParameter(params.NdArrayParameter(''), 'arrays_in', required=True),
+        params.ListParameter(params.NdArrayParameter(''), 'arrays_in', required=True, streaming=True),
         params.StringParameter('expression', required=True),
         params.BooleanParameter('generator', required=False)
     ]
     outputs = [params.ListParameter(params.NdArrayParameter(''), 'arrays_out')]
 
     def execute(self, arrays_in, expression, generator=False, **kwargs):
+        name = self.get_array_name(expression, kwargs)
         result = (
-            self.evaluate_expression(expression, dict(self.get_context(a, expression, kwargs), i=i, **kwargs))
-            for i, a in enumerate(arrays_in)
+            self.evaluate_expression(expression, dict(kwargs, i=i, **{name: a})) for i, a in enumerate(arrays_in)
         )
 
         return result if generator else list(result)
@@ -149,7 +174,7 @@ class ReduceByExpression(ExpressionMixin, Task):
 
     name = 'raster:reduce_by_expression'
     inputs = [
-        params.ListParameter(params.NdArrayParameter(''), 'arrays_in', required=True),
+        params.ListParameter(params.NdArrayParameter(''), 'arrays_in', required=True, streaming=True),
         params.StringParameter('expression', required=True),
         params.NdArrayParameter('initial_array', required=False)
     ]
@@ -170,8 +195,26 @@ class ReduceByExpression(ExpressionMixin, Task):
             context.update(kwargs)
             return self.evaluate_expression(expression, context)
 
-        args = [reduce_fn, arrays_in]
-        if initial_array is not None:
-            args.append(initial_array)
+        # Arrays may come from a generator, so reduce them as they're produced. Large rasters are reduced block by
+        # block, which needs all of them at once (that's cheap, since they're read from files as they're used).
+        arrays_in = itertools.chain([] if initial_array is None else [initial_array], arrays_in)
+        try:
+            first = next(arrays_in)
+        except StopIteration:
+            raise ExecutionError('There are no arrays to reduce', self)
+
+        if is_lazy_raster(first):
+            arrays_in = [first] + list(arrays_in)
+
+            # Reduce each band of rows in turn. Reductions within the expression would only see one band at a time.
+            try:
+                if find_reductions(compile_expression(expression).tree, expression_names):
+                    raise ExecutionError(
+                        'Expressions with reductions (e.g., mean) can\'t be used to reduce large rasters', self
+                    )
+
+                return map_blocks(lambda blocks: reduce(reduce_fn, blocks), arrays_in)
+            except BlockedEvaluationError as e:
+                raise ExecutionError('{0}: {1}'.format(str(e), expression), self)
 
-        return reduce(*args)
+        return reduce(reduce_fn, arrays_in, first)
@@ -1,33 +1,47 @@
 import os
+import shutil
+import threading
 from importlib import import_module
 
 import numpy
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import transaction
-from netCDF4 import Dataset
 from rasterio.dtypes import is_ndarray
 from shapely.geometry import shape
-from trefoil.netcdf.crs import set_crs
-from trefoil.netcdf.variable import SpatialCoordinateVariables
 from trefoil.render.renderers.stretched import StretchedRenderer
 from trefoil.utilities.color import Color
-from trefoil.utilities.proj import is_latlong
 
 from ncdjango.models import SERVICE_DATA_ROOT, Service, Variable, ProcessingResultService
+from ncdjango.stats import summarize_array
 
 from . import params
-from .data import is_raster
+from .blocks import create_raster_dataset, get_row_ranges
+from .cache import get_file_version
+from .data import LazyRaster, is_lazy_raster, is_raster
 from .params import ParameterNotValidError
 from .workflow import Workflow
 
 REGISTERED_JOBS = getattr(settings, 'NC_REGISTERED_JOBS', {})
 
 
-def get_task_instance(job_name):
-    if job_name not in REGISTERED_JOBS:
+_templates = {}  # {<job name>: (<version>, <task class or workflow>)}
+_templates_lock = threading.Lock()
+
+
+def get_job_version(job_info):
+    """Identifies the definition of a registered job: its task class, or the version of its workflow file"""
+
+    if not isinstance(job_info, dict):
         return None
 
+    if job_info.get('type') == 'workflow':
+        return get_file_version(job_info['path']) if job_info.get('path') else None
+
+    return job_info.get('type'), job_info.get('task')
+
+
+def load_job_template(job_name):
     job_info = REGISTERED_JOBS[job_name]
 
     if not isinstance(job_info, dict) or 'type' not in job_info:
@@ -41,22 +55,60 @@ def get_task_instance(job_name):
         try:
             module_name, class_name = class_path.rsplit('.', 1)
             module = import_module(module_name)
-            cls = getattr(module, class_name)
+            return getattr(module, class_name)
         except (ImportError, ValueError, AttributeError):
             raise ImproperlyConfigured('{} is not a valid task.'.format(class_path))
-
-        return cls()
     elif job_info['type'] == 'workflow':
         path = job_info.get('path')
         if not path or not os.path.isfile(path):
             raise ImproperlyConfigured('The workflow {} does not exist.'.format(path))
 
         with open(path, 'r') as f:
-            return Workflow.from_json(f.read())
+            workflow = Workflow.from_json(f.read())
+
+        try:
+            workflow.get_execution_order()  # Check the workflow, and keep the order for all jobs
+        except ValueError as e:
+            raise ImproperlyConfigured('The workflow {} is invalid: {}'.format(path, e))
+
+        return workflow
     else:
         raise ImproperlyConfigured('Invalid job type: {}'.format(job_info['type']))
 
 
+def get_job_template(job_name):
+    """
+    Returns the task class or workflow for a registered job, or None if there is no such job. Task classes are imported
+    and workflows are loaded and checked once, and loaded again if their file changes. Templates are shared, so they
+    shouldn't be run or modified; use `get_task_instance` to get a task to run.
+    """
+
+    if job_name not in REGISTERED_JOBS:
+        return None
+
+    version = get_job_version(REGISTERED_JOBS[job_name])
+
+    with _templates_lock:
+        cached_version, template = _templates.get(job_name, (None, None))
+
+    if version is None or version != cached_version:
+        template = load_job_template(job_name)
+
+        with _templates_lock:
+            _templates[job_name] = (version, template)
+
+    return template
+
+
+def get_task_instance(job_name):
+    template = get_job_template(job_name)
+
+    if template is None:
+        return None
+
+    return template.clone() if isinstance(template, Workflow) else template()
+
+
 def process_web_inputs(task, inputs):
     for param in task.inputs:
         if param.name in inputs:
@@ -71,9 +123,10 @@ def process_web_inputs(task, inputs):
 
             elif isinstance(param, params.ListParameter):
                 if isinstance(param.param_type, (params.RasterParameter, params.NdArrayParameter)):
-                    inputs[param.name] = [
-                        params.RegisteredDatasetParameter(param.name).clean(x) for x in inputs[param.name]
-                    ]
+                    rasters = (params.RegisteredDatasetParameter(param.name).clean(x) for x in inputs[param.name])
+
+                    # Workflows pass lists of rasters on as generators where they can, so load each as it's used
+                    inputs[param.name] = rasters if isinstance(task, Workflow) or param.streaming else list(rasters)
 
                 elif isinstance(param.param_type, params.FeatureParameter):
                     try:
@@ -94,27 +147,36 @@ def process_web_outputs(results, job, publish_raster_results=False, renderer_or_
             abs_path = os.path.join(settings.MEDIA_ROOT, SERVICE_DATA_ROOT, rel_path)
             os.makedirs(os.path.dirname(abs_path))
 
-            with Dataset(abs_path, 'w', format='NETCDF4') as ds:
-                if is_latlong(v.extent.projection):
-                    x_var = 'longitude'
-                    y_var = 'latitude'
+            if is_lazy_raster(v) and v.is_temporary:
+                # Results of blocked evaluation are already in the right format
+                v.close()
+                shutil.move(v.path, abs_path)
+                v.detach()
+                v = LazyRaster(abs_path, v.variable, v.x_dimension, v.y_dimension, v.extent, v.y_increasing)
+                x_var, y_var = v.x_dimension, v.y_dimension
+            else:
+                if is_lazy_raster(v):
+                    fill_value = getattr(v.data, '_FillValue', None)
                 else:
-                    x_var = 'x'
-                    y_var = 'y'
+                    fill_value = v.fill_value if numpy.ma.core.is_masked(v) else None
 
-                coord_vars = SpatialCoordinateVariables.from_bbox(v.extent, *reversed(v.shape), y_ascending=v.y_increasing)
-                coord_vars.add_to_dataset(ds, x_var, y_var)
+                ds, x_var, y_var = create_raster_dataset(
+                    abs_path, v.extent, v.shape, v.dtype, v.y_increasing, fill_value
+                )
 
-                fill_value = v.fill_value if numpy.ma.core.is_masked(v) else None
-                data_var = ds.createVariable('data', v.dtype, dimensions=(y_var, x_var), fill_value=fill_value, compression='zlib')
-                data_var[:] = v
-                set_crs(ds, 'data', v.extent.projection)
+                with ds:
+                    if is_lazy_raster(v):
+                        for start, stop in get_row_ranges([v]):
+                            ds.variables['data'][start:stop] = v.read(start, stop)
+                    else:
+                        ds.variables['data'][:] = v
 
             if callable(renderer_or_fn):
                 renderer = renderer_or_fn(v)
             elif renderer_or_fn is None:
+                summary = summarize_array(v)
                 renderer = StretchedRenderer(
-                    [(numpy.min(v).item(), Color(0, 0, 0)), (numpy.max(v).item(), Color(255, 255, 255))]
+                    [(summary.min, Color(0, 0, 0)), (summary.max, Color(255, 255, 255))]
                 )
             else:
                 renderer = renderer_or_fn
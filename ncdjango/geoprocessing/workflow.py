@@ -1,12 +1,29 @@
+import contextvars
 import copy
 import json
 import logging
+import threading
 import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 
-from .params import ParameterCollection, Parameter
+import numpy
+from django import db
+from django.conf import settings
+
+from .cache import get_node_cache
+from .data import LazyRaster, get_output_size, get_resident_size, spill_array
+from .params import ListParameter, ParameterCollection, Parameter
+from .profiling import TaskProfile, get_job_profile, profile_task
 
 logger = logging.getLogger(__name__)
 
+WORKFLOW_MAX_WORKERS = getattr(settings, 'NC_WORKFLOW_MAX_WORKERS', 1)
+WORKFLOW_EXECUTOR = getattr(settings, 'NC_WORKFLOW_EXECUTOR', 'thread')
+WORKFLOW_MEMORY_BUDGET = getattr(settings, 'NC_WORKFLOW_MEMORY_BUDGET', None)
+WORKFLOW_SPILL_DIR = getattr(settings, 'NC_WORKFLOW_SPILL_DIR', None)
+
 
 class TaskBase(type):
     """Parameter metaclass, used to register parameter classes for lookup by name."""
@@ -32,6 +49,7 @@ class Task(metaclass=TaskBase):
     inputs = []  # A list of `Parameter` objects defining accepted inputs for this task
     outputs = []  # A list of `Parameter` objects defining expected outputs for this task
     allow_extra_args = False  # If true, task may be called with kwargs not defined in `inputs`
+    cacheable = True  # If false, outputs are never cached (e.g., if they don't only depend on the inputs)
 
     def __init__(self):
         self.inputs = copy.copy(self.inputs)
@@ -99,6 +117,151 @@ class Task(metaclass=TaskBase):
         raise NotImplementedError
 
 
+def execute_task(task, inputs, in_process=False):
+    """
+    Calls a task and returns a tuple of (outputs as a dictionary, profile of the call as a dictionary). Used to run
+    workflow nodes in thread or process pools. If `in_process` is True, the task is running in a process pool, and
+    its outputs are prepared to be sent back to the workflow's process: iterators are materialized into lists, and
+    the temporary files of lazy rasters are handed over to the workflow's copies (see `LazyRaster.transfer`).
+    """
+
+    with profile_task(task) as profile:
+        outputs = task(**inputs).format_args()
+
+        if in_process:
+            outputs = {k: list(v) if isinstance(v, Iterator) else v for k, v in outputs.items()}
+
+    if in_process:
+        for value in outputs.values():
+            for item in value if isinstance(value, (list, tuple)) else [value]:
+                if isinstance(item, LazyRaster):
+                    item.transfer()
+
+    profile.output_sizes = {k: get_output_size(v) for k, v in outputs.items()}
+    return outputs, profile.to_dict()
+
+
+def get_cached_profile(task, outputs):
+    """Returns the profile of a task whose outputs were cached"""
+
+    profile = TaskProfile(task, cached=True)
+    profile.output_sizes = {k: get_output_size(v) for k, v in outputs.items()}
+    return profile.to_dict()
+
+
+def get_cached_outputs(cache, node, task_inputs):
+    """Returns a tuple of (cache key, cached outputs) for a workflow node. Either may be None."""
+
+    key = None if cache is None else cache.get_key(node.task, task_inputs)
+    outputs = None if key is None else cache.get(key)
+
+    if outputs is not None:
+        logger.info('Using cached outputs for node {0}'.format(node.id))
+
+    return key, outputs
+
+
+def iter_arrays(value):
+    """Returns the arrays in a task output, which may be an array or a list of arrays"""
+
+    if isinstance(value, (list, tuple)):
+        return [x for x in value if isinstance(x, numpy.ndarray)]
+    return [value] if isinstance(value, numpy.ndarray) else []
+
+
+def spill_value(value):
+    """Moves the arrays in a task output to memory-mapped temporary files (see `spill_array`)"""
+
+    if isinstance(value, (list, tuple)):
+        return type(value)(spill_array(x, WORKFLOW_SPILL_DIR) for x in value)
+    return spill_array(value, WORKFLOW_SPILL_DIR)
+
+
+class SharedIterator(object):
+    """
+    Shares an iterator between several consumers, which may be in different threads. Each of `branches` iterates over
+    every item, and items are only held until all of the branches have reached them.
+    """
+
+    def __init__(self, iterator, count):
+        self.iterator = iterator
+        self.lock = threading.Lock()
+        self.items = deque()
+        self.start = 0  # The position of the first item in `items`
+        self.positions = [0] * count
+        self.branches = [self.iterate(i) for i in range(count)]
+
+    def get_next(self, branch):
+        with self.lock:
+            position = self.positions[branch]
+
+            if position - self.start < len(self.items):
+                item = self.items[position - self.start]
+            else:
+                item = next(self.iterator)
+                self.items.append(item)
+
+            self.positions[branch] += 1
+
+            while self.items and min(self.positions) > self.start:
+                self.items.popleft()
+                self.start += 1
+
+            return item
+
+    def iterate(self, branch):
+        while True:
+            try:
+                item = self.get_next(branch)
+            except StopIteration:
+                return
+
+            yield item
+
+
+class SharedInputs(object):
+    """
+    Passes iterators (e.g., generators of arrays) from workflow inputs and node outputs to the node inputs which use
+    them. An iterator used by a single streaming list parameter (see `ListParameter`) is passed on as-is, and one used
+    by several is shared between them with `SharedIterator`, so each item is produced once. Otherwise (if it's used by
+    other parameters or is a workflow output, or if `allow_streaming` is False), the iterator is materialized into a
+    list once, for all of its uses.
+    """
+
+    def __init__(self, uses, allow_streaming=True):
+        """
+        :param uses: A dictionary of `{key: [<parameter or None>, ...]}` with the parameters which use each workflow
+            input (`('input', <name>)`) and node output (`('dependency', (<node id>, <output name>))`). None represents
+            a workflow output.
+        """
+
+        self.uses = uses
+        self.allow_streaming = allow_streaming
+        self.values = {}
+
+    def get(self, key, value):
+        """Returns a workflow input or node output for one of its uses"""
+
+        if not isinstance(value, Iterator):
+            return value
+
+        if key not in self.values:
+            uses = self.uses.get(key, [None])
+
+            if self.allow_streaming and all(isinstance(x, ListParameter) and x.streaming for x in uses):
+                self.values[key] = deque(SharedIterator(value, len(uses)).branches if len(uses) > 1 else [value])
+            else:
+                logger.debug('Materializing {0} for {1} uses'.format(key, len(uses)))
+                self.values[key] = deque([list(value)] * len(uses))
+
+        values = self.values[key]
+        value = values.popleft()
+        if not values:
+            del self.values[key]
+
+        return value
+
+
 class WorkflowNode(object):
     """
     Used by `Workflow` to represent a single node (a unique id, a task, and input mappings) in the workflow.
@@ -115,64 +278,282 @@ class WorkflowNode(object):
     def add_input(self, name, source, value):
         self.inputs[name] = (source, value)
 
+    @property
+    def dependencies(self):
+        """The ids of the nodes this node depends on"""
+
+        return {value[0] for source, value in self.inputs.values() if source == 'dependency'}
+
 
 class Workflow(Task):
     """A specialized task to manage the processing of many inter-related tasks."""
 
-    def __init__(self, name=None, description=None):
+    cacheable = False  # The outputs of each node are cached instead
+
+    def __init__(self, name=None, description=None, max_workers=None, executor=None):
         """Constructs the workflow from a dictionary structure."""
 
         super(Workflow, self).__init__()
 
         self.name = name
         self.description = description
+        self.max_workers = max_workers  # The most nodes to run at once, or None for `NC_WORKFLOW_MAX_WORKERS`
+        self.executor = executor  # 'thread' or 'process', or None for `NC_WORKFLOW_EXECUTOR`
 
         self.nodes_by_id = {}
         self.dependents_by_node_id = {}
         self.output_mapping = {}  # {<workflow output param name>: (<node id>, <task output param name>), ...}
+        self._execution_order = None
+
+    def clone(self):
+        """
+        Returns a copy of the workflow which can be run independently of it, e.g., for each job using a workflow
+        definition which has already been loaded. Tasks are copied, and parameters (which aren't modified) are shared.
+        """
+
+        workflow = copy.copy(self)
+        workflow.inputs = list(self.inputs)
+        workflow.outputs = list(self.outputs)
+        workflow.nodes_by_id = {
+            k: WorkflowNode(k, copy.copy(v.task), dict(v.inputs)) for k, v in self.nodes_by_id.items()
+        }
+        workflow.dependents_by_node_id = {k: set(v) for k, v in self.dependents_by_node_id.items()}
+        workflow.output_mapping = dict(self.output_mapping)
+
+        return workflow
+
+    def get_execution_order(self):
+        """
+        Returns the ids of the nodes needed for the workflow outputs in topological order, i.e., each node comes after
+        the nodes it depends on. Raises `ValueError` if nodes depend on each other in a cycle. The order is kept until
+        nodes or outputs are added.
+        """
+
+        if self._execution_order is None:
+            self._execution_order = self._sort_nodes()
+
+        return list(self._execution_order)
+
+    def _sort_nodes(self):
+        needed = set()
+        stack = [node_id for node_id, _ in self.output_mapping.values()]
+        while stack:
+            node_id = stack.pop()
+            if node_id not in needed:
+                needed.add(node_id)
+                stack.extend(self.nodes_by_id[node_id].dependencies)
+
+        waiting = {k: self.nodes_by_id[k].dependencies for k in self.nodes_by_id if k in needed}
+        ready = deque(k for k, v in waiting.items() if not v)
+        order = []
+
+        while ready:
+            node_id = ready.popleft()
+            order.append(node_id)
+
+            for dependent_id, dependencies in waiting.items():
+                if node_id in dependencies:
+                    dependencies.remove(node_id)
+                    if not dependencies:
+                        ready.append(dependent_id)
+
+        if len(order) < len(waiting):
+            raise ValueError('The workflow has circular dependencies between nodes: {0}'.format(
+                ', '.join(sorted(str(x) for x in set(waiting).difference(order)))
+            ))
+
+        return order
+
+    def _get_uses(self, order):
+        """Returns the parameters which use each workflow input and node output (see `SharedInputs`)"""
+
+        uses = {}
+
+        for node_id in order:
+            node = self.nodes_by_id[node_id]
+            parameters = ParameterCollection(node.task.inputs).by_name
+
+            for name, (source, value) in node.inputs.items():
+                if source == 'input':
+                    uses.setdefault((source, value), []).append(parameters.get(name))
+                elif source == 'dependency':
+                    uses.setdefault((source, tuple(value)), []).append(parameters.get(name))
+
+        for node_id, name in self.output_mapping.values():
+            uses.setdefault(('dependency', (node_id, name)), []).append(None)
+
+        return uses
+
+    def _get_node_inputs(self, node, workflow_inputs, dependents_by_node_id, shared_inputs):
+        """
+        Returns the task inputs for a node whose dependencies have completed, and releases the outputs of dependencies
+        which are no longer needed by other nodes.
+        """
 
-    def _execute_node(self, node, workflow_inputs):
         task_inputs = {}
 
         for name, (source, value) in node.inputs.items():
             if source == 'input':
                 if value in workflow_inputs:
-                    task_inputs[name] = workflow_inputs[value]
+                    task_inputs[name] = shared_inputs.get((source, value), workflow_inputs[value])
             elif source == 'dependency':
                 dependency = self.nodes_by_id[value[0]]
-
-                if not dependency.completed:
-                    self._execute_node(dependency, workflow_inputs)
-
                 if value[1] in dependency.outputs:
-                    task_inputs[name] = dependency.outputs[value[1]]
-
-                dependents = self.dependents_by_node_id[dependency.id]
-                dependents.remove(node.id)
-                if not dependents:
-                    dependency.outputs = None  # Allow release of outputs which are no longer needed
+                    task_inputs[name] = shared_inputs.get((source, tuple(value)), dependency.outputs[value[1]])
             elif source == 'literal':
                 task_inputs[name] = value
             else:
                 raise ValueError('Invalid input source: {0}'.format(source))
 
-        node.outputs = node.task(**task_inputs).format_args()
-        node.completed = True
+        for dependency_id in node.dependencies:
+            dependents = dependents_by_node_id[dependency_id]
+            dependents.discard(node.id)
+            if not dependents:
+                self.nodes_by_id[dependency_id].outputs = None  # Allow release of outputs which are no longer needed
 
-    def execute(self, **kwargs):
-        outputs = ParameterCollection(self.outputs)
+        return task_inputs
+
+    def _spill_outputs(self, order, dependents_by_node_id):
+        """
+        If the array outputs held for dependents of completed nodes use more memory than `NC_WORKFLOW_MEMORY_BUDGET`,
+        moves them to memory-mapped temporary files until they fit, starting with the outputs needed furthest ahead.
+        """
 
-        for param, (node_id, name) in self.output_mapping.items():
+        if WORKFLOW_MEMORY_BUDGET is None:
+            return
+
+        positions = {node_id: i for i, node_id in enumerate(order)}
+        resident = []
+
+        for node_id in order:
             node = self.nodes_by_id[node_id]
+            if not node.completed or node.outputs is None:
+                continue
+
+            size = sum(get_resident_size(x) for value in node.outputs.values() for x in iter_arrays(value))
+            if size:
+                # Outputs mapped to workflow outputs are needed last
+                next_use = min(positions.get(x, len(order)) for x in dependents_by_node_id.get(node_id, {None}))
+                resident.append((next_use, size, node))
+
+        total = sum(x[1] for x in resident)
+
+        for _, size, node in sorted(resident, key=lambda x: x[0], reverse=True):
+            if total <= WORKFLOW_MEMORY_BUDGET:
+                break
+
+            logger.debug('Moving outputs of node {0} to disk ({1} bytes)'.format(node.id, size))
+            node.outputs = {k: spill_value(v) for k, v in node.outputs.items()}
+            total -= size
+
+    def _execute_nodes(self, order, workflow_inputs, dependents_by_node_id, shared_inputs, cache, max_workers,
+                       executor):
+        """Runs nodes on a pool of `max_workers` threads or processes, starting each once its dependencies finish"""
+
+        if executor == 'process':
+            db.connections.close_all()  # Database connections can't be shared with forked processes
+            pool = ProcessPoolExecutor(max_workers)
+        elif executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers)
+        else:
+            raise ValueError('Invalid workflow executor: {0}'.format(executor))
+
+        waiting = {node_id: self.nodes_by_id[node_id].dependencies for node_id in order}
+        ready = [node_id for node_id in order if not waiting[node_id]]
+        running = {}
+        job_profile = get_job_profile()
 
-            if not node.completed:
-                self._execute_node(node, kwargs)
+        def complete(node, outputs):
+            node.outputs = outputs
+            node.completed = True
+            self._spill_outputs(order, dependents_by_node_id)
 
-            outputs[param] = node.outputs[name]
+            for dependent_id, dependencies in waiting.items():
+                if node.id in dependencies:
+                    dependencies.remove(node.id)
+                    if not dependencies:
+                        ready.append(dependent_id)
 
-        for node in self.nodes_by_id.values():
-            node.outputs = None
-            node.completed = False
+            ready.sort(key=order.index)
+
+        with pool:
+            try:
+                while ready or running:
+                    while ready:
+                        node = self.nodes_by_id[ready.pop(0)]
+                        task_inputs = self._get_node_inputs(
+                            node, workflow_inputs, dependents_by_node_id, shared_inputs
+                        )
+                        key, outputs = get_cached_outputs(cache, node, task_inputs)
+
+                        if outputs is not None:
+                            if job_profile is not None:
+                                job_profile.add_node(node.id, get_cached_profile(node.task, outputs))
+                            complete(node, outputs)
+                        elif executor == 'thread':
+                            # Run with a copy of the current context, e.g., to profile expressions in the task
+                            future = pool.submit(contextvars.copy_context().run, execute_task, node.task, task_inputs)
+                            running[future] = (node, key)
+                        else:
+                            future = pool.submit(execute_task, node.task, task_inputs, True)
+                            running[future] = (node, key)
+
+                    if running:
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                        for future in done:
+                            node, key = running.pop(future)
+                            outputs, profile = future.result()
+                            if job_profile is not None:
+                                job_profile.add_node(node.id, profile)
+                            if key is not None:
+                                cache.set(key, outputs)
+                            complete(node, outputs)
+            except:
+                for future in running:
+                    future.cancel()
+                raise
+
+    def execute(self, **kwargs):
+        order = self.get_execution_order()
+        dependents_by_node_id = {k: set(v) for k, v in self.dependents_by_node_id.items()}
+        cache = get_node_cache()
+        max_workers = self.max_workers or WORKFLOW_MAX_WORKERS
+        executor = (self.executor or WORKFLOW_EXECUTOR) if max_workers > 1 and len(order) > 1 else None
+        # Iterators can't be passed to other processes
+        shared_inputs = SharedInputs(self._get_uses(order), allow_streaming=executor != 'process')
+        outputs = ParameterCollection(self.outputs)
+        job_profile = get_job_profile()
+
+        try:
+            if executor is not None:
+                self._execute_nodes(order, kwargs, dependents_by_node_id, shared_inputs, cache, max_workers, executor)
+            else:
+                for node_id in order:
+                    node = self.nodes_by_id[node_id]
+                    task_inputs = self._get_node_inputs(node, kwargs, dependents_by_node_id, shared_inputs)
+                    key, node.outputs = get_cached_outputs(cache, node, task_inputs)
+
+                    if node.outputs is None:
+                        node.outputs, profile = execute_task(node.task, task_inputs)
+                        if key is not None:
+                            cache.set(key, node.outputs)
+                    else:
+                        profile = get_cached_profile(node.task, node.outputs)
+
+                    if job_profile is not None:
+                        job_profile.add_node(node.id, profile)
+
+                    node.completed = True
+                    self._spill_outputs(order, dependents_by_node_id)
+
+            for param, (node_id, name) in self.output_mapping.items():
+                value = self.nodes_by_id[node_id].outputs[name]
+                outputs[param] = shared_inputs.get(('dependency', (node_id, name)), value)
+        finally:
+            for node in self.nodes_by_id.values():
+                node.outputs = None
+                node.completed = False
 
         return outputs
 
@@ -193,6 +574,7 @@ class Workflow(Task):
 
         node = WorkflowNode(node_id, task, inputs)
         self.nodes_by_id[node_id] = node
+        self._execution_order = None
 
         for source, value in inputs.values():
             if source == 'dependency':
@@ -210,6 +592,7 @@ class Workflow(Task):
         """
 
         self.output_mapping[parameter_name] = (node_id, node_output_name)
+        self._execution_order = None
 
         dependents = self.dependents_by_node_id.get(node_id, set())
         dependents.add('output_{}'.format(parameter_name))
@@ -230,6 +613,11 @@ class Workflow(Task):
             'outputs': [{'name': k, 'node': v} for k, v in self.output_mapping.items()]
         }
 
+        if self.max_workers is not None:
+            d['meta']['max_workers'] = self.max_workers
+        if self.executor is not None:
+            d['meta']['executor'] = self.executor
+
         for parameter in self.inputs:
             input_info = {
                 'name': parameter.name,
@@ -278,7 +666,10 @@ class Workflow(Task):
         d = json.loads(text)
 
         meta = d.get('meta', {})
-        workflow = cls(name=meta.get('name'), description=meta.get('description'))
+        workflow = cls(
+            name=meta.get('name'), description=meta.get('description'), max_workers=meta.get('max_workers'),
+            executor=meta.get('executor')
+        )
 
         for workflow_input in d.get('inputs', []):
             parameter_cls = Parameter.by_id(workflow_input['type'])
@@ -4,7 +4,7 @@ import json
 from django import forms
 from django.core.exceptions import ValidationError
 from pyproj import Proj
-from shapely.geometry import MultiPoint
+from shapely.geometry import MultiPoint, MultiPolygon
 from shapely.geometry.base import BaseGeometry
 from shapely.geometry.multilinestring import MultiLineString
 from shapely.geometry.point import Point
@@ -32,8 +32,11 @@ class BoundingBoxField(forms.Field):
             else:
                 values = [float(x.strip()) for x in value.split(',')]
 
+            if len(values) != 4:
+                raise ValueError
+
             return BBox(values, projection=projection)
-        except ValueError:
+        except (ValueError, TypeError, KeyError):
             raise ValidationError('Invalid bbox')
 
     def prepare_value(self, value):
@@ -78,7 +81,21 @@ class GeometryField(forms.Field):
             elif geometry_type == 'esriGeometryPolygon':
                 data = json.loads(geometry)
                 rings = [LinearRing([(p[0], p[1]) for p in r]) for r in data['rings']]
-                return Polygon([r for r in rings if not r.is_ccw], interiors=[r for r in rings if r.is_ccw])
+
+                # Clockwise rings are exteriors, and counter-clockwise rings are holes in the exterior containing them
+                shells = [r for r in rings if not r.is_ccw]
+                holes = [[] for _ in shells]
+                for ring in (r for r in rings if r.is_ccw):
+                    containing = [i for i, shell in enumerate(shells) if Polygon(shell).contains(ring)]
+                    if not containing:
+                        raise ValueError
+                    holes[containing[0]].append(ring)
+
+                polygons = [Polygon(shell, interiors) for shell, interiors in zip(shells, holes)]
+                if not polygons:
+                    raise ValueError
+
+                return polygons[0] if len(polygons) == 1 else MultiPolygon(polygons)
 
             elif geometry_type == 'esriGeometryEnvelope':
                 if 'xmin' in geometry:
@@ -90,7 +107,7 @@ class GeometryField(forms.Field):
 
             else:
                 raise ValueError
-        except ValueError:
+        except (ValueError, TypeError, KeyError, IndexError):
             raise ValidationError('Invalid geometry')
 
     def prepare_value(self, value):
@@ -148,7 +165,7 @@ class TimeField(forms.Field):
             if ',' in value:
                 return tuple([timestamp_to_date(int(x) // 1000) for x in value.split(',')])
             else:
-                return datetime(int(value))
+                return timestamp_to_date(int(value) // 1000)
         except ValueError:
             return None
 
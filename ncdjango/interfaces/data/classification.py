@@ -0,0 +1,140 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+import numpy
+
+from ncdjango.stats import get_variable_statistics, sample_values, select_values
+from .classify import jenks, quantile_from_histogram, quantile_from_ranks, quantile_ranks, equal_from_range
+
+JENKS_SAMPLE_SIZE = getattr(settings, 'NC_JENKS_SAMPLE_SIZE', 5000)
+CLASSIFY_CACHE = getattr(settings, 'NC_CLASSIFY_CACHE', 'default')
+CLASSIFY_CACHE_TIMEOUT = getattr(settings, 'NC_CLASSIFY_CACHE_TIMEOUT', 7 * 24 * 60 * 60)  # 1 week
+CLASSIFY_LOCAL_CACHE_SIZE = getattr(settings, 'NC_CLASSIFY_LOCAL_CACHE_SIZE', 256)
+CLASSIFY_WARM_BREAKS = getattr(settings, 'NC_CLASSIFY_WARM_BREAKS', ())
+
+CLASSIFY_METHODS = ('jenks', 'quantile', 'equal')
+
+_local_cache = OrderedDict()
+_local_cache_lock = threading.Lock()
+
+
+def compute_classifications(variable, method, break_counts, approximate=False):
+    """
+    Calculates class breaks for a variable, for each of several numbers of breaks. The data is read or sampled once for
+    all of them. Returns a dictionary of `{<number of breaks>: <classification>}`, where each classification is a
+    dictionary with the `breaks`, the data `min`, and an `error` bound for the breaks (0 if they are exact, or None if
+    unknown).
+    """
+
+    statistics = get_variable_statistics(variable)
+    errors = {x: 0.0 for x in break_counts}
+
+    if not statistics['count']:
+        breaks = {x: [] for x in break_counts}
+    elif method == 'equal':
+        breaks = {x: equal_from_range(statistics['min'], statistics['max'], x) for x in break_counts}
+    elif method == 'jenks':
+        values = sample_values(variable, JENKS_SAMPLE_SIZE, total=statistics['count'])
+        breaks = {x: jenks(values, x, sample_size=None) for x in break_counts}
+        errors = {x: None for x in break_counts}
+    elif approximate:
+        bins, counts = statistics['histogram']['bins'], statistics['histogram']['counts']
+        breaks = {}
+        for num_breaks in break_counts:
+            breaks[num_breaks], errors[num_breaks] = quantile_from_histogram(
+                bins, counts, num_breaks, statistics['min'], statistics['max']
+            )
+    else:
+        count = statistics['count']
+        ranks = sorted(set().union(*(quantile_ranks(count, x).tolist() for x in break_counts)))
+        values = dict(zip(ranks, select_values(variable, ranks, statistics['min'], statistics['max'], count)))
+        select = lambda x: numpy.array([values[rank] for rank in x])
+        breaks = {x: quantile_from_ranks(select, count, x) for x in break_counts}
+
+    return {
+        x: {'breaks': [float(value) for value in breaks[x]], 'min': statistics['min'], 'error': errors[x]}
+        for x in break_counts
+    }
+
+
+def compute_classification(variable, method, num_breaks, approximate=False):
+    """Calculates class breaks for a variable (see `compute_classifications`)"""
+
+    return compute_classifications(variable, method, [num_breaks], approximate)[num_breaks]
+
+
+def get_cache_key(variable, method, num_breaks, approximate, data_version):
+    return 'ncdjango:classify:{}:{}:{}:{}:{}:{}'.format(
+        variable.service.pk, variable.pk, data_version, method, num_breaks, int(bool(approximate))
+    )
+
+
+def get_cached_classification(key):
+    """Returns a classification from the in-process cache or the Django cache, or None if it isn't cached"""
+
+    with _local_cache_lock:
+        if key in _local_cache:
+            _local_cache.move_to_end(key)
+            return _local_cache[key]
+
+    classification = caches[CLASSIFY_CACHE].get(key)
+
+    if classification is not None:
+        cache_locally(key, classification)
+
+    return classification
+
+
+def cache_locally(key, classification):
+    with _local_cache_lock:
+        _local_cache[key] = classification
+
+        while len(_local_cache) > CLASSIFY_LOCAL_CACHE_SIZE:
+            _local_cache.popitem(last=False)
+
+
+def set_cached_classification(key, classification):
+    caches[CLASSIFY_CACHE].set(key, classification, CLASSIFY_CACHE_TIMEOUT)
+    cache_locally(key, classification)
+
+
+def get_classification(variable, method, num_breaks, approximate=False):
+    """
+    Returns class breaks for a variable (see `compute_classification`). Results are cached in an in-process LRU cache
+    in front of the Django cache. Cache keys include the version of the data file, so updating the file invalidates
+    them.
+    """
+
+    data_version = variable.service.data_version
+    if data_version is None:
+        return compute_classification(variable, method, num_breaks, approximate)
+
+    key = get_cache_key(variable, method, num_breaks, approximate, data_version)
+    classification = get_cached_classification(key)
+
+    if classification is None:
+        classification = compute_classification(variable, method, num_breaks, approximate)
+        set_cached_classification(key, classification)
+
+    return classification
+
+
+def warm_classification_cache(variable, break_counts=CLASSIFY_WARM_BREAKS):
+    """
+    Calculates and caches class breaks for each method and each of the given numbers of breaks. Breaks which aren't
+    already cached are calculated together, so the data is read or sampled once per method.
+    """
+
+    data_version = variable.service.data_version
+    if data_version is None:
+        return
+
+    for method in CLASSIFY_METHODS:
+        keys = {x: get_cache_key(variable, method, x, False, data_version) for x in break_counts}
+        missing = [x for x in break_counts if get_cached_classification(keys[x]) is None]
+
+        if missing:
+            for num_breaks, classification in compute_classifications(variable, method, missing).items():
+                set_cached_classification(keys[num_breaks], classification)
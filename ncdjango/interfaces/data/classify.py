@@ -1,91 +1,97 @@
 import numpy
 
 
-def jenks(data, num_breaks):
+def _segment_argmin(values, starts):
     """
-    Calculate Jenks natural breaks.
+    Returns the per-segment minimum and the index of its first occurrence, for a flat array made up of consecutive
+    segments beginning at `starts`.
+    """
+
+    mins = numpy.minimum.reduceat(values, starts)
+    segments = numpy.repeat(numpy.arange(len(starts)), numpy.diff(numpy.append(starts, len(values))))
+    is_min = numpy.flatnonzero(values == mins[segments])
+    __, first = numpy.unique(segments[is_min], return_index=True)
 
-    Adapted from http://danieljlewis.org/files/2010/06/Jenks.pdf
-    Credit: Daniel Lewis
+    return mins, is_min[first]
+
+
+def jenks(data, num_breaks, sample_size=5000, seed=0):
+    """
+    Calculate Jenks natural breaks, using Fisher's exact dynamic programming method.
+
+    Within-class sums of squared deviations are computed from cumulative sums, and the optimal split points for each
+    number of classes are found with a divide-and-conquer search (optimal split points never decrease as the data
+    range grows), vectorized across all segments of each level of the search. Runs in O(k * n * log(n)) time.
 
     Arguments:
     data -- Array of values to classify.
     num_breaks -- Number of breaks to perform.
+    sample_size -- If there are more than this many values, classify a random sample of this size instead.
+    seed -- Seed for the random sample, so that breaks are repeatable for the same data.
     """
 
-    data = numpy.ma.compressed(data)
-    if len(data) > 1000:
-        data.sort()
-        ls = numpy.linspace(0, len(data)-1, 1000)
-        ls = [int(round(x)) for x in ls]
-        data_list = data[ls]
-    else:
-        data_list = data
-
-    data_list.sort()
+    data = numpy.ma.compressed(data).astype('float64')
+    if sample_size and len(data) > sample_size:
+        data = numpy.random.default_rng(seed).choice(data, sample_size, replace=False)
 
-    mat1 = []
-    for i in range(0, len(data_list) + 1):
-        temp = []
-        for j in range(0, num_breaks + 1):
-            temp.append(0)
-        mat1.append(temp)
+    data.sort()
+    n = len(data)
 
-    mat2 = []
-    for i in range(0, len(data_list) + 1):
-        temp = []
-        for j in range(0, num_breaks + 1):
-            temp.append(0)
-        mat2.append(temp)
+    if not n or num_breaks < 1:
+        return []
+    if num_breaks >= n:
+        return [float(x) for x in data] + [float(data[-1])] * (num_breaks - n)
 
-    for i in range(1, num_breaks + 1):
-        mat1[1][i] = 1
-        mat2[1][i] = 0
-        for j in range(2, len(data_list) + 1):
-            mat2[j][i] = float('inf')
+    # Cumulative sums (of values offset by the mean, for precision) let us compute the sum of squared deviations for
+    # any range of values in constant time.
+    centered = data - data.mean()
+    sums = numpy.concatenate(([0], numpy.cumsum(centered)))
+    squares = numpy.concatenate(([0], numpy.cumsum(centered * centered)))
 
-    v = 0.0
-    for l in range(2, len(data_list) + 1):
-        s1 = 0.0
-        s2 = 0.0
-        w = 0.0
-        for m in range(1, l + 1):
-            i3 = l - m + 1
+    def ssd(i, j):
+        """Sum of squared deviations for data[i:j+1]"""
 
-            val = float(data_list[i3-1])
+        s = sums[j + 1] - sums[i]
+        return (squares[j + 1] - squares[i]) - s * s / (j - i + 1)
 
-            s2 += val * val
-            s1 += val
+    indices = numpy.arange(n)
+    cost = ssd(numpy.zeros(n, dtype=int), indices)
+    class_starts = numpy.zeros((num_breaks + 1, n), dtype=int)
 
-            w += 1
-            v = s2 - (s1 * s1) / w
-            i4 = i3 - 1
+    for k in range(2, num_breaks + 1):
+        previous_cost = cost
+        cost = numpy.full(n, numpy.inf)
 
-            if i4 != 0:
-                for j in range(2, num_breaks + 1):
-                    if mat2[l][j] >= (v + mat2[i4][j - 1]):
-                        mat1[l][j] = i3
-                        mat2[l][j] = v + mat2[i4][j - 1]
+        # Segments of (first j, last j, first candidate i, last candidate i)
+        segments = numpy.array([[k - 1, n - 1, k - 1, n - 1]])
 
-        mat1[l][1] = 1
-        mat2[l][1] = v
+        while len(segments):
+            j_first, j_last, i_first, i_last = segments.T
+            mid = (j_first + j_last) // 2
+            lengths = numpy.minimum(i_last, mid) - i_first + 1
+            starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
 
-    k = len(data_list)
-    kclass = []
-    for i in range(0, num_breaks + 1):
-        kclass.append(0)
+            segment_ids = numpy.repeat(numpy.arange(len(segments)), lengths)
+            i = i_first[segment_ids] + (numpy.arange(lengths.sum()) - starts[segment_ids])
+            j = mid[segment_ids]
 
-    kclass[num_breaks] = float(data_list[len(data_list) - 1])
+            mins, positions = _segment_argmin(previous_cost[i - 1] + ssd(i, j), starts)
+            best = i[positions]
+            cost[mid] = mins
+            class_starts[k, mid] = best
 
-    count_num = num_breaks
-    while count_num >= 2:
-        id = int((mat1[k][count_num]) - 2)
+            left = numpy.column_stack((j_first, mid - 1, i_first, best))
+            right = numpy.column_stack((mid + 1, j_last, best, i_last))
+            segments = numpy.concatenate((left[left[:, 0] <= left[:, 1]], right[right[:, 0] <= right[:, 1]]))
 
-        kclass[count_num - 1] = data_list[id]
-        k = int((mat1[k][count_num] - 1))
-        count_num -= 1
+    # Walk back through the optimal class starts to find the upper bound of each class
+    breaks = []
+    j = n - 1
+    for k in range(num_breaks, 0, -1):
+        breaks.append(float(data[j]))
+        j = class_starts[k, j] - 1
 
-    return [float(x) for x in kclass][1:]
+    return breaks[::-1]
 
 
 def quantile(data, num_breaks):
@@ -131,6 +137,105 @@ def quantile(data, num_breaks):
     return scipy_mquantiles(data, numpy.linspace(1.0 / num_breaks, 1, num_breaks))
 
 
+def _quantile_positions(n, num_breaks):
+    """
+    Returns the lower (0-based) rank of the two adjacent values each quantile break is interpolated between, and the
+    weight of the upper value, using the same plotting positions as `quantile`.
+    """
+
+    p = numpy.linspace(1.0 / num_breaks, 1, num_breaks)
+    aleph = n * p + .4 + p * .2
+    k = numpy.floor(aleph.clip(1, n - 1)).astype(int)
+
+    return k - 1, (aleph - k).clip(0, 1)
+
+
+def quantile_ranks(n, num_breaks):
+    """
+    Returns the (0-based) ranks of the sorted values which quantile breaks depend on (see `quantile_from_ranks`).
+
+    Arguments:
+    n -- Number of values in the data.
+    num_breaks -- Number of breaks to perform.
+    """
+
+    if n < 2:
+        return numpy.arange(n)
+
+    lower, __ = _quantile_positions(n, num_breaks)
+    return numpy.concatenate((lower, lower + 1))
+
+
+def quantile_from_ranks(select, n, num_breaks):
+    """
+    Calculate the same quantile breaks as `quantile`, for data which isn't held in memory.
+
+    Arguments:
+    select -- Function which returns the values at an array of (0-based) ranks in the sorted data. Only the ranks
+        returned by `quantile_ranks` are selected.
+    n -- Number of values in the data.
+    num_breaks -- Number of breaks to perform.
+    """
+
+    if not n:
+        return []
+    if n == 1:
+        return numpy.resize(select(quantile_ranks(n, num_breaks)), num_breaks)
+
+    __, gamma = _quantile_positions(n, num_breaks)
+    values = select(quantile_ranks(n, num_breaks))
+
+    return (1. - gamma) * values[:num_breaks] + gamma * values[num_breaks:]
+
+
+def quantile_from_histogram(edges, counts, num_breaks, min_value=None, max_value=None):
+    """
+    Calculate approximate quantile breaks from a histogram of the data, assuming values are evenly distributed within
+    each bin. Returns a tuple of the breaks and an error bound: the maximum distance between any approximate break and
+    the corresponding break from `quantile`.
+
+    Arguments:
+    edges -- Histogram bin edges.
+    counts -- Number of values in each bin.
+    num_breaks -- Number of breaks to perform.
+    min_value -- Minimum value of the data, if known. The outer edges can be wider (e.g., if all values are the same).
+    max_value -- Maximum value of the data, if known.
+    """
+
+    edges = numpy.asarray(edges, dtype='float64')
+    if min_value is not None or max_value is not None:
+        edges = edges.clip(min_value, max_value)
+    counts = numpy.asarray(counts, dtype='float64')
+    cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+    n = cumulative[-1]
+
+    if not n:
+        return [], 0.0
+
+    # Fractional (0-based) rank of each break, using the same plotting positions as `quantile`
+    p = numpy.linspace(1.0 / num_breaks, 1, num_breaks)
+    ranks = (n * p + .4 + p * .2).clip(1, n) - 1
+
+    def find_bins(r):
+        return (numpy.searchsorted(cumulative, r, side='right') - 1).clip(0, len(counts) - 1)
+
+    bins = find_bins(ranks)
+    within = ((ranks - cumulative[bins] + 0.5) / numpy.maximum(counts[bins], 1)).clip(0, 1)
+    breaks = edges[bins] + within * (edges[bins + 1] - edges[bins])
+
+    # The first and last values are known exactly
+    breaks[ranks <= 0] = edges[0]
+    breaks[ranks >= n - 1] = edges[-1]
+
+    # The exact break is interpolated between the values on either side of its rank
+    lower = edges[find_bins(numpy.floor(ranks))]
+    upper = edges[find_bins(numpy.ceil(ranks).clip(0, n - 1)) + 1]
+    errors = numpy.maximum(breaks - lower, upper - breaks)
+    errors[(ranks <= 0) | (ranks >= n - 1)] = 0
+
+    return breaks.tolist(), float(errors.max())
+
+
 def equal(data, num_breaks):
     """
     Calculate equal interval breaks.
@@ -140,5 +245,18 @@ def equal(data, num_breaks):
     num_breaks -- Number of breaks to perform.
     """
 
-    step = (numpy.amax(data) - numpy.amin(data)) / num_breaks
-    return numpy.linspace(numpy.amin(data) + step, numpy.amax(data), num_breaks)
+    return equal_from_range(numpy.amin(data), numpy.amax(data), num_breaks)
+
+
+def equal_from_range(min_value, max_value, num_breaks):
+    """
+    Calculate equal interval breaks from a known data range.
+
+    Arguments:
+    min_value -- The minimum data value.
+    max_value -- The maximum data value.
+    num_breaks -- Number of breaks to perform.
+    """
+
+    step = (max_value - min_value) / num_breaks
+    return numpy.linspace(min_value + step, max_value, num_breaks)
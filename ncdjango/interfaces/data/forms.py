@@ -1,8 +1,112 @@
+import csv
+import io
+import json
+
 from django import forms
-from ncdjango.interfaces.arcgis.form_fields import SrField
+from django.conf import settings
+from django.core.exceptions import ValidationError
+import numpy
+
+from ncdjango.interfaces.arcgis.form_fields import BoundingBoxField, SrField, GeometryField, TimeField
+
+MAX_POINTS = getattr(settings, 'NC_MAX_POINTS', 50000)
 
 
 class PointForm(forms.Form):
     x = forms.FloatField()
     y = forms.FloatField()
-    projection = SrField()
\ No newline at end of file
+    projection = SrField()
+
+
+class WindowForm(forms.Form):
+    bbox = BoundingBoxField(required=False)
+    projection = SrField()
+    time = TimeField(required=False)
+
+
+class ZonalStatisticsForm(forms.Form):
+    geometry = GeometryField()
+    geometry_type = forms.CharField()
+    projection = SrField()
+    time = TimeField(required=False)
+    bins = forms.IntegerField(required=False, min_value=1)
+
+    def __init__(self, data, *args, **kwargs):
+        # Pre-process geometry field data
+        if 'geometry_type' in data:
+            data['geometry'] = {
+                'type': data['geometry_type'],
+                'geometry': data.get('geometry', '')
+            }
+
+        super(ZonalStatisticsForm, self).__init__(data, *args, **kwargs)
+
+
+class PointsForm(forms.Form):
+    points = forms.FileField()
+    projection = SrField()
+    format = forms.ChoiceField(
+        choices=(('csv', 'CSV'), ('jsonl', 'JSON lines'), ('binary', 'Binary')), required=False
+    )
+
+    def parse_geojson(self, data):
+        """Returns a list of (id, x, y) tuples from a GeoJSON point, multipoint, feature, or feature collection"""
+
+        if data.get('type') == 'FeatureCollection':
+            features = data['features']
+        elif data.get('type') == 'Feature':
+            features = [data]
+        else:
+            features = [{'geometry': data}]
+
+        points = []
+        for feature in features:
+            geometry = feature['geometry']
+            feature_id = feature.get('id', feature.get('properties', {}).get('id'))
+
+            if geometry['type'] == 'Point':
+                coordinates = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPoint':
+                coordinates = geometry['coordinates']
+            else:
+                raise ValidationError('Only point geometries are supported')
+
+            for x, y in (c[:2] for c in coordinates):
+                points.append((len(points) if feature_id is None else feature_id, float(x), float(y)))
+
+        return points
+
+    def parse_csv(self, text):
+        """Returns a list of (id, x, y) tuples from CSV text with `x`, `y`, and (optionally) `id` columns"""
+
+        reader = csv.DictReader(io.StringIO(text))
+        reader.fieldnames = [x.strip().lower() for x in reader.fieldnames or []]
+
+        if not {'x', 'y'}.issubset(reader.fieldnames):
+            raise ValidationError('CSV must have x and y columns')
+
+        return [(row.get('id', i), float(row['x']), float(row['y'])) for i, row in enumerate(reader)]
+
+    def clean_points(self):
+        """Returns a tuple of (ids, x values, y values)"""
+
+        upload = self.cleaned_data['points']
+
+        try:
+            text = upload.read().decode('utf-8-sig')
+
+            if upload.name.lower().endswith(('.json', '.geojson')) or text.lstrip().startswith('{'):
+                points = self.parse_geojson(json.loads(text))
+            else:
+                points = self.parse_csv(text)
+        except (ValueError, KeyError, TypeError, IndexError):
+            raise ValidationError('Invalid points file')
+
+        if not points:
+            raise ValidationError('No points')
+
+        if len(points) > MAX_POINTS:
+            raise ValidationError('Too many points (the maximum is {})'.format(MAX_POINTS))
+
+        ids, x, y = zip(*points)
+        return list(ids), numpy.array(x), numpy.array(y)
@@ -1,6 +1,8 @@
 from django.urls import re_path, include
 
-from .views import RangeView, ClassifyView, UniqueValuesView, ValuesAtPointView
+from .views import (
+    RangeView, ClassifyView, UniqueValuesView, ValuesAtPointView, ValuesAtPointsView, ZonalStatisticsView
+)
 
 
 urlpatterns = [
@@ -16,6 +18,16 @@ urlpatterns = [
                     ValuesAtPointView.as_view(),
                     name="data_values_at_point",
                 ),
+                re_path(
+                    r"^values-at-points/$",
+                    ValuesAtPointsView.as_view(),
+                    name="data_values_at_points",
+                ),
+                re_path(
+                    r"^zonal-statistics/$",
+                    ZonalStatisticsView.as_view(),
+                    name="data_zonal_statistics",
+                ),
             ]
         ),
     )
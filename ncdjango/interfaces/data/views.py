@@ -1,63 +1,198 @@
+import csv
+import io
 import json
 import math
+import struct
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 import numpy
-from pyproj import Proj
+from pyproj import Proj, Transformer
+from rasterio.features import rasterize
+from rasterio.transform import Affine
+from shapely.geometry import MultiPolygon, Polygon, box
 from shapely.geometry.point import Point
 
 from ncdjango.exceptions import ConfigurationError
-from ncdjango.utils import project_geometry
-from ncdjango.views import ServiceView, NetCdfDatasetMixin
-from .classify import jenks, quantile, equal
-from .forms import PointForm
+from ncdjango.stats import (
+    MAX_STORED_UNIQUE_VALUES, Summary, find_unique_values, get_variable_statistics, valid_values
+)
+from ncdjango.utils import best_fit, project_geometry
+from ncdjango.views import READ_BLOCK_SIZE, ServiceView, NetCdfDatasetMixin
+from .classification import CLASSIFY_METHODS, JENKS_SAMPLE_SIZE, get_classification
+from .classify import equal_from_range, jenks, quantile
+from .forms import PointForm, PointsForm, WindowForm, ZonalStatisticsForm
 
 MAX_UNIQUE_VALUES = getattr(settings, 'NC_MAX_UNIQUE_VALUES', 100)
-
-CLASSIFY_METHODS = {
-    'jenks': jenks,
-    'quantile': quantile,
-    'equal': equal
-}
+ZONAL_HISTOGRAM_BINS = getattr(settings, 'NC_ZONAL_HISTOGRAM_BINS', 10)
+WINDOW_SAMPLE_SIZE = getattr(settings, 'NC_WINDOW_SAMPLE_SIZE', 250000)
 
 
 class DataViewBase(NetCdfDatasetMixin, ServiceView):
     def get_service_name(self, request, *args, **kwargs):
         return kwargs['service_name']
 
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(DataViewBase, self).dispatch(request, *args, **kwargs)
+        except ConfigurationError:
+            return HttpResponseBadRequest()
+
     def get_variable(self):
         return get_object_or_404(self.service.variable_set.all(), name=self.kwargs.get('variable_name'))
 
+    def format_number(self, value):
+        """Returns a JSON-friendly representation of a number, or None for missing values"""
+
+        if value is None or numpy.ma.is_masked(value):
+            return None
+
+        value = float(value)
+        if math.isnan(value):
+            return None
+
+        return int(value) if value.is_integer() else value
+
+    def get_time_indices(self, variable, time_value, default=(0,)):
+        """
+        Returns a list of time indices for a single time value or a (start, end) range. If there is no time value, the
+        `default` indices are returned, or all time indices if `default` is None.
+        """
+
+        if not (self.service.supports_time and variable.supports_time):
+            return [None]
+
+        if not time_value:
+            if default is None:
+                data = self.open_dataset(self.service).variables[variable.variable]
+                return list(range(data.shape[data.dimensions.index(variable.time_dimension)]))
+
+            return list(default)
+
+        if isinstance(time_value, (tuple, list)):
+            start = best_fit(variable.time_stops, time_value[0])
+            end = best_fit(variable.time_stops, time_value[-1])
+            return list(range(start, end + 1))
+
+        return [best_fit(variable.time_stops, time_value)]
+
+    def get_window(self, variable, geometry):
+        """Returns grid (x_slice, y_slice) bounds covering the geometry, and the cell size of the grid"""
+
+        extent = variable.full_extent
+        width, height = self.get_grid_spatial_dimensions(variable)
+        cell_size = (float(extent.width) / width, float(extent.height) / height)
+        xmin, ymin, xmax, ymax = geometry.bounds
+
+        x_start = int(math.floor(float(xmin - extent.xmin) / cell_size[0]))
+        x_stop = int(math.ceil(float(xmax - extent.xmin) / cell_size[0]))
+        y_start = int(math.floor(float(ymin - extent.ymin) / cell_size[1]))
+        y_stop = int(math.ceil(float(ymax - extent.ymin) / cell_size[1]))
+
+        x_slice = (min(max(x_start, 0), width), min(max(x_stop, 0), width))
+        y_slice = (min(max(y_start, 0), height), min(max(y_stop, 0), height))
+
+        if not self.is_y_increasing(variable):
+            y_slice = (height - y_slice[1], height - y_slice[0])
+
+        return x_slice, y_slice, cell_size
+
+    def get_window_values(self, variable, bbox=None, time_value=None):
+        """
+        Returns a tuple of a flat array of the valid values within a bbox, for a time value or range (or all time steps)
+        and the read stride. Large windows are read at a stride along each dimension (including time), so that about
+        `NC_WINDOW_SAMPLE_SIZE` cells are read in total; results computed from these values are estimates if the stride
+        is greater than 1.
+        """
+
+        time_indices = self.get_time_indices(variable, time_value, default=None)
+
+        if bbox is None:
+            width, height = self.get_grid_spatial_dimensions(variable)
+            x_slice, y_slice = (0, width), (0, height)
+        else:
+            x_slice, y_slice, __ = self.get_window(variable, box(bbox.xmin, bbox.ymin, bbox.xmax, bbox.ymax))
+
+        num_cells = (x_slice[1] - x_slice[0]) * (y_slice[1] - y_slice[0]) * len(time_indices)
+        if not num_cells:
+            return numpy.array([]), 1
+
+        num_dimensions = 3 if len(time_indices) > 1 else 2
+        stride = max(int(math.ceil((float(num_cells) / WINDOW_SAMPLE_SIZE) ** (1.0 / num_dimensions))), 1)
+        time_indices = time_indices[::stride]
+
+        values = [
+            valid_values(self.get_grid_for_variable(
+                variable, time_index=time_index, x_slice=x_slice + (stride,), y_slice=y_slice + (stride,)
+            ))
+            for time_index in time_indices
+        ]
+
+        return numpy.concatenate(values), stride
+
+    def get_window_params(self, variable, **kwargs):
+        """
+        Returns a (bbox, time) tuple from `bbox`, `projection` and `time` request parameters, with the bbox projected
+        to the variable's projection. Both are None if not provided.
+        """
+
+        form_params = {'projection': Proj(str(variable.projection))}
+        form_params.update(kwargs)
+        form = WindowForm(form_params)
+        if form.is_valid():
+            form_data = form.cleaned_data
+        else:
+            raise ConfigurationError
+
+        bbox = form_data.get('bbox')
+        if bbox:
+            if bbox.projection is None:
+                bbox.projection = form_data['projection']
+            bbox = bbox.project(Proj(str(variable.projection)))
+
+        return bbox or None, form_data.get('time') or None
+
 
 class RangeView(DataViewBase):
-    """Returns value ranges for a variable in a service"""
+    """
+    Returns value ranges for a variable in a service. If a `bbox` and/or `time` is provided, the range is calculated
+    for only that window, and is an estimate (`approximate` is true) if the window had to be sampled.
+    """
 
     def handle_request(self, request, **kwargs):
         variable = self.get_variable()
-        dataset = self.open_dataset(self.service)
+        bbox, time_value = self.get_window_params(variable, **kwargs)
 
-        try:
-            variable_data = dataset.variables[variable.variable][:]
-            min_value = float(numpy.min(variable_data))
-            max_value = float(numpy.max(variable_data))
+        if bbox is None and time_value is None:
+            statistics = get_variable_statistics(variable)
+            data = {
+                'min': self.format_number(statistics['min']),
+                'max': self.format_number(statistics['max'])
+            }
+        else:
+            try:
+                values, stride = self.get_window_values(variable, bbox, time_value)
+            finally:
+                self.close_dataset()
 
             data = {
-                'min': int(min_value) if min_value.is_integer() else min_value,
-                'max': int(max_value) if max_value.is_integer() else max_value
+                'min': self.format_number(values.min()) if values.size else None,
+                'max': self.format_number(values.max()) if values.size else None,
+                'approximate': stride > 1
             }
 
-            return HttpResponse(json.dumps(data), content_type='application/json')
-        finally:
-            self.close_dataset()
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 class ClassifyView(DataViewBase):
-    """Generates classbreaks for a variable in a service"""
+    """
+    Generates classbreaks for a variable in a service. With `approximate=true`, quantile breaks are calculated from the
+    stored histogram rather than from all values, and the response includes an error bound (`null` if unknown).
+    """
 
     def handle_request(self, request, **kwargs):
-        if kwargs.get('method', '').lower() in ('jenks', 'quantile', 'equal'):
+        if kwargs.get('method', '').lower() in CLASSIFY_METHODS:
             method = kwargs['method'].lower()
         else:
             raise ConfigurationError('Invalid method')
@@ -67,48 +202,88 @@ class ClassifyView(DataViewBase):
         except (ValueError, TypeError):
             raise ConfigurationError('Invalid number of breaks')
 
+        if num_breaks < 1:
+            raise ConfigurationError('Invalid number of breaks')
+
+        approximate = kwargs.get('approximate', '').lower() in ('true', '1')
         variable = self.get_variable()
-        dataset = self.open_dataset(self.service)
+        bbox, time_value = self.get_window_params(variable, **kwargs)
 
-        try:
-            variable_data = dataset.variables[variable.variable][:].ravel()
-            min_value = float(numpy.min(variable_data))
-            classes = CLASSIFY_METHODS[method](variable_data, num_breaks)
-            classes = [int(x) if float(x).is_integer() else x for x in classes]
+        if bbox is None and time_value is None:
+            classification = get_classification(variable, method, num_breaks, approximate)
+        else:
+            classification = self.classify_window(variable, method, num_breaks, bbox, time_value)
+            approximate = True
 
-            data = {
-                'breaks': classes,
-                'min': int(min_value) if min_value.is_integer() else min_value
-            }
+        data = {
+            'breaks': [self.format_number(x) for x in classification['breaks']],
+            'min': self.format_number(classification['min'])
+        }
 
-            return HttpResponse(json.dumps(data), content_type='application/json')
+        if approximate:
+            data['error'] = classification['error']
+
+        return HttpResponse(json.dumps(data), content_type='application/json')
+
+    def classify_window(self, variable, method, num_breaks, bbox, time_value):
+        """
+        Calculates class breaks from the values within a window (see `get_window_values`). The error bound is 0 if all
+        values in the window were read, or None if they were sampled.
+        """
+
+        try:
+            values, stride = self.get_window_values(variable, bbox, time_value)
         finally:
             self.close_dataset()
 
+        if not values.size:
+            breaks = []
+        elif method == 'equal':
+            breaks = equal_from_range(values.min(), values.max(), num_breaks)
+        elif method == 'jenks':
+            breaks = jenks(values, num_breaks, sample_size=JENKS_SAMPLE_SIZE)
+        else:
+            breaks = quantile(numpy.ma.asarray(values), num_breaks)
+
+        return {
+            'breaks': breaks,
+            'min': values.min() if values.size else None,
+            'error': 0.0 if stride == 1 and method != 'jenks' else None
+        }
+
 
 class UniqueValuesView(DataViewBase):
-    """Returns unique values for a variable"""
+    """
+    Returns unique values for a variable. If there are more than `NC_MAX_UNIQUE_VALUES` unique values, the variable is
+    not scanned any further: `complete` is false, `num_values` is a lower bound, and only the first
+    `NC_MAX_UNIQUE_VALUES` of the values found are returned.
+    """
 
     def handle_request(self, request, **kwargs):
         variable = self.get_variable()
-        dataset = self.open_dataset(self.service)
+        statistics = get_variable_statistics(variable)
 
-        try:
-            unique_data = numpy.unique(dataset.variables[variable.variable][:])
-            data = {
-                'num_values': len(unique_data)
-            }
-            if len(unique_data) > MAX_UNIQUE_VALUES:
-                unique_data = unique_data[:MAX_UNIQUE_VALUES]
-            data['values'] = [
-                x for x in
-                (int(x) if float(x).is_integer() else float(x) for x in unique_data)
-                if not math.isnan(x)
-            ]
+        if statistics['unique_values'] is not None:
+            unique_data = statistics['unique_values']
+            is_complete = len(unique_data) <= MAX_UNIQUE_VALUES
+            num_values = len(unique_data)
+        else:
+            unique_values = find_unique_values(variable, MAX_UNIQUE_VALUES)
+            unique_data = [] if unique_values.values is None else unique_values.values.tolist()
+            is_complete = unique_values.is_complete
 
-            return HttpResponse(json.dumps(data), content_type='application/json')
-        finally:
-            self.close_dataset()
+            # Stored statistics only leave out unique values if there are more than `NC_STATISTICS_MAX_UNIQUE_VALUES`
+            num_values = unique_values.count
+            if not is_complete:
+                num_values = max(num_values, MAX_STORED_UNIQUE_VALUES + 1)
+
+        data = {
+            'num_values': num_values,
+            'complete': is_complete,
+            'values': [int(x) if float(x).is_integer() else float(x) for x in unique_data[:MAX_UNIQUE_VALUES]]
+        }
+
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
 
 class ValuesAtPointView(DataViewBase):
@@ -130,29 +305,12 @@ class ValuesAtPointView(DataViewBase):
             Point(form_data['x'], form_data['y']), form_data['projection'], Proj(str(variable.projection))
         )
         data = {'values': []}
-        dataset = self.open_dataset(self.service)
 
         try:
-            dataset_variable = dataset.variables[variable.variable]
-            dimensions = dataset_variable.dimensions
-            shape = [dimensions.index(variable.y_dimension), dimensions.index(variable.x_dimension)]
-
-            if variable.time_dimension:
-                shape.append(dimensions.index(variable.time_dimension))
-
-            skip_dimensions = 0
-            for i, dimension in enumerate(dimensions):
-                if dimension not in (variable.y_dimension, variable.x_dimension, variable.time_dimension):
-                    shape.insert(0, i)
-                    skip_dimensions += 1
-
-            variable_data = dataset.variables[variable.variable][:].transpose(*shape)
-            for __ in range(skip_dimensions):
-                variable_data = variable_data[0]
-
+            width, height = self.get_grid_spatial_dimensions(variable)
             cell_size = (
-                float(variable.full_extent.width) / variable_data.shape[1],
-                float(variable.full_extent.height) / variable_data.shape[0]
+                float(variable.full_extent.width) / width,
+                float(variable.full_extent.height) / height
             )
 
             cell_index = [
@@ -161,15 +319,274 @@ class ValuesAtPointView(DataViewBase):
             ]
 
             if not self.is_y_increasing(variable):
-                cell_index[1] = variable_data.shape[0] - cell_index[1] - 1
+                cell_index[1] = height - cell_index[1] - 1
 
-            if variable_data.shape[1] > cell_index[0] >= 0 and variable_data.shape[0] > cell_index[1] >= 0:
-                variable_data = variable_data[cell_index[1], cell_index[0]]
+            if width > cell_index[0] >= 0 and height > cell_index[1] >= 0:
                 data['values'] = [
-                    None if math.isnan(x) else x for x in
-                    (int(x) if float(x).is_integer() else float(x) for x in variable_data)
+                    self.format_number(x) for x in self.get_values_at_cell(variable, cell_index[0], cell_index[1])
                 ]
 
             return HttpResponse(json.dumps(data), content_type='application/json')
         finally:
             self.close_dataset()
+
+
+class ValuesAtPointsView(DataViewBase):
+    """
+    Returns all values (through time) at each of a set of uploaded points (a CSV or GeoJSON file). Points are read in
+    groups which share a chunk of the dataset, and results are streamed back in that order as CSV, JSON lines, or
+    binary. Points outside the grid have no values.
+
+    The binary format is a header of the magic bytes `NCPV`, the size of each value in bytes (uint8, 4 or 8), three
+    padding bytes, and the number of time steps (uint32), followed by one record per point: the index of the point in
+    the upload (int32) and its values (float32 or float64, with NaN for missing values). All numbers are little-endian.
+    """
+
+    form_class = PointsForm
+
+    CONTENT_TYPES = {
+        'csv': 'text/csv',
+        'jsonl': 'application/x-ndjson',
+        'binary': 'application/octet-stream'
+    }
+
+    def get_cell_indices(self, variable, x, y):
+        """Returns (column, row) index arrays for points in the variable's projection, and a mask of points in grid"""
+
+        extent = variable.full_extent
+        width, height = self.get_grid_spatial_dimensions(variable)
+
+        columns = numpy.floor((x - extent.xmin) / (float(extent.width) / width)).astype('int64')
+        rows = numpy.floor((y - extent.ymin) / (float(extent.height) / height)).astype('int64')
+
+        if not self.is_y_increasing(variable):
+            rows = height - rows - 1
+
+        return columns, rows, (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+
+    def get_tile_shape(self, variable, num_times):
+        """
+        Returns the (rows, columns) of a tile of points to read at once: a single chunk, reduced if necessary to keep
+        the values for all time steps within `NC_READ_BLOCK_SIZE`
+        """
+
+        rows, columns = self.get_time_series_chunk_shape(variable)
+        itemsize = self.open_dataset(self.service).variables[variable.variable].dtype.itemsize
+
+        while num_times * rows * columns * itemsize > READ_BLOCK_SIZE and rows * columns > 1:
+            if rows >= columns:
+                rows = (rows + 1) // 2
+            else:
+                columns = (columns + 1) // 2
+
+        return rows, columns
+
+    def iter_point_values(self, variable, columns, rows, in_grid, num_times):
+        """
+        Yields `(indices, values)` tuples, where `indices` is an array of point indices and `values` is a masked
+        (points, time) array. Points outside the grid come first, followed by points grouped by tile.
+        """
+
+        outside = numpy.flatnonzero(~in_grid)
+        if outside.size:
+            yield outside, numpy.ma.masked_all((outside.size, num_times))
+
+        inside = numpy.flatnonzero(in_grid)
+        if not inside.size:
+            return
+
+        tile_rows, tile_columns = self.get_tile_shape(variable, num_times)
+        width = self.get_grid_spatial_dimensions(variable)[0]
+        tiles = (rows[inside] // tile_rows) * (width // tile_columns + 1) + columns[inside] // tile_columns
+
+        order = numpy.argsort(tiles, kind='stable')
+        inside, tiles = inside[order], tiles[order]
+
+        for group in numpy.split(inside, numpy.flatnonzero(numpy.diff(tiles)) + 1):
+            group_columns, group_rows = columns[group], rows[group]
+            x_start, y_start = group_columns.min(), group_rows.min()
+
+            window = self.get_time_series_window(
+                variable, (x_start, group_columns.max() + 1), (y_start, group_rows.max() + 1)
+            )
+            values = numpy.ma.asarray(window)[:, group_rows - y_start, group_columns - x_start].T
+
+            if values.dtype.kind == 'f':
+                values = numpy.ma.masked_invalid(values)
+
+            yield group, values
+
+    def iter_csv(self, ids, x, y, point_values, num_times, dtype):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['id', 'x', 'y'] + ['value_{}'.format(i) for i in range(num_times)])
+
+        for indices, values in point_values:
+            for i, row in zip(indices, values.tolist()):
+                writer.writerow([ids[i], x[i], y[i]] + row)
+
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    def iter_jsonl(self, ids, x, y, point_values, num_times, dtype):
+        for indices, values in point_values:
+            yield ''.join(
+                json.dumps({'id': ids[i], 'x': x[i], 'y': y[i], 'values': row}) + '\n'
+                for i, row in zip(indices, values.tolist())
+            )
+
+    def iter_binary(self, ids, x, y, point_values, num_times, dtype):
+        value_type = numpy.result_type(dtype, numpy.float32).newbyteorder('<')
+        record_type = numpy.dtype([('index', '<i4'), ('values', value_type, (num_times,))])
+
+        yield struct.pack('<4sB3xI', b'NCPV', value_type.itemsize, num_times)
+
+        for indices, values in point_values:
+            records = numpy.empty(len(indices), dtype=record_type)
+            records['index'] = indices
+            records['values'] = values.astype('float64').filled(numpy.nan)
+            yield records.tobytes()
+
+    def handle_request(self, request, **kwargs):
+        variable = self.get_variable()
+        form_params = {'projection': Proj(str(variable.projection))}
+        form_params.update(kwargs)
+        form = self.form_class(form_params, request.FILES)
+        if form.is_valid():
+            form_data = form.cleaned_data
+        else:
+            raise ConfigurationError
+
+        try:
+            ids, x, y = form_data['points']
+            output_format = form_data.get('format') or 'csv'
+            transformer = Transformer.from_proj(form_data['projection'], Proj(str(variable.projection)))
+            columns, rows, in_grid = self.get_cell_indices(variable, *transformer.transform(x, y))
+
+            data = self.open_dataset(self.service).variables[variable.variable]
+            if variable.time_dimension in data.dimensions:
+                num_times = data.shape[data.dimensions.index(variable.time_dimension)]
+            else:
+                num_times = 1
+
+            # Values are returned with scaling applied
+            dtype = numpy.result_type(data.dtype, *(
+                numpy.asarray(getattr(data, k)).dtype for k in ('scale_factor', 'add_offset') if k in data.ncattrs()
+            ))
+            serialize = getattr(self, 'iter_{}'.format(output_format))
+        except:
+            # The dataset is closed by the response once it starts, but not if the request fails first
+            self.close_dataset()
+            raise
+
+        def iter_response():
+            try:
+                point_values = self.iter_point_values(variable, columns, rows, in_grid, num_times)
+                for content in serialize(ids, x.tolist(), y.tolist(), point_values, num_times, dtype):
+                    yield content
+            finally:
+                self.close_dataset()
+
+        return StreamingHttpResponse(iter_response(), content_type=self.CONTENT_TYPES[output_format])
+
+
+class ZonalStatisticsView(DataViewBase):
+    """Returns summary statistics for the values of a variable within a polygon, for one or more time steps"""
+
+    form_class = ZonalStatisticsForm
+
+    def get_zone(self, variable, geometry, x_slice, y_slice, cell_size):
+        """Rasterizes the geometry onto the grid window. Returns a boolean array which is True within the zone."""
+
+        extent = variable.full_extent
+        y_increasing = self.is_y_increasing(variable)
+
+        if y_increasing:
+            top = extent.ymin + y_slice[1] * cell_size[1]
+        else:
+            top = extent.ymax - y_slice[0] * cell_size[1]
+
+        transform = Affine(cell_size[0], 0, extent.xmin + x_slice[0] * cell_size[0], 0, -cell_size[1], top)
+        # Include every cell touched by the geometry, so polygons smaller than a cell still have values
+        zone = rasterize(
+            [(geometry, 1)], out_shape=(y_slice[1] - y_slice[0], x_slice[1] - x_slice[0]), transform=transform,
+            fill=0, all_touched=True, dtype='uint8'
+        ).astype(bool)
+
+        # Rasterized rows run top to bottom; flip them to match grids with increasing y values
+        return zone[::-1] if y_increasing else zone
+
+    def iter_zone_values(self, variable, zone, time_indices, x_slice, y_slice):
+        """Yields 1D arrays of valid values within the zone, one grid block at a time"""
+
+        for time_index in time_indices:
+            for y_offset, block in self.iter_grid_blocks(variable, time_index, x_slice, y_slice):
+                values = valid_values(block[zone[y_offset:y_offset + block.shape[0]]])
+
+                if values.size:
+                    yield values
+
+    def handle_request(self, request, **kwargs):
+        variable = self.get_variable()
+        form_params = {'projection': Proj(str(variable.projection)), 'geometry_type': 'esriGeometryPolygon'}
+        form_params.update(kwargs)
+        form = self.form_class(form_params)
+        if form.is_valid():
+            form_data = form.cleaned_data
+        else:
+            raise ConfigurationError
+
+        geometry = project_geometry(form_data['geometry'], form_data['projection'], Proj(str(variable.projection)))
+        if not isinstance(geometry, (Polygon, MultiPolygon)):
+            raise ConfigurationError('Zonal statistics require a polygon geometry')
+
+        num_bins = form_data.get('bins') or ZONAL_HISTOGRAM_BINS
+        data = {
+            'count': 0,
+            'min': None,
+            'max': None,
+            'mean': None,
+            'std': None,
+            'histogram': {'bins': [], 'counts': []}
+        }
+
+        self.open_dataset(self.service)
+
+        try:
+            time_indices = self.get_time_indices(variable, form_data.get('time'))
+            x_slice, y_slice, cell_size = self.get_window(variable, geometry)
+
+            if x_slice[1] <= x_slice[0] or y_slice[1] <= y_slice[0]:
+                return HttpResponse(json.dumps(data), content_type='application/json')
+
+            zone = self.get_zone(variable, geometry, x_slice, y_slice, cell_size)
+
+            summary = Summary()
+
+            for values in self.iter_zone_values(variable, zone, time_indices, x_slice, y_slice):
+                summary.update(values)
+
+            if summary.count:
+                counts = numpy.zeros(num_bins, dtype='int64')
+                bins = numpy.histogram_bin_edges([], bins=num_bins, range=(summary.min, summary.max))
+
+                # Second pass to fill the histogram, now that the range is known
+                for values in self.iter_zone_values(variable, zone, time_indices, x_slice, y_slice):
+                    counts += numpy.histogram(values, bins=bins)[0]
+
+                data.update({
+                    'count': summary.count,
+                    'min': self.format_number(summary.min),
+                    'max': self.format_number(summary.max),
+                    'mean': self.format_number(summary.mean),
+                    'std': self.format_number(summary.std),
+                    'histogram': {
+                        'bins': [self.format_number(x) for x in bins],
+                        'counts': counts.tolist()
+                    }
+                })
+
+            return HttpResponse(json.dumps(data), content_type='application/json')
+        finally:
+            self.close_dataset()
@@ -0,0 +1,22 @@
+from django.core.management import BaseCommand
+
+from ncdjango.interfaces.data.classification import warm_classification_cache
+from ncdjango.models import Variable
+from ncdjango.stats import update_variable_statistics
+
+
+class Command(BaseCommand):
+    help = 'Compute and store statistics, and warm the classification cache, for variables whose data has changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('services', nargs='*', help='Service names (defaults to all services)')
+        parser.add_argument('--force', action='store_true', help='Recompute statistics even if they are current')
+
+    def handle(self, *args, **options):
+        variables = Variable.objects.all().select_related('service')
+        if options['services']:
+            variables = variables.filter(service__name__in=options['services'])
+
+        for variable in variables:
+            update_variable_statistics(variable, force=options['force'])
+            warm_classification_cache(variable)
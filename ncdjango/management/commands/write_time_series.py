@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from ncdjango.models import Variable
+from ncdjango.timeseries import write_time_series
+
+
+class Command(BaseCommand):
+    help = 'Write time-series-optimized copies of service variables whose data has changed.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('services', nargs='*', help='Service names (defaults to all services)')
+        parser.add_argument('--force', action='store_true', help='Rewrite copies even if they are current')
+
+    def handle(self, *args, **options):
+        variables = Variable.objects.exclude(time_dimension=None).select_related('service')
+        if options['services']:
+            variables = variables.filter(service__name__in=options['services'])
+
+        for variable in variables:
+            write_time_series(variable, force=options['force'])
@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ncdjango', '0003_auto_20151230_0954'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VariableStatistics',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data_version', models.CharField(max_length=100)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('statistics', models.TextField(default='{}')),
+                ('variable', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='statistics', to='ncdjango.Variable')),
+            ],
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ncdjango', '0004_variablestatistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingjob',
+            name='profile',
+            field=models.TextField(default='{}'),
+        ),
+    ]
@@ -1,12 +1,13 @@
 import calendar
 import datetime
 import logging
+import os
 import uuid
 
 from celery.result import AsyncResult
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 
 from .fields import BoundingBoxField, RasterRendererField
 from .utils import auto_memoize
@@ -16,6 +17,8 @@ logger = logging.getLogger(__name__)
 SERVICE_DATA_ROOT = getattr(settings, "NC_SERVICE_DATA_ROOT", "services/")
 TEMPORARY_FILE_LOCATION = getattr(settings, 'NC_TEMPORARY_FILE_LOCATION', 'temp')
 USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
+PRECOMPUTE_STATISTICS = getattr(settings, 'NC_PRECOMPUTE_STATISTICS', False)
+PRECOMPUTE_TIME_SERIES = getattr(settings, 'NC_PRECOMPUTE_TIME_SERIES', False)
 
 
 class Service(models.Model):
@@ -69,6 +72,17 @@ class Service(models.Model):
 
         return super(Service, self).save(*args, **kwargs)
 
+    @property
+    def data_version(self):
+        """ An identifier for the current version of the data file, derived from its modification time and size. """
+
+        try:
+            stat = os.stat(os.path.join(settings.MEDIA_ROOT, self.data_path))
+        except OSError:
+            return None
+
+        return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
 
 class Variable(models.Model):
     """
@@ -156,6 +170,12 @@ class Variable(models.Model):
             # TODO
             raise NotImplementedError
 
+    @property
+    def time_series_path(self):
+        """ Path to the time-series-optimized copy of this variable's data (which may not exist). """
+
+        return '{}.{}.timeseries.nc'.format(os.path.join(settings.MEDIA_ROOT, self.service.data_path), self.variable)
+
     def save(self, *args, **kwargs):
         has_required_time_fields = (self.time_dimension and self.time_start and self.time_end)
         if self.supports_time and not has_required_time_fields:
@@ -164,6 +184,40 @@ class Variable(models.Model):
         return super(Variable, self).save(*args, **kwargs)
 
 
+class VariableStatistics(models.Model):
+    """
+    Statistics for a variable, computed from the full dataset. Stored statistics are only valid for the version of the
+    data file they were computed from.
+    """
+
+    variable = models.OneToOneField(Variable, on_delete=models.CASCADE, related_name='statistics')
+    data_version = models.CharField(max_length=100)
+    updated = models.DateTimeField(auto_now=True)
+    statistics = models.TextField(null=False, default="{}")
+
+    @property
+    def is_current(self):
+        """ Were these statistics computed from the current version of the data file? False if the file is missing. """
+
+        data_version = self.variable.service.data_version
+        return data_version is not None and self.data_version == data_version
+
+
+def variable_saved(sender, instance, **kwargs):
+    if PRECOMPUTE_STATISTICS:
+        from .tasks import update_variable_statistics
+
+        transaction.on_commit(lambda: update_variable_statistics.delay(instance.pk))
+
+    if PRECOMPUTE_TIME_SERIES and instance.time_dimension:
+        from .tasks import write_time_series
+
+        transaction.on_commit(lambda: write_time_series.delay(instance.pk))
+
+
+models.signals.post_save.connect(variable_saved, sender=Variable)
+
+
 class TemporaryFile(models.Model):
     """A temporary file upload"""
 
@@ -203,6 +257,7 @@ class ProcessingJob(models.Model):
     celery_id = models.CharField(max_length=100)
     inputs = models.TextField(null=False, default="{}")
     outputs = models.TextField(null=False, default="{}")
+    profile = models.TextField(null=False, default="{}")  # Execution profile (see `JobProfile`)
 
     @property
     def status(self):
@@ -0,0 +1,487 @@
+import json
+import logging
+import time
+
+import numpy
+from django.conf import settings
+
+from .models import VariableStatistics
+from .views import NetCdfDatasetMixin
+
+logger = logging.getLogger(__name__)
+
+HISTOGRAM_BINS = getattr(settings, 'NC_STATISTICS_HISTOGRAM_BINS', 1024)
+MAX_STORED_UNIQUE_VALUES = getattr(settings, 'NC_STATISTICS_MAX_UNIQUE_VALUES', 1000)
+MEMORY_LIMIT = getattr(settings, 'NC_STATISTICS_MEMORY_LIMIT', 256 * 1024 * 1024)  # 256 MB
+
+
+def valid_values(data):
+    """Returns a flat array of the values in `data` which are neither masked nor NaN"""
+
+    values = numpy.ma.compressed(data)
+
+    if values.dtype.kind == 'f':
+        values = values[~numpy.isnan(values)]
+
+    return values
+
+
+class Summary(object):
+    """
+    Accumulates count, min, max, mean, and variance over blocks of values. Blocks are merged using the parallel form of
+    Welford's algorithm (Chan et al.), which is numerically stable regardless of the number or size of blocks.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min = None
+        self.max = None
+        self._mean = 0.0
+        self._m2 = 0.0  # Sum of squared differences from the mean
+
+    def _merge(self, count, mean, m2, min_value, max_value):
+        total = self.count + count
+        delta = mean - self._mean
+
+        self._mean += delta * count / total
+        self._m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+
+        self.min = min_value if self.min is None else min(self.min, min_value)
+        self.max = max_value if self.max is None else max(self.max, max_value)
+
+    def update(self, values):
+        """Adds a block of values. `values` should be a flat array of valid values (see `valid_values`)"""
+
+        if not values.size:
+            return
+
+        values = values.astype('float64', copy=False)
+        mean = values.mean()
+        m2 = numpy.square(values - mean).sum()
+
+        self._merge(values.size, mean, m2, values.min(), values.max())
+
+    def merge(self, other):
+        """Merges the values summarized by another `Summary` object into this one"""
+
+        if other.count:
+            self._merge(other.count, other._mean, other._m2, other.min, other.max)
+
+    @property
+    def mean(self):
+        return float(self._mean) if self.count else None
+
+    @property
+    def variance(self):
+        return float(self._m2 / self.count) if self.count else None
+
+    @property
+    def std(self):
+        return float(numpy.sqrt(self._m2 / self.count)) if self.count else None
+
+    def as_dict(self):
+        return {
+            'count': int(self.count),
+            'min': None if self.min is None else float(self.min),
+            'max': None if self.max is None else float(self.max),
+            'mean': self.mean,
+            'std': self.std
+        }
+
+
+class UniqueValues(object):
+    """
+    Accumulates the sorted unique values of blocks of values, until there are more than `limit` of them. Integer
+    blocks spanning a small range of values are counted with `bincount` rather than sorted.
+    """
+
+    BINCOUNT_RANGE = 2 ** 16
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.values = None
+        self.is_complete = True
+
+    def update(self, values):
+        """
+        Adds a block of values. `values` should be a flat array of valid values (see `valid_values`). Returns False once
+        the limit has been exceeded, after which further blocks are ignored.
+        """
+
+        if not self.is_complete:
+            return False
+
+        if not values.size:
+            return True
+
+        if values.dtype.kind in 'iu' and int(values.max()) - int(values.min()) < self.BINCOUNT_RANGE:
+            offset = int(values.min())
+            present = numpy.flatnonzero(numpy.bincount((values - offset).astype('intp')))
+            block_values = (present + offset).astype(values.dtype)
+        else:
+            block_values = numpy.unique(values)
+
+        self.values = block_values if self.values is None else numpy.union1d(self.values, block_values)
+
+        if len(self.values) > self.limit:
+            self.is_complete = False
+
+        return self.is_complete
+
+    @property
+    def count(self):
+        """The number of unique values found (a lower bound if the limit has been exceeded)"""
+
+        return 0 if self.values is None else len(self.values)
+
+
+def get_block_elements(dtype, memory_limit=MEMORY_LIMIT):
+    """
+    Returns the number of elements of a given type which can be read in a single block, such that the block plus the
+    temporaries created while summarizing it (compressed and float64 copies, masks) stay within `memory_limit` bytes.
+    """
+
+    itemsize = numpy.dtype(dtype).itemsize
+    return max(memory_limit // (2 * itemsize + 18), 1)
+
+
+def summarize_array(arr, memory_limit=MEMORY_LIMIT):
+    """Returns a `Summary` of the valid values of an in-memory array, processed in blocks along the first axis"""
+
+    summary = Summary()
+
+    if not arr.size:
+        return summary
+
+    row_elements = max(arr.size // arr.shape[0], 1) if arr.ndim else 1
+    rows = max(get_block_elements(arr.dtype, memory_limit) // row_elements, 1)
+
+    if not arr.ndim:
+        summary.update(valid_values(arr))
+    else:
+        for i in range(0, arr.shape[0], rows):
+            summary.update(valid_values(arr[i:i + rows]))
+
+    return summary
+
+
+class VariableReader(NetCdfDatasetMixin):
+    """Provides access to the data for a service's variables outside of a request"""
+
+    def __init__(self, service):
+        super(VariableReader, self).__init__()
+
+        self.service = service
+
+    def get_time_indices(self, variable):
+        """Returns the time indices of a variable, or `[None]` if the variable doesn't have a time dimension"""
+
+        data = self.open_dataset(self.service).variables[variable.variable]
+
+        if variable.time_dimension and variable.time_dimension in data.dimensions:
+            return list(range(data.shape[data.dimensions.index(variable.time_dimension)]))
+
+        return [None]
+
+    def iter_blocks(self, variable, memory_limit=MEMORY_LIMIT):
+        """
+        Yields `(time_start, block)` tuples covering all of the data for a variable. Blocks span the full x dimension,
+        and are aligned to the variable's chunking along the time and y dimensions. Blocks are sized to stay within
+        `memory_limit` (see `get_block_elements`). The dimensions of each block are in the variable's native order,
+        except that time is always the first axis (with length 1 if the variable has no time dimension). Other,
+        non-spatial dimensions are fixed at their first index.
+        """
+
+        data = self.open_dataset(self.service).variables[variable.variable]
+        dimensions = list(data.dimensions)
+        shape = dict(zip(dimensions, data.shape))
+
+        has_time = variable.time_dimension in dimensions
+        chunking = data.chunking()
+        if chunking == 'contiguous' or chunking is None:
+            chunk_sizes = {}
+        else:
+            chunk_sizes = dict(zip(dimensions, chunking))
+
+        width = shape[variable.x_dimension]
+        height = shape[variable.y_dimension]
+        num_times = shape[variable.time_dimension] if has_time else 1
+        time_chunk = chunk_sizes.get(variable.time_dimension, 1) if has_time else 1
+        y_chunk = chunk_sizes.get(variable.y_dimension, 1)
+
+        block_elements = get_block_elements(data.dtype, memory_limit)
+        grid_elements = width * height
+
+        if grid_elements * time_chunk <= block_elements:
+            # Whole grids fit: read as many time chunks at once as possible
+            block_times = max(block_elements // (grid_elements * time_chunk), 1) * time_chunk
+            block_rows = height
+        else:
+            block_times = time_chunk if width * y_chunk * time_chunk <= block_elements else 1
+            block_rows = max(block_elements // (width * y_chunk * block_times), 1) * y_chunk
+
+        for time_start in range(0, num_times, block_times):
+            time_stop = min(time_start + block_times, num_times)
+
+            for y_start in range(0, height, block_rows):
+                y_stop = min(y_start + block_rows, height)
+
+                slices = []
+                for dimension in dimensions:
+                    if dimension == variable.x_dimension:
+                        slices.append(slice(None))
+                    elif dimension == variable.y_dimension:
+                        slices.append(slice(y_start, y_stop))
+                    elif has_time and dimension == variable.time_dimension:
+                        slices.append(slice(time_start, time_stop))
+                    else:
+                        slices.append(0)
+
+                block = data[tuple(slices)]
+
+                if has_time:
+                    time_axis = [d for d in dimensions if d in (
+                        variable.time_dimension, variable.y_dimension, variable.x_dimension
+                    )].index(variable.time_dimension)
+                    block = numpy.moveaxis(block, time_axis, 0)
+                else:
+                    block = block[numpy.newaxis]
+
+                yield time_start, block
+
+
+def compute_statistics(variable, bins=HISTOGRAM_BINS, memory_limit=MEMORY_LIMIT):
+    """
+    Computes global and per-time-step statistics for a variable, plus a histogram of all values and, if there are not
+    too many of them, the unique values. Data is read in bounded blocks (see `VariableReader.iter_blocks`), in two
+    passes: the first to find the data range and the second to fill the histogram.
+    """
+
+    start = time.time()
+    reader = VariableReader(variable.service)
+
+    try:
+        time_indices = reader.get_time_indices(variable)
+        summary = Summary()
+        time_step_summaries = [Summary() for __ in time_indices]
+        unique_values = UniqueValues(MAX_STORED_UNIQUE_VALUES)
+
+        for time_start, block in reader.iter_blocks(variable, memory_limit):
+            for i, grid in enumerate(block):
+                values = valid_values(grid)
+                time_step_summaries[time_start + i].update(values)
+                unique_values.update(values)
+
+        for time_step_summary in time_step_summaries:
+            summary.merge(time_step_summary)
+
+        if summary.count:
+            edges = numpy.histogram_bin_edges([], bins=bins, range=(summary.min, summary.max))
+            counts = numpy.zeros(bins, dtype='int64')
+
+            for __, block in reader.iter_blocks(variable, memory_limit):
+                counts += numpy.histogram(valid_values(block), bins=edges)[0]
+        else:
+            edges = counts = numpy.array([])
+
+        statistics = summary.as_dict()
+        statistics['histogram'] = {'bins': edges.tolist(), 'counts': counts.tolist()}
+        if unique_values.is_complete:
+            statistics['unique_values'] = [] if unique_values.values is None else unique_values.values.tolist()
+        else:
+            statistics['unique_values'] = None
+
+        if time_indices != [None]:
+            statistics['time_steps'] = [x.as_dict() for x in time_step_summaries]
+
+        return statistics
+    finally:
+        reader.close_dataset()
+        logger.info('Computed statistics for {}:{} in {:.3f} seconds'.format(
+            variable.service.name, variable.variable, time.time() - start
+        ))
+
+
+def read_valid_values(variable, memory_limit=MEMORY_LIMIT):
+    """
+    Returns a flat array of all valid values for a variable. The full variable is never loaded at once, but the result
+    holds every valid value, so this should only be used when all values are required (e.g., exact quantiles).
+    """
+
+    reader = VariableReader(variable.service)
+
+    try:
+        blocks = [valid_values(block) for __, block in reader.iter_blocks(variable, memory_limit)]
+        return numpy.concatenate(blocks) if blocks else numpy.array([])
+    finally:
+        reader.close_dataset()
+
+
+def select_values(variable, ranks, min_value, max_value, count, bins=HISTOGRAM_BINS, memory_limit=MEMORY_LIMIT):
+    """
+    Returns the values at the given (0-based) ranks in the sorted valid values of a variable, as a float64 array.
+    `min_value`, `max_value` and `count` describe the valid values (see `get_variable_statistics`).
+
+    Rather than sorting every value, each rank is narrowed down to a range of values by counting the values in a
+    histogram over its current range, one pass over the data per refinement, until the values in all of the ranges fit
+    within `memory_limit`. Those values are then read and sorted. Each pass reads the data in bounded blocks (see
+    `VariableReader.iter_blocks`).
+    """
+
+    capacity = get_block_elements('float64', memory_limit)
+
+    # Half-open ranges of values, (low, high, number of values below low), with the ranks and number of values in each
+    intervals = {(float(min_value), float(numpy.nextafter(max_value, numpy.inf)), 0): (sorted(set(ranks)), count)}
+    found = {}
+    reader = VariableReader(variable.service)
+
+    def iter_values():
+        for __, block in reader.iter_blocks(variable, memory_limit):
+            yield valid_values(block).astype('float64', copy=False)
+
+    try:
+        while sum(x[1] for x in intervals.values()) > capacity:
+            edges = {x: numpy.unique(numpy.linspace(x[0], x[1], bins + 1)) for x in intervals}
+            counts = {x: numpy.zeros(len(edges[x]) - 1, dtype='int64') for x in intervals}
+
+            for values in iter_values():
+                for (low, high, below), interval_edges in edges.items():
+                    inside = values[(values >= low) & (values < high)]
+                    bin_indices = numpy.searchsorted(interval_edges, inside, side='right') - 1
+                    counts[(low, high, below)] += numpy.bincount(bin_indices, minlength=len(interval_edges) - 1)
+
+            refined = {}
+            for (low, high, below), (interval_ranks, __) in intervals.items():
+                interval_edges = edges[(low, high, below)]
+                cumulative = numpy.concatenate(([0], numpy.cumsum(counts[(low, high, below)]))) + below
+
+                for rank in interval_ranks:
+                    i = numpy.searchsorted(cumulative, rank, side='right') - 1
+                    bin_low, bin_high = float(interval_edges[i]), float(interval_edges[i + 1])
+
+                    if numpy.nextafter(bin_low, numpy.inf) >= bin_high:
+                        # The range can't be narrowed any further, so every value in it is the same
+                        found[rank] = bin_low
+                    else:
+                        key = (bin_low, bin_high, int(cumulative[i]))
+                        refined.setdefault(key, ([], int(cumulative[i + 1] - cumulative[i])))[0].append(rank)
+
+            intervals = refined
+
+        if intervals:
+            selected = {x: [] for x in intervals}
+
+            for values in iter_values():
+                for low, high, below in intervals:
+                    selected[(low, high, below)].append(values[(values >= low) & (values < high)])
+
+            for (low, high, below), (interval_ranks, __) in intervals.items():
+                values = numpy.sort(numpy.concatenate(selected[(low, high, below)]))
+                found.update((rank, values[rank - below]) for rank in interval_ranks)
+
+        return numpy.array([found[rank] for rank in ranks], dtype='float64')
+    finally:
+        reader.close_dataset()
+
+
+def find_unique_values(variable, limit, memory_limit=MEMORY_LIMIT):
+    """
+    Returns a `UniqueValues` object with the unique values for a variable, read in bounded blocks (see
+    `VariableReader.iter_blocks`). Reading stops as soon as more than `limit` unique values have been found.
+    """
+
+    unique_values = UniqueValues(limit)
+    reader = VariableReader(variable.service)
+
+    try:
+        for __, block in reader.iter_blocks(variable, memory_limit):
+            if not unique_values.update(valid_values(block)):
+                break
+
+        return unique_values
+    finally:
+        reader.close_dataset()
+
+
+def sample_values(variable, size, total=None, seed=0, memory_limit=MEMORY_LIMIT):
+    """
+    Returns a random sample of up to `size` valid values for a variable, read in bounded blocks (see
+    `VariableReader.iter_blocks`). If the total number of valid values is known, the sample is stratified across
+    blocks: each block contributes in proportion to its share of the values. Otherwise, a reservoir sample is kept.
+    The same seed always gives the same sample for the same data.
+    """
+
+    rng = numpy.random.default_rng(seed)
+    reader = VariableReader(variable.service)
+
+    try:
+        if total is not None:
+            if total <= size:
+                return read_valid_values(variable, memory_limit)
+
+            samples = []
+            seen = 0
+            taken = 0
+
+            for __, block in reader.iter_blocks(variable, memory_limit):
+                values = valid_values(block)
+                seen += values.size
+
+                # Cumulative rounding keeps the total sample size exact
+                quota = min(int(round(size * seen / total)) - taken, values.size)
+                if quota > 0:
+                    samples.append(rng.choice(values, quota, replace=False))
+                    taken += quota
+
+            return numpy.concatenate(samples) if samples else numpy.array([])
+
+        reservoir = None
+        seen = 0
+
+        for __, block in reader.iter_blocks(variable, memory_limit):
+            values = valid_values(block)
+
+            if reservoir is None:
+                reservoir = numpy.empty(size, dtype=values.dtype)
+
+            # Fill any remaining space in the reservoir directly
+            fill = min(size - min(seen, size), values.size)
+            reservoir[seen:seen + fill] = values[:fill]
+
+            # Then replace existing items with decreasing probability (Vitter's algorithm R), vectorized over the block
+            if fill < values.size:
+                positions = rng.integers(0, numpy.arange(seen + fill, seen + values.size) + 1)
+                replace = positions < size
+                reservoir[positions[replace]] = values[fill:][replace]
+
+            seen += values.size
+
+        return numpy.array([]) if reservoir is None else reservoir[:min(seen, size)]
+    finally:
+        reader.close_dataset()
+
+
+def update_variable_statistics(variable, force=False):
+    """
+    Computes and stores statistics for a variable, unless statistics for the current version of the data file are
+    already stored. Returns the `VariableStatistics` object.
+    """
+
+    try:
+        stored = variable.statistics
+    except VariableStatistics.DoesNotExist:
+        stored = VariableStatistics(variable=variable)
+
+    if force or stored.pk is None or not stored.is_current:
+        stored.statistics = json.dumps(compute_statistics(variable))
+        stored.data_version = variable.service.data_version
+        stored.save()
+
+    return stored
+
+
+def get_variable_statistics(variable):
+    """Returns statistics for a variable as a dictionary, computing and storing them first if necessary"""
+
+    return json.loads(update_variable_statistics(variable).statistics)
@@ -1 +1,22 @@
+from celery import shared_task
+
 from ncdjango.geoprocessing.celery_tasks import *
+
+
+@shared_task
+def update_variable_statistics(variable_id, force=False):
+    from ncdjango.interfaces.data.classification import warm_classification_cache
+    from ncdjango.models import Variable
+    from ncdjango.stats import update_variable_statistics
+
+    variable = Variable.objects.get(pk=variable_id)
+    update_variable_statistics(variable, force=force)
+    warm_classification_cache(variable)
+
+
+@shared_task
+def write_time_series(variable_id, force=False):
+    from ncdjango.models import Variable
+    from ncdjango.timeseries import write_time_series
+
+    write_time_series(Variable.objects.get(pk=variable_id), force=force)
@@ -0,0 +1,121 @@
+import logging
+import os
+import time
+
+import netCDF4
+from django.conf import settings
+
+from .stats import MEMORY_LIMIT, VariableReader, get_block_elements
+
+logger = logging.getLogger(__name__)
+
+TIME_SERIES_CHUNK_SIZE = getattr(settings, 'NC_TIME_SERIES_CHUNK_SIZE', 16)
+
+# Attributes which affect how values are masked or scaled, and so are copied along with the data
+COPY_ATTRIBUTES = ('scale_factor', 'add_offset', 'missing_value', 'valid_min', 'valid_max', 'valid_range')
+
+
+def open_time_series(variable):
+    """
+    Opens and returns the time series copy of a variable's data, or returns None if there is no copy or it was made
+    from a different version of the data file.
+    """
+
+    if not os.path.exists(variable.time_series_path):
+        return None
+
+    data_version = variable.service.data_version
+    dataset = netCDF4.Dataset(variable.time_series_path, 'r')
+
+    if data_version is None or getattr(dataset, 'source_version', None) != data_version:
+        dataset.close()
+        return None
+
+    return dataset
+
+
+def is_time_series_current(variable):
+    """ Does the variable have a time series copy, made from the current version of the data file? """
+
+    dataset = open_time_series(variable)
+    if dataset is None:
+        return False
+
+    dataset.close()
+    return True
+
+
+def write_time_series(variable, force=False, chunk_size=TIME_SERIES_CHUNK_SIZE, memory_limit=MEMORY_LIMIT):
+    """
+    Writes a copy of a variable's data chunked for time series access: each chunk covers all time steps for a small
+    (`chunk_size` x `chunk_size`) block of cells, so reading the values at a point touches a single chunk. Data is
+    copied in bands of rows which, across all time steps, stay within `memory_limit`. Returns False if the variable has
+    no time dimension, or if the copy is already current (unless `force` is True).
+    """
+
+    if not variable.time_dimension or (not force and is_time_series_current(variable)):
+        return False
+
+    start = time.time()
+    reader = VariableReader(variable.service)
+    path = variable.time_series_path
+    temp_path = '{}.tmp'.format(path)
+
+    try:
+        data = reader.open_dataset(variable.service).variables[variable.variable]
+        data.set_auto_scale(False)
+        dimensions = list(data.dimensions)
+        shape = dict(zip(dimensions, data.shape))
+
+        time_dimensions = (variable.time_dimension, variable.y_dimension, variable.x_dimension)
+        num_times, height, width = (shape[x] for x in time_dimensions)
+        native_order = [x for x in dimensions if x in time_dimensions]
+        axes = [native_order.index(x) for x in time_dimensions]
+
+        band_elements = get_block_elements(data.dtype, memory_limit)
+        band_rows = max(band_elements // (num_times * width * chunk_size), 1) * chunk_size
+
+        with netCDF4.Dataset(temp_path, 'w') as dataset:
+            dataset.source_version = variable.service.data_version
+
+            for dimension in time_dimensions:
+                dataset.createDimension(dimension, shape[dimension])
+
+            fill_value = getattr(data, '_FillValue', None)
+            copy = dataset.createVariable(
+                variable.variable, data.dtype, time_dimensions, zlib=True, fill_value=fill_value,
+                chunksizes=(num_times, min(chunk_size, height), min(chunk_size, width))
+            )
+            copy.setncatts({k: data.getncattr(k) for k in COPY_ATTRIBUTES if k in data.ncattrs()})
+            copy.set_auto_scale(False)
+
+            # Hold a full band of output chunks in cache, so each chunk is written once
+            band_bytes = num_times * band_rows * width * data.dtype.itemsize
+            copy.set_var_chunk_cache(size=int(band_bytes * 1.1))
+
+            for y_start in range(0, height, band_rows):
+                y_stop = min(y_start + band_rows, height)
+
+                slices = []
+                for dimension in dimensions:
+                    if dimension == variable.y_dimension:
+                        slices.append(slice(y_start, y_stop))
+                    elif dimension in time_dimensions:
+                        slices.append(slice(None))
+                    else:
+                        slices.append(0)
+
+                copy[:, y_start:y_stop, :] = data[tuple(slices)].transpose(*axes)
+
+        os.replace(temp_path, path)
+    finally:
+        reader.close_dataset()
+
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    logger.info('Wrote time series copy of {}:{} in {:.3f} seconds'.format(
+        variable.service.name, variable.variable, time.time() - start
+    ))
+
+    return True
@@ -32,6 +32,7 @@ from .utils import project_geometry
 
 FORCE_WEBP = getattr(settings, 'NC_FORCE_WEBP', False)
 ENABLE_STRIDING = getattr(settings, 'NC_ENABLE_STRIDING', False)
+READ_BLOCK_SIZE = getattr(settings, 'NC_READ_BLOCK_SIZE', 64 * 1024 * 1024)  # 64 MB
 
 
 class ServiceView(View):
@@ -73,6 +74,7 @@ class NetCdfDatasetMixin(object):
 
     def __init__(self, *args, **kwargs):
         self.dataset = None
+        self.time_series_datasets = {}
 
         super(NetCdfDatasetMixin, self).__init__(*args, **kwargs)
 
@@ -84,12 +86,31 @@ class NetCdfDatasetMixin(object):
             self.dataset = netCDF4.Dataset(path, "r")
         return self.dataset
 
+    def open_time_series_dataset(self, variable):
+        """
+        Opens and returns the time-series-optimized copy of a variable's data, or returns None if there is no copy or it
+        was made from a different version of the data file.
+        """
+
+        from .timeseries import open_time_series  # Avoid a circular import (timeseries uses this mixin)
+
+        if variable.pk not in self.time_series_datasets:
+            self.time_series_datasets[variable.pk] = open_time_series(variable)
+
+        return self.time_series_datasets[variable.pk]
+
     def close_dataset(self):
         if self.dataset and self.dataset.isopen():
             self.dataset.close()
         
         self.dataset = None
 
+        for dataset in self.time_series_datasets.values():
+            if dataset and dataset.isopen():
+                dataset.close()
+
+        self.time_series_datasets = {}
+
     def get_grid_for_variable(self, variable, time_index=None, x_slice=None, y_slice=None):
         data = self.open_dataset(self.service).variables[variable.variable]
 
@@ -125,6 +146,121 @@ class NetCdfDatasetMixin(object):
 
         return data
 
+    def iter_grid_blocks(self, variable, time_index=None, x_slice=None, y_slice=None, block_size=READ_BLOCK_SIZE):
+        """
+        Yields `(y_offset, data)` tuples covering the grid for a variable in bands of rows. Bands are aligned to the
+        variable's chunking along the y dimension and are never larger than `block_size` bytes (unless a single chunk
+        row is larger), so that the full grid never has to be held in memory. `y_offset` is relative to `y_slice`.
+        """
+
+        data = self.open_dataset(self.service).variables[variable.variable]
+        dimensions = list(data.dimensions)
+        width, height = self.get_grid_spatial_dimensions(variable)
+
+        x_start, x_stop = x_slice or (0, width)
+        y_start, y_stop = y_slice or (0, height)
+
+        chunking = data.chunking()
+        if chunking == 'contiguous' or chunking is None:
+            chunk_rows = 1
+        else:
+            chunk_rows = chunking[dimensions.index(variable.y_dimension)]
+
+        row_size = max(x_stop - x_start, 1) * data.dtype.itemsize
+        block_rows = max(block_size // (row_size * chunk_rows), 1) * chunk_rows
+
+        # Align the first band to a chunk boundary
+        start = y_start
+        while start < y_stop:
+            stop = min((start // chunk_rows + 1) * chunk_rows + block_rows - chunk_rows, y_stop)
+            yield start - y_start, self.get_grid_for_variable(
+                variable, time_index=time_index, x_slice=(x_start, x_stop), y_slice=(start, stop)
+            )
+            start = stop
+
+    def get_values_at_cell(self, variable, x_index, y_index, time_index=None):
+        """
+        Returns a 1-dimensional array of values at a cell: one per time step, or only the value at `time_index`. Reads
+        from the variable's time series copy if there is a current one; otherwise only the cell's values are read from
+        the dataset.
+        """
+
+        time_slice = slice(None) if time_index is None else slice(time_index, time_index + 1)
+        time_series = self.open_time_series_dataset(variable) if variable.time_dimension else None
+
+        try:
+            if time_series:
+                return time_series.variables[variable.variable][time_slice, y_index, x_index]
+
+            data = self.open_dataset(self.service).variables[variable.variable]
+            slices = []
+
+            for dimension in data.dimensions:
+                if dimension == variable.x_dimension:
+                    slices.append(x_index)
+                elif dimension == variable.y_dimension:
+                    slices.append(y_index)
+                elif dimension == variable.time_dimension:
+                    slices.append(time_slice)
+                else:
+                    slices.append(0)
+
+            return numpy.ma.atleast_1d(data[tuple(slices)])
+        except IndexError:
+            return numpy.array([])
+
+    def get_time_series_chunk_shape(self, variable):
+        """
+        Returns the (rows, columns) chunk shape used for reading time series windows (see `get_time_series_window`),
+        or the full grid shape if the data isn't chunked.
+        """
+
+        width, height = self.get_grid_spatial_dimensions(variable)
+        time_series = self.open_time_series_dataset(variable) if variable.time_dimension else None
+
+        if time_series:
+            return tuple(time_series.variables[variable.variable].chunking()[1:])
+
+        data = self.open_dataset(self.service).variables[variable.variable]
+        chunking = data.chunking()
+
+        if chunking == 'contiguous' or chunking is None:
+            return height, width
+
+        dimensions = list(data.dimensions)
+        return chunking[dimensions.index(variable.y_dimension)], chunking[dimensions.index(variable.x_dimension)]
+
+    def get_time_series_window(self, variable, x_slice, y_slice):
+        """
+        Returns a (time, y, x) array of all values within a window of the grid. The time axis has length 1 if the
+        variable has no time dimension. Reads from the variable's time series copy if there is a current one.
+        """
+
+        time_series = self.open_time_series_dataset(variable) if variable.time_dimension else None
+
+        if time_series:
+            return time_series.variables[variable.variable][:, slice(*y_slice), slice(*x_slice)]
+
+        data = self.open_dataset(self.service).variables[variable.variable]
+        valid_dimensions = (variable.time_dimension, variable.y_dimension, variable.x_dimension)
+        slices = []
+
+        for dimension in data.dimensions:
+            if dimension == variable.x_dimension:
+                slices.append(slice(*x_slice))
+            elif dimension == variable.y_dimension:
+                slices.append(slice(*y_slice))
+            elif dimension == variable.time_dimension:
+                slices.append(slice(None))
+            else:
+                slices.append(0)
+
+        dimensions = [x for x in data.dimensions if x in valid_dimensions]
+        order = [x for x in valid_dimensions if x in dimensions]
+        window = data[tuple(slices)].transpose(*[dimensions.index(x) for x in order])
+
+        return window if variable.time_dimension in dimensions else window[numpy.newaxis]
+
     def get_grid_spatial_dimensions(self, variable):
         """Returns (width, height) for the given variable"""
 
@@ -364,13 +500,12 @@ class IdentifyViewBase(NetCdfDatasetMixin, ServiceView):
                     data[variable] = None
                     continue
 
-                variable_data = self.get_grid_for_variable(
-                    config.variable, time_index=time_index, x_slice=(cell_index[0], cell_index[0] + 1),
-                    y_slice=(cell_index[1], cell_index[1] + 1)
+                variable_data = self.get_values_at_cell(
+                    config.variable, cell_index[0], cell_index[1], time_index=time_index
                 )
 
                 if len(variable_data):
-                    value = variable_data[0][0]
+                    value = variable_data[0]
                     data[variable] = None if numpy.ma.core.is_masked(value) else float(value)
 
             data, content_type = self.serialize_data(data)
@@ -0,0 +1,65 @@
+"""
+Compares the time taken to evaluate geoprocessing expressions with each expression backend.
+
+Usage: python scripts/benchmark_expressions.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from ncdjango.geoprocessing.evaluation import Parser  # noqa: E402
+
+SMALL_ARRAY = numpy.arange(16, dtype='float64')
+LARGE_ARRAY = numpy.random.random((1000, 1000))
+LARGE_MASKED_ARRAY = numpy.ma.masked_less(LARGE_ARRAY, 0.1)
+
+BENCHMARKS = (
+    ('scalar arithmetic', 'x * 2 + y / 3 - 1', {'x': 5.0, 'y': 2.0}),
+    ('scalar conditional', '(x > 2 and y < 5) or x == y', {'x': 5.0, 'y': 2.0}),
+    ('scalar functions', 'abs(x - y) + floor(x) * ceil(y)', {'x': 5.5, 'y': -2.5}),
+    ('small array arithmetic', 'x * 2 + y / 3 - 1', {'x': SMALL_ARRAY, 'y': SMALL_ARRAY}),
+    ('small array reduction', 'x + y * (mean(x) - min(y))', {'x': SMALL_ARRAY, 'y': SMALL_ARRAY}),
+    ('large array arithmetic', 'x * 2 + y / 3 - 1', {'x': LARGE_ARRAY, 'y': LARGE_ARRAY}),
+    ('large masked arithmetic', 'x * 2 + y / 3 - 1', {'x': LARGE_MASKED_ARRAY, 'y': LARGE_MASKED_ARRAY}),
+    ('large repeated terms', '(x - mean(x)) / std(x) > 2 * 1.5 and (x - mean(x)) > 0', {'x': LARGE_ARRAY}),
+)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--number', type=int, default=10000, help='Evaluations per expression (default 10000)')
+    args = argparser.parse_args()
+
+    parser = Parser()
+
+    print('{:<25} {:>14} {:>14} {:>14} {:>9}'.format(
+        'Expression', 'eval (us)', 'closure (us)', 'inplace (us)', 'Speedup'
+    ))
+
+    for name, expr, context in BENCHMARKS:
+        number = args.number if numpy.size(context['x']) < 1000 else max(args.number // 1000, 1)
+        results = {}
+
+        for backend in ('eval', 'closure', 'inplace'):
+            expression = parser.compile(expr, backend=backend)
+            seconds = min(timeit.repeat(lambda: expression.evaluate(context), number=number, repeat=3))
+            results[backend] = seconds / number * 1e6
+
+        print('{:<25} {:>14.2f} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(
+            name, results['eval'], results['closure'], results['inplace'],
+            results['eval'] / min(results['closure'], results['inplace'])
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Measures the start-up cost of parsing geoprocessing expressions: creating the first parser in a process, creating
+further parsers, and compiling the first expression, compared with building the lexer and parser from scratch.
+
+Usage: python scripts/benchmark_parser.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from ply import lex, yacc  # noqa: E402
+
+from ncdjango.geoprocessing.evaluation import Lexer, Parser  # noqa: E402
+
+
+def main():
+    argparser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    argparser.add_argument('--number', type=int, default=100, help='Repetitions for each measurement (default 100)')
+    args = argparser.parse_args()
+
+    start = time.perf_counter()
+    parser = Parser()
+    first_parser = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parser.compile('(x - mean(x)) / std(x) > 2')
+    first_compile = time.perf_counter() - start
+
+    def time_each(fn):
+        return min(timeit.repeat(fn, number=args.number, repeat=3)) / args.number
+
+    results = (
+        ('First Parser()', first_parser),
+        ('First compile()', first_compile),
+        ('Parser()', time_each(Parser)),
+        ('Lexer()', time_each(Lexer)),
+        ('Lexer from scratch', time_each(lambda: lex.lex(module=Lexer.__new__(Lexer)))),
+        ('Parser tables from scratch', time_each(lambda: yacc.yacc(
+            module=parser, tabmodule='ncdjango.geoprocessing.no_parsetab', debug=False, write_tables=False,
+            errorlog=yacc.NullLogger()
+        )))
+    )
+
+    for name, seconds in results:
+        print('{:<28} {:>10.3f} ms'.format(name, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
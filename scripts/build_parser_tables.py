@@ -0,0 +1,32 @@
+"""
+Regenerates the parser tables for geoprocessing expressions (ncdjango/geoprocessing/parsetab.py). Run this after
+changing the expression grammar.
+
+Usage: python scripts/build_parser_tables.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from ncdjango.geoprocessing import evaluation  # noqa: E402
+
+
+def main():
+    path = os.path.join(os.path.dirname(os.path.abspath(evaluation.__file__)), 'parsetab.py')
+
+    # PLY only writes tables if it can't load them, so remove the old ones first
+    if os.path.exists(path):
+        os.remove(path)
+
+    evaluation.build_parser(evaluation.Parser(), write_tables=True)
+    print('Wrote {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import os
+
+from netCDF4 import Dataset
+import numpy
+import pytest
+from trefoil.geometry.bbox import BBox
+from pyproj import Proj
+
+from ncdjango.models import Service, Variable
+
+PROJECTION = '+proj=longlat +datum=WGS84 +no_defs'
+
+
+@pytest.fixture
+def create_variable(tmpdir, settings):
+    """
+    Returns a function which creates a service with a single variable from an array, with dimensions (y, x) or
+    (time, y, x). The grid covers the extent (0, 0, <width>, <height>), with y values increasing.
+    """
+
+    settings.MEDIA_ROOT = str(tmpdir)
+    os.makedirs(os.path.join(str(tmpdir), 'services'))
+
+    def create(name, arr):
+        arr = numpy.ma.asarray(arr)
+        dimensions = ('y', 'x') if arr.ndim == 2 else ('time', 'y', 'x')
+
+        with Dataset(os.path.join(str(tmpdir), 'services', '{}.nc'.format(name)), 'w') as ds:
+            for dimension, size in zip(dimensions, arr.shape):
+                ds.createDimension(dimension, size)
+            ds.createVariable('x', 'float64', dimensions=('x',))[:] = numpy.arange(arr.shape[-1]) + 0.5
+            ds.createVariable('y', 'float64', dimensions=('y',))[:] = numpy.arange(arr.shape[-2]) + 0.5
+            ds.createVariable('value', arr.dtype, dimensions=dimensions, fill_value=-1)[:] = arr
+
+        extent = BBox((0, 0, arr.shape[-1], arr.shape[-2]), projection=Proj(PROJECTION))
+        service = Service.objects.create(
+            name=name, data_path='services/{}.nc'.format(name), projection=PROJECTION, full_extent=extent,
+            initial_extent=extent
+        )
+
+        return Variable.objects.create(
+            service=service, index=0, variable='value', projection=PROJECTION, x_dimension='x', y_dimension='y',
+            name='value', full_extent=extent, time_dimension='time' if arr.ndim == 3 else None
+        )
+
+    return create
+
+
+@pytest.fixture
+def grid_variable(create_variable):
+    """A 10x10 grid of the values 0-99, increasing along x and then y"""
+
+    return create_variable('grid', numpy.arange(100, dtype='int32').reshape(10, 10))
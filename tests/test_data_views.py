@@ -0,0 +1,200 @@
+import json
+import struct
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import RequestFactory
+import numpy
+import pytest
+
+from ncdjango.interfaces.arcgis.form_fields import GeometryField
+from ncdjango.interfaces.data import views
+from ncdjango.interfaces.data.views import (
+    ClassifyView, RangeView, UniqueValuesView, ValuesAtPointsView, ZonalStatisticsView
+)
+from ncdjango.stats import MAX_STORED_UNIQUE_VALUES
+
+
+def get_response(view_class, variable, http_method='get', **params):
+    request = getattr(RequestFactory(), http_method)('/', params)
+    return view_class.as_view()(request, service_name=variable.service.name, variable_name=variable.name)
+
+
+def get_data(view_class, variable, **params):
+    response = get_response(view_class, variable, **params)
+
+    if response.status_code != 200:
+        return response.status_code, None
+
+    return response.status_code, json.loads(response.content)
+
+
+class TestGeometryField(object):
+    def test_polygon(self):
+        field = GeometryField()
+
+        shell = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]  # Clockwise
+        hole = [[2, 2], [4, 2], [4, 4], [2, 4], [2, 2]]  # Counter-clockwise
+        geometry = field.to_python({'type': 'esriGeometryPolygon', 'geometry': json.dumps({'rings': [shell, hole]})})
+        assert geometry.geom_type == 'Polygon'
+        assert geometry.area == 96
+        assert len(geometry.interiors) == 1
+
+        other = [[20, 0], [20, 5], [25, 5], [25, 0], [20, 0]]
+        geometry = field.to_python({
+            'type': 'esriGeometryPolygon', 'geometry': json.dumps({'rings': [shell, other, hole]})
+        })
+        assert geometry.geom_type == 'MultiPolygon'
+        assert geometry.area == 121
+
+
+@pytest.mark.django_db
+class TestZonalStatisticsView(object):
+    def test_polygon(self, grid_variable):
+        rings = [[[1.5, 1.5], [1.5, 3.5], [3.5, 3.5], [3.5, 1.5], [1.5, 1.5]]]
+        status, data = get_data(ZonalStatisticsView, grid_variable, geometry=json.dumps({'rings': rings}))
+
+        assert status == 200
+        assert data['count'] == 9
+        assert (data['min'], data['max'], data['mean']) == (11, 33, 22)
+        assert sum(data['histogram']['counts']) == 9
+
+    def test_small_polygon(self, grid_variable):
+        """Polygons smaller than a cell include the cell they're in"""
+
+        rings = [[[4.2, 6.2], [4.2, 6.8], [4.8, 6.8], [4.8, 6.2], [4.2, 6.2]]]
+        status, data = get_data(ZonalStatisticsView, grid_variable, geometry=json.dumps({'rings': rings}))
+
+        assert status == 200
+        assert data['count'] == 1
+        assert data['min'] == data['max'] == 64
+
+    def test_envelope(self, grid_variable):
+        status, data = get_data(
+            ZonalStatisticsView, grid_variable, geometry='5.5,5.5,7.5,6.5', geometry_type='esriGeometryEnvelope'
+        )
+
+        assert status == 200
+        assert data['count'] == 6
+        assert (data['min'], data['max']) == (55, 67)
+
+    def test_invalid_geometry(self, grid_variable):
+        assert get_data(ZonalStatisticsView, grid_variable, geometry='{"rings": 5}')[0] == 400
+        assert get_data(ZonalStatisticsView, grid_variable, geometry='not json')[0] == 400
+        assert get_data(
+            ZonalStatisticsView, grid_variable, geometry='1,1', geometry_type='esriGeometryPoint'
+        )[0] == 400
+
+
+@pytest.mark.django_db
+class TestWindowViews(object):
+    def test_range(self, grid_variable, monkeypatch):
+        assert get_data(RangeView, grid_variable)[1] == {'min': 0, 'max': 99}
+        assert get_data(RangeView, grid_variable, bbox='2,3,5,6')[1] == {'min': 32, 'max': 54, 'approximate': False}
+
+        # Large windows are sampled
+        monkeypatch.setattr(views, 'WINDOW_SAMPLE_SIZE', 25)
+        assert get_data(RangeView, grid_variable, bbox='0,0,10,10')[1] == {'min': 0, 'max': 88, 'approximate': True}
+
+    def test_classify(self, grid_variable, monkeypatch):
+        data = get_data(ClassifyView, grid_variable, bbox='2,3,5,6', method='equal', breaks='3')[1]
+        assert data == {'breaks': [pytest.approx(39.333, abs=1e-3), pytest.approx(46.667, abs=1e-3), 54], 'min': 32,
+                        'error': 0}
+
+        monkeypatch.setattr(views, 'WINDOW_SAMPLE_SIZE', 25)
+        data = get_data(ClassifyView, grid_variable, bbox='0,0,10,10', method='quantile', breaks='3')[1]
+        assert data['error'] is None
+        assert data['breaks'][-1] == 88
+
+    def test_approximate_classify(self, grid_variable):
+        exact = get_data(ClassifyView, grid_variable, method='quantile', breaks='4')[1]
+        assert 'error' not in exact
+
+        data = get_data(ClassifyView, grid_variable, method='quantile', breaks='4', approximate='true')[1]
+        assert data['error'] > 0
+        assert numpy.abs(numpy.array(data['breaks']) - exact['breaks']).max() <= data['error']
+
+    def test_invalid_window(self, grid_variable):
+        assert get_data(RangeView, grid_variable, bbox='2,3')[0] == 400
+        assert get_data(RangeView, grid_variable, bbox='{"xmin": 2}')[0] == 400
+
+
+@pytest.mark.django_db
+class TestUniqueValuesView(object):
+    def test_unique_values(self, grid_variable, monkeypatch):
+        status, data = get_data(UniqueValuesView, grid_variable)
+        assert status == 200
+        assert data == {'num_values': 100, 'complete': True, 'values': list(range(100))}
+
+        # If there are too many values, only the first of them are returned
+        monkeypatch.setattr(views, 'MAX_UNIQUE_VALUES', 10)
+        data = get_data(UniqueValuesView, grid_variable)[1]
+        assert data == {'num_values': 100, 'complete': False, 'values': list(range(10))}
+
+    def test_too_many_stored_values(self, create_variable, monkeypatch):
+        variable = create_variable('many', numpy.arange(2000, dtype='float32').reshape(40, 50) / 2)
+
+        # Stored statistics only have up to `NC_STATISTICS_MAX_UNIQUE_VALUES` unique values, so the variable is scanned
+        data = get_data(UniqueValuesView, variable)[1]
+        assert data['num_values'] > MAX_STORED_UNIQUE_VALUES and not data['complete']
+        assert data['values'] == [x / 2 for x in range(100)]
+
+        monkeypatch.setattr(views, 'MAX_UNIQUE_VALUES', 5000)
+        data = get_data(UniqueValuesView, variable)[1]
+        assert data['num_values'] == 2000 and data['complete']
+        assert data['values'][:4] == [0, 0.5, 1, 1.5]
+
+
+def get_point_values(variable, points, output_format):
+    response = get_response(
+        ValuesAtPointsView, variable, 'post', points=SimpleUploadedFile('points.csv', points), format=output_format
+    )
+    assert response.status_code == 200
+    return b''.join(response.streaming_content)
+
+
+@pytest.mark.django_db
+class TestValuesAtPointsView(object):
+    POINTS = b'id,x,y\na,1.5,2.5\nb,20,1\nc,4.5,6.5\n'
+
+    def test_csv(self, grid_variable):
+        content = get_point_values(grid_variable, self.POINTS, 'csv').decode()
+
+        # Points outside the grid come first
+        assert content.splitlines() == ['id,x,y,value_0', 'b,20.0,1.0,', 'a,1.5,2.5,21', 'c,4.5,6.5,64']
+
+    def test_jsonl(self, create_variable):
+        arr = numpy.ma.masked_array(numpy.arange(300, dtype='float32').reshape(3, 10, 10))
+        arr[1, 2, 1] = numpy.ma.masked
+        variable = create_variable('series', arr)
+
+        lines = get_point_values(variable, self.POINTS, 'jsonl').decode().splitlines()
+        assert [json.loads(x) for x in lines] == [
+            {'id': 'b', 'x': 20, 'y': 1, 'values': [None, None, None]},
+            {'id': 'a', 'x': 1.5, 'y': 2.5, 'values': [21, None, 221]},
+            {'id': 'c', 'x': 4.5, 'y': 6.5, 'values': [64, 164, 264]}
+        ]
+
+    def test_binary(self, create_variable):
+        variable = create_variable('series', numpy.arange(200, dtype='int16').reshape(2, 10, 10))
+        content = get_point_values(variable, self.POINTS, 'binary')
+
+        assert struct.unpack('<4sB3xI', content[:12]) == (b'NCPV', 4, 2)
+
+        records = numpy.frombuffer(content[12:], dtype=[('index', '<i4'), ('values', '<f4', (2,))])
+        assert records['index'].tolist() == [1, 0, 2]
+        assert numpy.isnan(records['values'][0]).all()
+        assert records['values'][1:].tolist() == [[21, 121], [64, 164]]
+
+    def test_dataset_closed_on_error(self, grid_variable, monkeypatch):
+        instances = []
+
+        def get_cell_indices(self, variable, x, y):
+            instances.append(self)
+            self.open_dataset(self.service)
+            raise ValueError
+
+        monkeypatch.setattr(ValuesAtPointsView, 'get_cell_indices', get_cell_indices)
+
+        with pytest.raises(ValueError):
+            get_response(ValuesAtPointsView, grid_variable, 'post', points=SimpleUploadedFile('points.csv', b'x,y\n1,1'))
+        assert instances[0].dataset is None
@@ -1,24 +1,40 @@
 import json
 import os
+import threading
+import weakref
 
 from trefoil.geometry.bbox import BBox
 from netCDF4 import Dataset
 import numpy
 from numpy.ma import masked_array
+from pyproj import Proj
 import pytest
 from rasterio.dtypes import is_ndarray
 
-from ncdjango.geoprocessing.data import Raster
-from ncdjango.geoprocessing.evaluation import Lexer, Parser
+from ncdjango.geoprocessing import blocks, cache, celery_tasks, distributed, utils
+from ncdjango.geoprocessing.data import LazyRaster, Raster, is_memory_mapped
+from ncdjango.geoprocessing.evaluation import Lexer, Parser, compile_expression
 from ncdjango.geoprocessing.exceptions import ExecutionError
-from ncdjango.geoprocessing.params import StringParameter, IntParameter
+from ncdjango.geoprocessing.params import StringParameter, IntParameter, ListParameter, NdArrayParameter
+from ncdjango.geoprocessing.params import RasterParameter
+from ncdjango.geoprocessing.profiling import evaluate, profile_expressions, profile_job
 from ncdjango.geoprocessing.tasks.raster import MaskByExpression, ApplyExpression, LoadRasterDataset, ArrayFromDataset
 from ncdjango.geoprocessing.tasks.raster import MapByExpression, ReduceByExpression
 from ncdjango.geoprocessing.workflow import Task, Workflow
+from ncdjango.models import ProcessingJob
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'ncdjango', 'geoprocessing', 'test_data')
 
 
+class FailingTask(Task):
+    name = 'test:failing'
+    inputs = [IntParameter('value', required=True)]
+    outputs = [IntParameter('value_out')]
+
+    def execute(self, value):
+        raise ValueError('Failed')
+
+
 @pytest.fixture
 def simple_task():
     class SimpleTask(Task):
@@ -89,6 +105,109 @@ class TestTask(object):
         result = simple_workflow(int1=1, int2=2, int3=3)
         assert result['total'] == 6
 
+    def test_concurrent_workflow_execution(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        class BranchTask(Task):
+            inputs = [IntParameter('int_in', required=True)]
+            outputs = [IntParameter('int_out')]
+
+            def execute(self, int_in):
+                barrier.wait()  # Only passes if both branches run at once
+                return int_in * 2
+
+        class CombineTask(Task):
+            inputs = [IntParameter('int1', required=True), IntParameter('int2', required=True)]
+            outputs = [IntParameter('int_out')]
+
+            def execute(self, int1, int2):
+                return int1 + int2
+
+        workflow = Workflow(max_workers=2)
+        workflow.inputs = [IntParameter('int1', required=True), IntParameter('int2', required=True)]
+        workflow.outputs = [IntParameter('total')]
+        workflow.add_node('combine', CombineTask(), {
+            'int1': ('dependency', ('branch_1', 'int_out')), 'int2': ('dependency', ('branch_2', 'int_out'))
+        })
+        workflow.add_node('branch_1', BranchTask(), {'int_in': ('input', 'int1')})
+        workflow.add_node('branch_2', BranchTask(), {'int_in': ('input', 'int2')})
+        workflow.add_node('unused', BranchTask(), {'int_in': ('input', 'int1')})
+        workflow.map_output('combine', 'int_out', 'total')
+
+        assert workflow.get_execution_order() == ['branch_1', 'branch_2', 'combine']
+        assert workflow(int1=1, int2=2)['total'] == 6
+        assert workflow(int1=3, int2=4)['total'] == 14
+        assert all(x.outputs is None for x in workflow.nodes_by_id.values())
+
+        workflow.add_node('cycle', CombineTask(), {
+            'int1': ('dependency', ('combine', 'int_out')), 'int2': ('dependency', ('cycle', 'int_out'))
+        })
+        workflow.map_output('cycle', 'int_out', 'cycle')
+        with pytest.raises(ValueError) as excinfo:
+            workflow.get_execution_order()
+        assert 'circular' in str(excinfo.value)
+
+    def test_process_workflow_execution(self):
+        arr = numpy.arange(10)
+
+        workflow = Workflow(max_workers=2, executor='process')
+        workflow.inputs = [NdArrayParameter('array_in', required=True)]
+        workflow.outputs = [NdArrayParameter('doubled'), NdArrayParameter('squared')]
+        workflow.add_node('double', ApplyExpression(), {
+            'array_in': ('input', 'array_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('square', ApplyExpression(), {
+            'array_in': ('input', 'array_in'), 'expression': ('literal', 'x ** 2')
+        })
+        workflow.map_output('double', 'array_out', 'doubled')
+        workflow.map_output('square', 'array_out', 'squared')
+
+        result = workflow(array_in=arr)
+        assert (result['doubled'] == arr * 2).all()
+        assert (result['squared'] == arr ** 2).all()
+
+        workflow = Workflow.from_json(workflow.to_json())
+        assert (workflow.max_workers, workflow.executor) == (2, 'process')
+
+    def test_process_workflow_lazy_raster(self, lazy_raster):
+        workflow = Workflow(max_workers=2, executor='process')
+        workflow.inputs = [RasterParameter('raster_in', required=True)]
+        workflow.outputs = [RasterParameter('raster_out')]
+        workflow.add_node('scale', ApplyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('offset', ApplyExpression(), {
+            'array_in': ('dependency', ('scale', 'array_out')), 'expression': ('literal', 'x + 1')
+        })
+        workflow.map_output('offset', 'array_out', 'raster_out')
+
+        # Temporary files of blocked evaluation results are kept until the workflow's copies are no longer used
+        result = workflow(raster_in=lazy_raster)['raster_out']
+        assert isinstance(result, LazyRaster) and result.is_temporary
+        assert (result.materialize() == lazy_raster.materialize() * 2 + 1).all()
+
+        path = result.path
+        del result
+        assert not os.path.exists(path)
+        assert os.path.exists(lazy_raster.path)
+
+    def test_process_streaming_workflow(self):
+        workflow = Workflow(max_workers=2, executor='process')
+        workflow.inputs = [ListParameter(NdArrayParameter(''), 'arrays_in', required=True)]
+        workflow.outputs = [NdArrayParameter('sum'), ListParameter(NdArrayParameter(''), 'arrays_out')]
+        workflow.add_node('scale', MapByExpression(), {
+            'arrays_in': ('input', 'arrays_in'), 'expression': ('literal', 'x * 2'), 'generator': ('literal', True)
+        })
+        workflow.add_node('sum', ReduceByExpression(), {
+            'arrays_in': ('dependency', ('scale', 'arrays_out')), 'expression': ('literal', 'x + y')
+        })
+        workflow.map_output('sum', 'array_out', 'sum')
+        workflow.map_output('scale', 'arrays_out', 'arrays_out')
+
+        result = workflow(arrays_in=[numpy.full(10, i, dtype='float64') for i in range(10)])
+        assert (result['sum'] == 90).all()
+        assert [x[0] for x in result['arrays_out']] == [i * 2 for i in range(10)]
+
     def test_simple_workflow_serialization(self, simple_workflow):
         expected_output = {
             "inputs": [
@@ -175,6 +294,331 @@ class TestTask(object):
         assert is_ndarray(array_out)
         assert (array_out == expected).all()
 
+    def test_streaming_workflow(self):
+        alive = []
+        max_alive = []
+
+        def generate_arrays(count):
+            for i in range(count):
+                arr = numpy.full(10, i, dtype='float64')
+                alive.append(i)
+                weakref.finalize(arr, alive.remove, i)
+                max_alive.append(len(alive))
+                yield arr
+
+        workflow = Workflow()
+        workflow.inputs = [ListParameter(NdArrayParameter(''), 'arrays_in', required=True)]
+        workflow.outputs = [NdArrayParameter('sum'), NdArrayParameter('difference')]
+        workflow.add_node('scale', MapByExpression(), {
+            'arrays_in': ('input', 'arrays_in'), 'expression': ('literal', 'x * 2'), 'generator': ('literal', True)
+        })
+        workflow.add_node('sum', ReduceByExpression(), {
+            'arrays_in': ('dependency', ('scale', 'arrays_out')), 'expression': ('literal', 'x + y')
+        })
+        workflow.map_output('sum', 'array_out', 'sum')
+
+        # Arrays are generated as they're used, rather than all at once
+        result = workflow(arrays_in=generate_arrays(50))
+        assert (result['sum'] == sum(range(50)) * 2).all()
+        assert max(max_alive) <= 3
+
+        # The map is shared by both reductions, and materialized for the workflow output
+        workflow.outputs.append(ListParameter(NdArrayParameter(''), 'arrays_out'))
+        workflow.add_node('difference', ReduceByExpression(), {
+            'arrays_in': ('dependency', ('scale', 'arrays_out')), 'expression': ('literal', 'x - y')
+        })
+        workflow.map_output('difference', 'array_out', 'difference')
+        result = workflow(arrays_in=generate_arrays(10))
+        assert (result['sum'] == 90).all()
+        assert (result['difference'] == -90).all()
+
+        workflow.map_output('scale', 'arrays_out', 'arrays_out')
+        result = workflow(arrays_in=generate_arrays(10))
+        assert (result['sum'] == 90).all()
+        assert (result['difference'] == -90).all()
+        assert [x[0] for x in result['arrays_out']] == [i * 2 for i in range(10)]
+
+    def test_workflow_cache(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(cache, 'WORKFLOW_CACHE_DIR', str(tmpdir))
+        calls = []
+
+        class CountedExpression(ApplyExpression):
+            name = 'test:counted_expression'
+
+            def execute(self, array_in, expression, **kwargs):
+                calls.append(expression)
+                return super(CountedExpression, self).execute(array_in, expression, **kwargs)
+
+        workflow = Workflow()
+        workflow.inputs = [RasterParameter('raster_in', required=True)]
+        workflow.outputs = [RasterParameter('raster_out')]
+        workflow.add_node('scale', CountedExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('offset', CountedExpression(), {
+            'array_in': ('dependency', ('scale', 'array_out')), 'expression': ('literal', 'x + 1')
+        })
+        workflow.map_output('offset', 'array_out', 'raster_out')
+
+        arr = numpy.ma.masked_less(numpy.reshape(numpy.arange(20, dtype='float32'), (4, 5)), 2)
+        extent = BBox((0, 0, 5, 4), projection=Proj('EPSG:4326'))
+        expected = workflow(raster_in=Raster(arr, extent, 1, 0))['raster_out']
+        assert len(calls) == 2
+
+        # Equal inputs use the cached outputs
+        result = workflow(raster_in=Raster(arr.copy(), extent, 1, 0))['raster_out']
+        assert len(calls) == 2
+        assert isinstance(result, Raster)
+        assert result.extent.as_list() == extent.as_list()
+        assert (result.mask == expected.mask).all()
+        assert (result == expected).all()
+
+        workflow(raster_in=Raster(arr + 1, extent, 1, 0))
+        assert len(calls) == 4
+
+        cache.NodeCache(str(tmpdir), max_size=0).evict()
+        assert not [x for x in os.listdir(str(tmpdir)) if not x.startswith('.')]
+
+    def test_cache_copy_on_write(self, tmpdir):
+        node_cache = cache.NodeCache(str(tmpdir))
+        arr = numpy.ma.masked_less(numpy.reshape(numpy.arange(20, dtype='float32'), (4, 5)), 2)
+        extent = BBox((0, 0, 5, 4), projection=Proj('EPSG:4326'))
+        node_cache.set('key', {'array_out': arr, 'raster_out': Raster(arr, extent, 1, 0)})
+
+        # Outputs loaded from the cache can be modified in place, without changing the cache
+        outputs = node_cache.get('key')
+        for value in outputs.values():
+            value += 1
+            value[3, 4] = numpy.ma.masked
+            value.mask[0, 0] = False
+
+        for value in node_cache.get('key').values():
+            assert (value.mask == arr.mask).all()
+            assert (value == arr).all()
+
+    def test_cache_eviction(self, tmpdir, lazy_raster):
+        node_cache = cache.NodeCache(str(tmpdir.mkdir('cache')))
+        task = ApplyExpression()
+        inputs = {'array_in': lazy_raster, 'expression': 'x * 2'}
+        key = node_cache.get_key(task, inputs)
+        node_cache.set(key, task(**inputs).format_args())
+
+        # Outputs loaded from the cache can still be read after another job evicts them
+        outputs = node_cache.get(key)
+        cache.NodeCache(node_cache.path, max_size=0).evict()
+        assert not os.path.exists(os.path.join(node_cache.path, key))
+        assert (outputs['array_out'].materialize() == lazy_raster.materialize() * 2).all()
+
+        del outputs
+        assert not os.listdir(node_cache.path)
+
+    def test_workflow_memory_budget(self, monkeypatch):
+        monkeypatch.setattr('ncdjango.geoprocessing.workflow.WORKFLOW_MEMORY_BUDGET', 100)
+        mapped = []
+
+        class CombineTask(Task):
+            inputs = [RasterParameter('raster1', required=True), RasterParameter('raster2', required=True)]
+            outputs = [RasterParameter('raster_out')]
+
+            def execute(self, raster1, raster2):
+                mapped.extend([is_memory_mapped(raster1), is_memory_mapped(raster2)])
+                return raster1 + raster2
+
+        workflow = Workflow()
+        workflow.inputs = [RasterParameter('raster_in', required=True)]
+        workflow.outputs = [RasterParameter('raster_out')]
+        workflow.add_node('scale', ApplyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('offset', ApplyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x + 1')
+        })
+        workflow.add_node('combine', CombineTask(), {
+            'raster1': ('dependency', ('scale', 'array_out')), 'raster2': ('dependency', ('offset', 'array_out'))
+        })
+        workflow.map_output('combine', 'raster_out', 'raster_out')
+
+        arr = numpy.ma.masked_less(numpy.reshape(numpy.arange(20, dtype='float32'), (4, 5)), 2)
+        extent = BBox((0, 0, 5, 4), projection=Proj('EPSG:4326'))
+        result = workflow(raster_in=Raster(arr, extent, 1, 0))['raster_out']
+
+        # Each intermediate raster is 100 bytes with its mask, so the first is moved to disk once the second is done
+        assert mapped == [True, False]
+        assert isinstance(result, Raster)
+        assert result.extent.as_list() == extent.as_list()
+        assert (result.mask == arr.mask).all()
+        assert (result == arr * 3 + 1).all()
+
+    def test_distributed_workflow(self, tmpdir):
+        calls = []
+
+        class FlakyExpression(ApplyExpression):
+            name = 'test:flaky_expression'
+
+            def execute(self, array_in, expression, **kwargs):
+                calls.append(expression)
+                if len(calls) == 1:
+                    raise OSError('Shared storage is unavailable')
+                return super(FlakyExpression, self).execute(array_in, expression, **kwargs)
+
+        class CombineRasters(Task):
+            name = 'test:combine_rasters'
+            inputs = [RasterParameter('raster1', required=True), RasterParameter('raster2', required=True)]
+            outputs = [RasterParameter('raster_out')]
+
+            def execute(self, raster1, raster2):
+                return raster1 + raster2
+
+        workflow = Workflow()
+        workflow.inputs = [RasterParameter('raster_in', required=True)]
+        workflow.outputs = [RasterParameter('raster_out')]
+        workflow.add_node('scale', FlakyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('offset', ApplyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x + 1')
+        })
+        workflow.add_node('combine', CombineRasters(), {
+            'raster1': ('dependency', ('scale', 'array_out')), 'raster2': ('dependency', ('offset', 'array_out'))
+        })
+        workflow.map_output('combine', 'raster_out', 'raster_out')
+
+        arr = numpy.ma.masked_less(numpy.reshape(numpy.arange(20, dtype='float32'), (4, 5)), 2)
+        extent = BBox((0, 0, 5, 4), projection=Proj('EPSG:4326'))
+        path = str(tmpdir.join('run'))
+        distributed.start_run(workflow, workflow.validate_inputs({'raster_in': Raster(arr, extent, 1, 0)}), path)
+
+        # Run the nodes eagerly. Outputs are passed through the run directory, and the failed node is retried.
+        distributed.get_workflow_signature(workflow, path).apply().get()
+        assert calls == ['x * 2', 'x * 2']
+        assert sorted(os.listdir(path)) == ['inputs', 'node-0', 'node-1', 'node-2', 'run.json']
+
+        result = distributed.load_outputs(workflow, path)['raster_out']
+        assert isinstance(result, Raster)
+        assert result.extent.as_list() == extent.as_list()
+        assert (result.mask == arr.mask).all()
+        assert (result == arr * 3 + 1).all()
+
+        # Errors which would happen again aren't retried
+        workflow.add_node('invalid', FlakyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x + y')
+        })
+        path = str(tmpdir.join('invalid'))
+        distributed.start_run(workflow, workflow.validate_inputs({'raster_in': Raster(arr, extent, 1, 0)}), path)
+
+        assert distributed.run_workflow_node.apply((path, 'invalid')).failed()
+        assert calls[2:] == ['x + y']
+
+
+    def test_job_profile(self, lazy_raster):
+        lazy_raster.service = 'grid'
+
+        workflow = Workflow()
+        workflow.inputs = [RasterParameter('raster_in', required=True)]
+        workflow.outputs = [RasterParameter('raster_out')]
+        workflow.add_node('scale', ApplyExpression(), {
+            'array_in': ('input', 'raster_in'), 'expression': ('literal', 'x * 2')
+        })
+        workflow.add_node('offset', ApplyExpression(), {
+            'array_in': ('dependency', ('scale', 'array_out')), 'expression': ('literal', 'x + 1')
+        })
+        workflow.map_output('offset', 'array_out', 'raster_out')
+
+        with profile_job() as job_profile:
+            workflow(raster_in=lazy_raster)
+
+        profile = json.loads(json.dumps(job_profile.to_dict()))
+        assert profile['time'] >= sum(x['time'] for x in profile['nodes'])
+        assert profile['peak_rss'] > 0
+        assert profile['bytes_read'] == {'grid': 800}
+        assert [x['node'] for x in profile['nodes']] == ['scale', 'offset']
+
+        # Only the first node reads from the service. Outputs of blocked evaluation are NetCDF files.
+        scale, offset = profile['nodes']
+        assert scale['task'] == 'raster:apply_expression'
+        assert not scale['cached']
+        assert 0 < scale['cpu_time'] and 0 < scale['time']
+        assert scale['bytes_read'] == {'grid': 800}
+        assert offset['bytes_read'] == {}
+        assert offset['output_sizes']['array_out'] > 800
+
+    def test_job_registry(self, tmpdir, monkeypatch):
+        path = str(tmpdir.join('workflow.json'))
+        with open(os.path.join(TEST_DATA_DIR, 'map_reduce_workflow.json'), 'r') as f:
+            tmpdir.join('workflow.json').write(f.read())
+
+        monkeypatch.setattr(utils, 'REGISTERED_JOBS', {
+            'map_reduce': {'type': 'workflow', 'path': path},
+            'apply': {'type': 'task', 'task': 'ncdjango.geoprocessing.tasks.raster.ApplyExpression'}
+        })
+        monkeypatch.setattr(utils, '_templates', {})
+
+        loads = []
+        from_json = Workflow.from_json
+        monkeypatch.setattr(Workflow, 'from_json', classmethod(lambda cls, text: loads.append(text) or from_json(text)))
+
+        # The workflow is loaded once, and each job gets its own copy
+        workflow_1 = utils.get_task_instance('map_reduce')
+        workflow_2 = utils.get_task_instance('map_reduce')
+        assert len(loads) == 1
+        assert workflow_1 is not workflow_2
+        assert workflow_1.nodes_by_id['sum_arrays'] is not workflow_2.nodes_by_id['sum_arrays']
+        assert workflow_1.get_execution_order() == ['normalize_inputs', 'sum_arrays']
+
+        arrays = [numpy.arange(1, 11), numpy.arange(10, 20)]
+        assert (workflow_1(arrays_in=arrays)['array_out'] == workflow_2(arrays_in=arrays)['array_out']).all()
+
+        # Changes to the file are loaded
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        utils.get_task_instance('map_reduce')
+        assert len(loads) == 2
+
+        assert isinstance(utils.get_task_instance('apply'), ApplyExpression)
+        assert utils.get_task_instance('apply') is not utils.get_task_instance('apply')
+        assert utils.get_task_instance('missing') is None
+
+    @pytest.mark.django_db
+    def test_failed_job_profile(self, tmpdir, monkeypatch, simple_workflow):
+        jobs = {'fail': {'type': 'task', 'task': 'tests.test_geoprocessing.FailingTask'}}
+        monkeypatch.setattr(utils, 'REGISTERED_JOBS', jobs)
+        monkeypatch.setattr(celery_tasks, 'REGISTERED_JOBS', jobs)
+
+        # The profile is saved when the job fails
+        ProcessingJob.objects.create(job='fail', user_ip='127.0.0.1', celery_id='failed-job')
+        assert celery_tasks.run_job.apply(('fail', {'value': 1}), task_id='failed-job').failed()
+
+        profile = json.loads(ProcessingJob.objects.get(celery_id='failed-job').profile)
+        assert profile['cpu_time'] > 0 and profile['peak_rss'] > 0
+
+        # Including when a distributed workflow fails before finishing all of its nodes
+        path = str(tmpdir.join('run'))
+        distributed.start_run(simple_workflow, {'int1': 1, 'int2': 2, 'int3': 3}, path)
+        distributed.run_workflow_node.apply((path, 'sum_1'))
+
+        ProcessingJob.objects.create(job='sum', user_ip='127.0.0.1', celery_id='failed-workflow')
+        assert celery_tasks.finish_distributed_job.apply(('sum', 'failed-workflow', path)).failed()
+
+        profile = json.loads(ProcessingJob.objects.get(celery_id='failed-workflow').profile)
+        assert [x['node'] for x in profile['nodes']] == ['sum_1']
+        assert not os.path.exists(path)
+
+
+@pytest.fixture
+def lazy_raster(tmpdir, monkeypatch):
+    # Read two rows at a time
+    monkeypatch.setattr(blocks, 'READ_BLOCK_SIZE', 80)
+
+    path = str(tmpdir.join('grid.nc'))
+    with Dataset(path, 'w') as ds:
+        ds.createDimension('y', 20)
+        ds.createDimension('x', 10)
+        variable = ds.createVariable('value', 'float32', ('y', 'x'), chunksizes=(2, 10), fill_value=-1)
+        variable[:] = numpy.reshape(numpy.arange(200), (20, 10))
+        variable[0, 0] = numpy.ma.masked
+
+    return LazyRaster(path, 'value', 'x', 'y', BBox((0, 0, 10, 20), projection=Proj('EPSG:4326')))
+
 
 class TestRasterTasks(object):
     def test_mask_by_expression(self):
@@ -284,6 +728,60 @@ class TestRasterTasks(object):
         assert 'exactly one variable' in str(excinfo.value)
 
 
+    def test_masked_expressions(self):
+        extent = BBox((0, 0, 4, 3), projection=Proj('EPSG:4326'))
+        arr = numpy.reshape(numpy.arange(12, dtype='float32'), (3, 4))
+        x = Raster(arr, extent, 1, 0)
+        y = Raster(numpy.ma.masked_less(arr, 2), extent, 1, 0)
+        z = numpy.ma.masked_greater(arr, 10)
+
+        task = ApplyExpression()
+        result = task.evaluate_expression('x + y * z', {'x': x, 'y': y, 'z': z})
+
+        assert isinstance(result, Raster)
+        assert result.extent == extent
+        assert (result.mask == ((arr < 2) | (arr > 10))).all()
+        assert (result.compressed() == (arr + arr * arr).ravel()[2:11]).all()
+        assert (y.mask == (arr < 2)).all()
+
+        result = task.evaluate_expression('y - mean(y)', {'y': y})
+        assert result.mean() == pytest.approx(0)
+        assert task.evaluate_expression('min(y) + max(z)', {'y': y, 'z': z}) == 12
+
+        result = task.evaluate_expression('x * 2', {'x': x})
+        assert isinstance(result, Raster)
+        assert not result.mask.any()
+
+    def test_blocked_expressions(self, lazy_raster):
+        arr = lazy_raster.materialize()
+
+        assert isinstance(arr, Raster)
+        assert arr.shape == (20, 10)
+        assert (lazy_raster[4:6] == arr[4:6]).all()
+
+        expr = '(x - mean(x)) / std(x) + max(x - min(x))'
+        result = ApplyExpression()(array_in=lazy_raster, expression=expr)['array_out']
+        expected = ApplyExpression()(array_in=arr, expression=expr)['array_out']
+
+        assert isinstance(result, LazyRaster)
+        assert result.shape == (20, 10)
+        assert numpy.allclose(result.materialize(), expected)
+        assert (result.materialize().mask == arr.mask).all()
+
+        result = MaskByExpression()(array_in=lazy_raster, expression='x > mean(x)')['array_out']
+        expected = MaskByExpression()(array_in=arr, expression='x > mean(x)')['array_out']
+        assert (result.materialize().mask == expected.mask).all()
+
+        value = ApplyExpression().evaluate_expression('mean(x) * 2', {'x': lazy_raster})
+        assert value == pytest.approx(arr.mean() * 2)
+
+        result = ReduceByExpression()(arrays_in=[lazy_raster, arr, lazy_raster], expression='x + y')['array_out']
+        assert (result.materialize() == arr * 3).all()
+
+        with pytest.raises(ExecutionError):
+            ApplyExpression()(array_in=lazy_raster, expression='median(x)')
+
+
 class TestEvaluations(object):
     def test_lexer(self):
         l = Lexer()
@@ -461,6 +959,147 @@ class TestEvaluations(object):
         assert p.evaluate('min(x) < max(x)', context=context) == True
         assert p.evaluate('abs(min(x))', context={'x': numpy.array([-1, 2, 3])}) == 1
 
+    def test_expression_profiling(self):
+        expression = Parser().compile('(x - mean(x)) * 2 + (x - mean(x))', backend='closure')
+        x = numpy.arange(1000, dtype='float64')
+
+        with profile_expressions() as profiler:
+            result = evaluate(expression, {'x': x})
+            evaluate(expression, {'x': x})
+
+        assert numpy.array_equal(result, evaluate(expression, {'x': x}))
+
+        profile = profiler.to_list()[0]
+        assert profile['evaluations'] == 2
+
+        tree = profile['tree']
+        assert tree['expression'] == '((x - mean(x)) * 2) + (x - mean(x))'
+        assert tree['calls'] == 2
+        assert tree['dtype'] == 'float64'
+        assert tree['shape'] == [1000]
+        assert tree['allocated'] >= 2 * x.nbytes
+        assert tree['peak'] >= x.nbytes
+        assert tree['self_time'] <= tree['time']
+
+        # The shared node is only evaluated once per evaluation
+        shared = tree['children'][1]
+        assert shared['shared']
+        assert shared['calls'] == 2
+        assert shared['children'][0]['expression'] == 'mean(x)'
+        assert shared['children'][0]['shape'] == []
+
+    def test_parser_templates(self):
+        p1, p2 = Parser(), Parser()
+
+        assert p1.parser.action is p2.parser.action
+        assert p1.lexer is not p2.lexer
+
+        # Grammar rules and functions are bound to each parser
+        p2.fn_abs = lambda value: 'p2'
+        assert p1.evaluate('abs(-1)') == 1
+        assert p2.evaluate('abs(-1)') == 'p2'
+
+        with pytest.raises(SyntaxError):
+            p2.evaluate('x +')
+
+    def test_compiled_expression(self):
+        expression = compile_expression('min(x) + y * 2')
+
+        assert expression is compile_expression('min(x) + y * 2')
+        assert expression.names == ('x', 'y')
+        assert compile_expression('y - x * mean(y)').names == ('y', 'x')
+        assert expression.evaluate({'x': numpy.array([1, 2]), 'y': 3}) == 7
+        assert expression.evaluate({'x': numpy.array([5, 6]), 'y': 0}) == 5
+
+        with pytest.raises(NameError):
+            expression.evaluate({'x': numpy.array([1, 2])})
+
+    def test_expression_backends(self):
+        p = Parser()
+        context = {'x': numpy.array([1, 2, 3]), 'y': 2, 'z': [4, 5]}
+
+        for expr in ('x * y + 1', '-x', 'x > y and x < 3', 'min(x) + max(x, 0)', 'z[1] * y', '(1 + 2) ** y'):
+            closure_result = p.compile(expr, backend='closure').evaluate(context)
+            eval_result = p.compile(expr, backend='eval').evaluate(context)
+
+            assert numpy.array_equal(closure_result, eval_result)
+
+        expression = p.compile('x + 1', backend='closure')
+        assert expression.evaluate({'x': 1}) == 2
+        assert expression.evaluate({'x': 2}) == 3
+
+        with pytest.raises(ValueError):
+            p.compile('x + 1', backend='invalid')
+
+    def test_inplace_backend(self, monkeypatch):
+        p = Parser()
+        x = numpy.arange(1, 7, dtype='float32').reshape(2, 3)
+        y = numpy.arange(3, dtype='int64')
+        context = {'x': x, 'y': y, 'z': 2}
+
+        for expr in ('(x - y) * z / (x + 1)', '-(x * y)', '(y + 1) / 2', '(y * 2) ** z % 5', 'x > (y + z) * 2',
+                     'min(x * 2) - (y - 1)', 'x + y + z'):
+            inplace_result = p.compile(expr, backend='inplace').evaluate(context)
+            closure_result = p.compile(expr, backend='closure').evaluate(context)
+
+            assert inplace_result.dtype == closure_result.dtype
+            assert numpy.array_equal(inplace_result, closure_result)
+
+        # Inputs are never overwritten
+        assert numpy.array_equal(x, numpy.arange(1, 7).reshape(2, 3))
+        assert numpy.array_equal(y, numpy.arange(3))
+
+        # Nor are the masks of masked inputs, which some masked operations return as the mask of their result
+        monkeypatch.setattr('ncdjango.geoprocessing.evaluation.EXPRESSION_NUMEXPR', False)
+        a = masked_array([1.0, 2.0, 3.0], mask=[True, False, False])
+        b = masked_array([4.0, 5.0, 6.0], mask=[False, False, True])
+        for expr in ('(b % b) + a', '-b * a', '(b % b) * (a % a) - 1'):
+            inplace_result = p.compile(expr, backend='inplace').evaluate({'a': a, 'b': b})
+            closure_result = p.compile(expr, backend='closure').evaluate({'a': a, 'b': b})
+
+            assert numpy.array_equal(inplace_result.mask, closure_result.mask)
+            assert a.mask.tolist() == [True, False, False]
+            assert b.mask.tolist() == [False, False, True]
+
+        # Results have the same type with each backend, including masked arrays combined with Python numbers
+        context = {'w': masked_array(y.astype('float32')), 'z': masked_array(x, mask=x > 4)}
+        for expr in ('(max(w) ** z) / 2.25', '(z * z) / 2.25', '(z - z) + 1', '(z * w) * 2', '-(z * 2) + 1.5'):
+            results = [p.compile(expr, backend=x).evaluate(context) for x in ('inplace', 'closure', 'eval')]
+
+            assert results[0].dtype == results[1].dtype == results[2].dtype
+            assert numpy.array_equal(results[0].mask, results[1].mask)
+            assert numpy.ma.allclose(results[0], results[1])
+
+    def test_optimization(self):
+        p = Parser()
+
+        expression = p.compile('x * (2 * 1.5) + -1', backend='closure')
+        assert expression.tree.right == -1
+        assert expression.tree.left.right == 3.0
+
+        calls = []
+
+        def fn_mean(a):
+            calls.append(a)
+            return numpy.mean(a)
+
+        p.fn_mean = fn_mean
+        x = numpy.arange(10, dtype='float64')
+        expr = '(x - mean(x)) / mean(x) > 2 * 0.5 and (x - mean(x)) > 0'
+
+        for backend in ('closure', 'inplace'):
+            del calls[:]
+            result = p.compile(expr, backend=backend).evaluate({'x': x})
+
+            assert len(calls) == 1
+            assert numpy.array_equal(result, p.compile(expr, backend='eval').evaluate({'x': x}))
+            assert numpy.array_equal(x, numpy.arange(10))
+
+        # Errors in constant expressions are raised on evaluation
+        expression = p.compile('1 / 0 + x')
+        with pytest.raises(ZeroDivisionError):
+            expression.evaluate({'x': 1})
+
 
 class TestDataTypes(object):
     def test_raster(self):
@@ -0,0 +1,285 @@
+import json
+import os
+
+from netCDF4 import Dataset
+import numpy
+import pytest
+
+from ncdjango.interfaces.data import classification
+from ncdjango.interfaces.data.classify import jenks, quantile, quantile_from_histogram, quantile_from_ranks
+from ncdjango.models import VariableStatistics
+from ncdjango.stats import (
+    Summary, UniqueValues, find_unique_values, sample_values, select_values, summarize_array,
+    update_variable_statistics
+)
+
+
+def reference_jenks(data, num_breaks):
+    """Jenks breaks by a direct (slow) dynamic programming search of every split point"""
+
+    data = numpy.sort(numpy.asarray(data, dtype='float64'))
+    n = len(data)
+    ssd = lambda i, j: ((data[i:j + 1] - data[i:j + 1].mean()) ** 2).sum()
+
+    # cost[k][j] is the lowest total for data[:j + 1] in k classes, and start[k][j] is where the last class starts
+    cost = [[ssd(0, j) for j in range(n)]]
+    start = [[0] * n]
+    for k in range(1, num_breaks):
+        cost.append([numpy.inf] * n)
+        start.append([0] * n)
+        for j in range(k, n):
+            for i in range(k, j + 1):
+                total = cost[k - 1][i - 1] + ssd(i, j)
+                if total < cost[k][j]:
+                    cost[k][j], start[k][j] = total, i
+
+    breaks = []
+    j = n - 1
+    for k in range(num_breaks - 1, -1, -1):
+        breaks.append(data[j])
+        j = start[k][j] - 1
+
+    return breaks[::-1]
+
+
+def get_jenks_cost(data, breaks):
+    """Returns the total of the sums of squared deviations of the classes given by a list of breaks"""
+
+    data = numpy.asarray(data, dtype='float64')
+    lower = numpy.concatenate(([-numpy.inf], breaks[:-1]))
+    classes = [data[(data > x) & (data <= y)] for x, y in zip(lower, breaks)]
+
+    return sum(((x - x.mean()) ** 2).sum() for x in classes if x.size)
+
+
+class TestSummary(object):
+    def test_merge(self):
+        rng = numpy.random.default_rng(0)
+        values = rng.normal(1e6, 3, size=10000)  # A large mean, which naive sums of squares lose precision with
+
+        # Blocks of different sizes, merged in different orders, give the same result as the full array
+        blocks = numpy.split(values, [1, 10, 2500, 7000])
+        summaries = []
+        for block in blocks:
+            summary = Summary()
+            summary.update(block)
+            summaries.append(summary)
+
+        merged = Summary()
+        for summary in summaries[::-1] + [Summary()]:
+            merged.merge(summary)
+
+        updated = Summary()
+        for block in blocks:
+            updated.update(block)
+
+        for summary in (merged, updated):
+            assert summary.count == values.size
+            assert (summary.min, summary.max) == (values.min(), values.max())
+            assert summary.mean == pytest.approx(values.mean(), rel=1e-12)
+            assert summary.std == pytest.approx(values.std(), rel=1e-9)
+
+        empty = Summary()
+        empty.merge(Summary())
+        assert empty.as_dict() == {'count': 0, 'min': None, 'max': None, 'mean': None, 'std': None}
+
+    def test_summarize_array(self):
+        arr = numpy.ma.masked_array(numpy.arange(1000, dtype='float32').reshape(10, 100), mask=False)
+        arr[0, :50] = numpy.ma.masked
+        arr[1, 0] = numpy.nan
+
+        # Masked and NaN values are left out, regardless of the block size
+        summary = summarize_array(arr, memory_limit=1024).as_dict()
+        values = arr.compressed().astype('float64')
+        values = values[~numpy.isnan(values)]
+        assert summary['count'] == 949
+        assert (summary['min'], summary['max']) == (50, 999)
+        assert summary['mean'] == pytest.approx(values.mean())
+        assert summary['std'] == pytest.approx(values.std())
+
+
+class TestUniqueValues(object):
+    def test_limit(self):
+        unique_values = UniqueValues(5)
+        assert unique_values.count == 0
+
+        # Small integer ranges are counted, and other values are sorted
+        assert unique_values.update(numpy.array([3, 1, 3, 1], dtype='int16'))
+        assert unique_values.update(numpy.array([], dtype='int16'))
+        assert unique_values.update(numpy.array([2, 100000], dtype='int64'))
+        assert unique_values.update(numpy.array([1, 2, 3, 4], dtype='int16'))
+        assert unique_values.is_complete
+        assert unique_values.values.tolist() == [1, 2, 3, 4, 100000]
+
+        # Once the limit is exceeded, further values are ignored
+        assert not unique_values.update(numpy.array([5, 6], dtype='int16'))
+        assert not unique_values.update(numpy.array([7, 8, 9], dtype='int16'))
+        assert not unique_values.is_complete
+        assert unique_values.count == 7
+
+    @pytest.mark.django_db
+    def test_find_unique_values(self, create_variable):
+        variable = create_variable('many', numpy.arange(2000, dtype='float32').reshape(40, 50))
+
+        unique_values = find_unique_values(variable, 3000)
+        assert unique_values.is_complete
+        assert unique_values.values.tolist() == list(range(2000))
+
+        # Reading stops at the first block with too many values
+        unique_values = find_unique_values(variable, 10, memory_limit=1024)
+        assert not unique_values.is_complete
+        assert unique_values.count < 100
+
+
+class TestJenks(object):
+    def test_breaks(self):
+        rng = numpy.random.default_rng(0)
+        data = numpy.concatenate((rng.normal(0, 1, 30), rng.normal(10, 2, 20), rng.normal(30, 5, 15)))
+
+        for num_breaks in (1, 2, 3, 5, 8):
+            assert jenks(data, num_breaks) == pytest.approx(reference_jenks(data, num_breaks))
+
+        # Duplicate values. Some numbers of breaks have more than one best set of breaks.
+        data = [1, 1, 1, 2, 2, 8, 8, 8, 9, 20, 20, 21, 21, 21, 40]
+        assert jenks(data, 4) == [2, 9, 21, 40]
+        for num_breaks in (2, 3, 4, 5, 6):
+            expected = get_jenks_cost(data, reference_jenks(data, num_breaks))
+            assert get_jenks_cost(data, jenks(data, num_breaks)) == pytest.approx(expected)
+
+        # Masked values are ignored
+        masked = numpy.ma.masked_array(data + [1000], mask=[False] * len(data) + [True])
+        assert jenks(masked, 4) == jenks(data, 4)
+
+    def test_small_data(self):
+        assert jenks([3, 1, 2], 3) == [1, 2, 3]
+        assert jenks([3, 1, 2], 5) == [1, 2, 3, 3, 3]
+        assert jenks([2, 2, 1], 3) == [1, 2, 2]
+        assert jenks([], 3) == []
+
+    def test_sample(self):
+        data = numpy.random.default_rng(0).random(1000)
+
+        # Large arrays are sampled, repeatably for the same seed
+        assert jenks(data, 4, sample_size=100) == jenks(data, 4, sample_size=100)
+        assert jenks(data, 4, sample_size=100) != jenks(data, 4, sample_size=100, seed=1)
+        assert jenks(data, 4, sample_size=100) != jenks(data, 4, sample_size=None)
+
+
+@pytest.mark.django_db
+class TestSampleValues(object):
+    @pytest.mark.parametrize('stratified', [True, False])
+    def test_sample_values(self, create_variable, stratified):
+        rng = numpy.random.default_rng(0)
+        arr = numpy.ma.masked_array(rng.random((20, 25), dtype='float32'), mask=rng.random((20, 25)) < .2)
+        variable = create_variable('random', arr)
+        values = arr.compressed()
+        total = values.size if stratified else None
+
+        # With a small memory limit, values are sampled across many blocks
+        sample = lambda seed=0: sample_values(variable, 50, total, seed=seed, memory_limit=26 * 60)
+
+        assert sample().size == 50
+        assert numpy.unique(sample()).size == 50
+        assert numpy.isin(sample(), values).all()
+        assert (sample() == sample()).all()
+        assert not (sample() == sample(seed=1)).all()
+
+        # Small variables aren't sampled
+        assert numpy.array_equal(numpy.sort(sample_values(variable, 1000, total)), numpy.sort(values))
+
+
+@pytest.mark.django_db
+class TestQuantiles(object):
+    def test_select_values(self, create_variable):
+        rng = numpy.random.default_rng(0)
+        arr = numpy.ma.masked_array(rng.normal(size=(3, 40, 50)).astype('float32'), mask=rng.random((3, 40, 50)) < .1)
+        arr[1, :10] = 2.5  # Many copies of a single value
+        variable = create_variable('normal', arr)
+
+        values = numpy.sort(arr.compressed().astype('float64'))
+        ranks = [0, 5, 1000, 1500, 1501, numpy.searchsorted(values, 2.5) + 100, values.size - 1]
+        stats = (values.min(), values.max(), values.size)
+
+        # With a small memory limit, ranks are narrowed down over several passes before values are read
+        assert (select_values(variable, ranks, *stats, bins=4, memory_limit=1024) == values[ranks]).all()
+        assert (select_values(variable, ranks, *stats) == values[ranks]).all()
+
+        select = lambda x: select_values(variable, x, *stats, memory_limit=4096)
+        for num_breaks in (1, 4, 7):
+            assert numpy.allclose(quantile_from_ranks(select, values.size, num_breaks), quantile(values, num_breaks))
+
+    def test_exact_classification(self, grid_variable):
+        result = classification.compute_classification(grid_variable, 'quantile', 4)
+        assert numpy.allclose(result['breaks'], quantile(numpy.arange(100), 4))
+        assert result['error'] == 0
+
+    def test_quantile_from_histogram(self):
+        rng = numpy.random.default_rng(0)
+        datasets = [
+            rng.normal(size=1000), rng.exponential(size=500), rng.integers(0, 5, 300).astype('float64'),
+            numpy.round(rng.normal(size=2000), 1), numpy.array([7.0])
+        ]
+
+        # Approximate breaks are within the error bound of the exact breaks
+        for data in datasets:
+            for bins in (1, 20, 256):
+                counts, edges = numpy.histogram(data, bins)
+                for num_breaks in (1, 3, 5, 10):
+                    breaks, error = quantile_from_histogram(edges, counts, num_breaks, data.min(), data.max())
+                    exact = quantile(numpy.ma.asarray(data), num_breaks)
+
+                    assert len(breaks) == num_breaks
+                    assert numpy.abs(numpy.array(breaks) - exact).max() <= error + 1e-9
+
+        assert quantile_from_histogram([0, 1], [0], 4) == ([], 0)
+
+    def test_approximate_classification(self, create_variable):
+        rng = numpy.random.default_rng(0)
+        variable = create_variable('normal', rng.normal(size=(40, 50)).astype('float32'))
+        exact = classification.compute_classification(variable, 'quantile', 5)
+
+        result = classification.compute_classification(variable, 'quantile', 5, approximate=True)
+        assert 0 < result['error'] < 1
+        assert numpy.abs(numpy.array(result['breaks']) - exact['breaks']).max() <= result['error']
+
+        # The histogram of a single value is wider than the data
+        variable = create_variable('constant', numpy.full((10, 10), 7, dtype='int32'))
+        result = classification.compute_classification(variable, 'quantile', 3, approximate=True)
+        assert result['breaks'] == [7, 7, 7]
+        assert result['error'] == 0
+
+    def test_warm_classification_cache(self, grid_variable, monkeypatch):
+        reads = []
+        monkeypatch.setattr(classification, 'select_values', lambda *args: reads.append(args) or select_values(*args))
+        monkeypatch.setattr(classification, '_local_cache', classification.OrderedDict())
+
+        # The data is read once, for all numbers of breaks
+        classification.warm_classification_cache(grid_variable, (3, 4, 5))
+        assert len(reads) == 1
+
+        for num_breaks in (3, 4, 5):
+            breaks = classification.get_classification(grid_variable, 'quantile', num_breaks)['breaks']
+            assert numpy.allclose(breaks, quantile(numpy.arange(100), num_breaks))
+        assert len(reads) == 1
+
+
+@pytest.mark.django_db
+class TestVariableStatistics(object):
+    def test_is_current(self, grid_variable, settings):
+        stored = update_variable_statistics(grid_variable)
+        assert stored.is_current
+        assert json.loads(stored.statistics)['count'] == 100
+
+        # Statistics are out of date once the data file changes, or if it's missing
+        path = os.path.join(settings.MEDIA_ROOT, grid_variable.service.data_path)
+        with Dataset(path, 'a') as ds:
+            ds.variables['value'][0, 0] = 1000
+        assert not stored.is_current
+
+        stored = update_variable_statistics(grid_variable)
+        assert stored.is_current
+        assert json.loads(stored.statistics)['max'] == 1000
+
+        os.remove(path)
+        assert not stored.is_current
+        assert not VariableStatistics(variable=grid_variable, data_version=None).is_current
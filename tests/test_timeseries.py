@@ -0,0 +1,33 @@
+import os
+
+from netCDF4 import Dataset
+import numpy
+import pytest
+
+from ncdjango.timeseries import is_time_series_current, write_time_series
+from ncdjango.views import NetCdfDatasetMixin
+
+
+@pytest.mark.django_db
+class TestTimeSeries(object):
+    def test_time_series_copy(self, create_variable, settings):
+        arr = numpy.arange(60, dtype='float32').reshape(3, 4, 5)
+        variable = create_variable('series', arr)
+
+        assert not is_time_series_current(variable)
+        assert write_time_series(variable, chunk_size=2)
+        assert is_time_series_current(variable)
+        assert not write_time_series(variable)
+
+        mixin = NetCdfDatasetMixin()
+        try:
+            dataset = mixin.open_time_series_dataset(variable)
+            assert (dataset.variables['value'][:, 2, 3] == arr[:, 2, 3]).all()
+        finally:
+            mixin.close_dataset()
+
+        # The copy isn't used once the data file changes
+        with Dataset(os.path.join(settings.MEDIA_ROOT, variable.service.data_path), 'a') as ds:
+            ds.variables['value'][0, 0, 0] = 100
+        assert not is_time_series_current(variable)
+        assert NetCdfDatasetMixin().open_time_series_dataset(variable) is None